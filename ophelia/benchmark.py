@@ -0,0 +1,367 @@
+# Copyright (c) 2013 Thomas Lotze
+# See also LICENSE.txt
+
+"""Benchmarks of traversal and rendering on synthetic template trees.
+"""
+
+import StringIO
+import json
+import ophelia.bundle
+import ophelia.frozen
+import ophelia.input
+import ophelia.pagetemplate
+import ophelia.request
+import ophelia.util
+import ophelia.wsgi
+import optparse
+import os
+import os.path
+import pkg_resources
+import platform
+import shutil
+import sys
+import tempfile
+import time
+import wsgiref.util
+
+
+PHASES = ('traverse', 'build_content', 'build_headers', 'application')
+
+# start-up of an application reading the template tree or a bundle file
+STARTUP = ('startup', 'startup_bundle')
+
+PARAGRAPH = (u"Lorem ipsum dolor sit amet, consectetur adipisici elit, sed "
+             u"eiusmod tempor incidunt ut labore et dolore magna aliqua.")
+
+
+def generate_tree(template_root, depth=2, width=3, macros=10, page_size=20):
+    """Write a synthetic template tree for benchmarking.
+
+    The root directory's __init__ loads a file of macros and provides the
+    HTML skeleton, each directory's __init__ wraps the pages below it in
+    another element. Each directory contains a number of pages and, up to
+    the given depth, the same number of subdirectories.
+
+    template_root: str, file system path of the directory to write to
+    depth: int, number of directory levels below the root
+    width: int, number of pages and subdirectories per directory
+    macros: int, number of macros defined and used by each page
+    page_size: int, number of repeated paragraphs on each page
+
+    returns list of str, paths of all pages relative to the site root
+    """
+    def write(dir_path, name, content):
+        if not os.path.isdir(dir_path):
+            os.makedirs(dir_path)
+        open(os.path.join(dir_path, name), 'w').write(content)
+
+    write(template_root, 'macros.html', '<?xml?>\n' + ''.join(
+            '<div metal:define-macro="macro%s" class="macro">'
+            '<p tal:content="title">title</p></div>\n' % i
+            for i in xrange(macros)))
+    write(template_root, '__init__', """\
+__request__.load_macros('macros.html')
+title = u'Benchmark'
+<?xml?>
+<html><head><title tal:content="title">title</title></head>
+<body><div tal:replace="structure innerslot" /></body></html>
+""")
+
+    page = """\
+paragraphs = range(%s)
+<?xml?>
+<div><h1 tal:content="title">title</h1>
+%s<p tal:repeat="i paragraphs"><span tal:replace="i" /> %s</p>
+</div>
+""" % (page_size,
+       ''.join('<div metal:use-macro="macros/macro%s" />\n' % i
+               for i in xrange(macros)),
+       PARAGRAPH)
+
+    paths = []
+    dirs = [('', template_root)]
+    for level in xrange(depth + 1):
+        subdirs = []
+        for prefix, dir_path in dirs:
+            if level:
+                write(dir_path, '__init__', """\
+<?xml?>
+<div class="level%s" tal:content="structure innerslot" />
+""" % level)
+            for i in xrange(width):
+                write(dir_path, 'page%s.html' % i, page)
+                paths.append('%spage%s.html' % (prefix, i))
+                if level < depth:
+                    subdirs.append(('%sdir%s/' % (prefix, i),
+                                    os.path.join(dir_path, 'dir%s' % i)))
+        dirs = subdirs
+    return paths
+
+
+def statistics(samples, total=None):
+    """Summarize a list of durations.
+
+    samples: list of float, durations in seconds
+    total: float, the wall-clock time the samples were taken in, defaults to
+           the sum of the samples
+
+    returns dict: number of samples, throughput per second and the minimum,
+            mean, maximum, 50th, 90th and 99th percentile in milliseconds
+    """
+    samples = sorted(samples)
+    count = len(samples)
+    if total is None:
+        total = sum(samples)
+
+    def percentile(p):
+        return samples[min(count - 1, int(count * p / 100.0))] * 1000
+
+    return dict(
+        count=count,
+        throughput=count / total if total else 0,
+        min=samples[0] * 1000,
+        mean=sum(samples) / count * 1000,
+        max=samples[-1] * 1000,
+        p50=percentile(50),
+        p90=percentile(90),
+        p99=percentile(99),
+        )
+
+
+class Benchmark(object):
+    """Measures the phases of rendering pages of a template tree.
+
+    Instantiate as Benchmark(template_root, paths, options=None,
+                             iterations=100, startups=5).
+
+    template_root: str, file system path to the template root
+    paths: list of str, paths of the pages to request in turn
+    options: dict of further configuration settings
+    iterations: int, number of requests to time per phase
+    startups: int, number of times to time starting up
+
+    Each page is requested once before timing so process-wide caches are
+    filled and steady-state performance is measured. Start-up is measured
+    as the time it takes a new application to answer a request for each
+    page once with empty process-wide caches, as a freshly started worker
+    process would, both reading the template tree and loading a bundle.
+    """
+
+    site = 'http://localhost/'
+
+    def __init__(self, template_root, paths, options=None, iterations=100,
+                 startups=5):
+        self.template_root = template_root
+        self.paths = paths
+        self.options = dict(options or {})
+        self.iterations = iterations
+        self.startups = startups
+
+    def __call__(self):
+        """Run all benchmarks.
+
+        returns dict mapping phase names to statistics
+        """
+        for path in self.paths:
+            self.render(path)
+        samples = dict((phase, []) for phase in PHASES + STARTUP)
+        start = time.time()
+        for i in xrange(self.iterations):
+            timings = self.render(self.paths[i % len(self.paths)])
+            for phase, duration in timings:
+                samples[phase].append(duration)
+        request_time = time.time() - start
+
+        app = ophelia.wsgi.Application(dict(
+                self.options, site=self.site,
+                template_root=self.template_root))
+        start = time.time()
+        for i in xrange(self.iterations):
+            samples['application'].append(
+                self.call(app, self.paths[i % len(self.paths)]))
+        app_time = time.time() - start
+
+        bundle_dir = tempfile.mkdtemp()
+        try:
+            bundle_path = os.path.join(bundle_dir, 'site.bundle')
+            ophelia.bundle.write_bundle(ophelia.frozen.FrozenTree(
+                    self.template_root, self.options), bundle_path)
+            for i in xrange(self.startups):
+                samples['startup'].append(self.startup({}))
+                samples['startup_bundle'].append(
+                    self.startup({'bundle_file': bundle_path}))
+        finally:
+            shutil.rmtree(bundle_dir)
+
+        results = {}
+        for phase in STARTUP:
+            results[phase] = statistics(samples[phase])
+        for phase in PHASES:
+            results[phase] = statistics(
+                samples[phase],
+                app_time if phase == 'application' else None)
+        results['request'] = statistics(
+            [sum(timings) for timings in zip(*[
+                        samples[phase] for phase in PHASES[:3]])],
+            request_time)
+        return results
+
+    def render(self, path):
+        env = dict(self.options)
+        env.update({
+            'wsgi.input': StringIO.StringIO(),
+            'REQUEST_METHOD': 'GET',
+            'PATH_INFO': '/' + path,
+            'QUERY_STRING': '',
+            })
+        request = ophelia.request.Request(
+            path, self.template_root, self.site, **env)
+        timings = []
+        for phase in PHASES[:3]:
+            start = time.time()
+            getattr(request, phase)()
+            timings.append((phase, time.time() - start))
+        return timings
+
+    def startup(self, options):
+        for cache in (ophelia.pagetemplate.template_cache,
+                      ophelia.input.split_cache, ophelia.input.code_cache,
+                      ophelia.request.directory_cache):
+            cache.clear()
+        start = time.time()
+        app = ophelia.wsgi.Application(dict(
+                self.options, site=self.site,
+                template_root=self.template_root, **options))
+        for path in self.paths:
+            self.call(app, path)
+        return time.time() - start
+
+    def call(self, app, path):
+        env = {'PATH_INFO': '/' + path}
+        wsgiref.util.setup_testing_defaults(env)
+        start = time.time()
+        body = app(env, lambda status, headers, exc_info=None: None)
+        ''.join(body)
+        return time.time() - start
+
+
+def environment():
+    """Describe the software the benchmarks were run with.
+
+    returns dict
+    """
+    try:
+        version = pkg_resources.get_distribution('ophelia').version
+    except pkg_resources.DistributionNotFound:
+        version = None
+    return dict(
+        ophelia=version,
+        python=platform.python_version(),
+        implementation=platform.python_implementation(),
+        platform=platform.platform(),
+        time=time.strftime('%Y-%m-%dT%H:%M:%S'),
+        )
+
+
+def compare(results, baseline, tolerance=0.1):
+    """Compare median latencies to those of an earlier run.
+
+    results: dict mapping phase names to statistics
+    baseline: dict, results of the earlier run
+    tolerance: float, relative slowdown still considered acceptable
+
+    returns list of (str, float, float, bool): phase name, baseline and
+            current median in milliseconds, and whether the phase regressed
+    """
+    comparison = []
+    for phase in sorted(results):
+        if phase not in baseline:
+            continue
+        before = baseline[phase]['p50']
+        after = results[phase]['p50']
+        comparison.append(
+            (phase, before, after, after > before * (1 + tolerance)))
+    return comparison
+
+
+def report(results, out=sys.stdout):
+    out.write('%-14s %8s %8s %8s %8s %8s %10s\n' % (
+            'phase', 'min', 'p50', 'p90', 'p99', 'max', 'per second'))
+    for phase in PHASES[:3] + ('request',) + PHASES[3:] + STARTUP:
+        stats = results[phase]
+        out.write('%-14s %8.3f %8.3f %8.3f %8.3f %8.3f %10.1f\n' % (
+                phase, stats['min'], stats['p50'], stats['p90'],
+                stats['p99'], stats['max'], stats['throughput']))
+
+
+def main():
+    parser = optparse.OptionParser(
+        usage='%prog [options]',
+        description='Benchmark Ophelia on a synthetic template tree. '
+        'Latencies are reported in milliseconds.')
+    parser.add_option('--depth', type='int', default=2,
+                      help='directory levels below the root [%default]')
+    parser.add_option('--width', type='int', default=3,
+                      help='pages and subdirectories per directory '
+                      '[%default]')
+    parser.add_option('--macros', type='int', default=10,
+                      help='macros used by each page [%default]')
+    parser.add_option('--page-size', type='int', default=20,
+                      help='paragraphs per page [%default]')
+    parser.add_option('-n', '--iterations', type='int', default=1000,
+                      help='requests timed per phase [%default]')
+    parser.add_option('-c', '--config', default=None,
+                      help='configuration file of further settings')
+    parser.add_option('-o', '--output', default=None,
+                      help='file to write the results to as JSON')
+    parser.add_option('--compare', default=None,
+                      help='JSON file of earlier results to compare with, '
+                      'exits with status 1 on regressions')
+    parser.add_option('--tolerance', type='float', default=0.2,
+                      help='relative slowdown of median latencies not '
+                      'considered a regression [%default]')
+    cmd_options, args = parser.parse_args()
+    if args:
+        parser.error('no arguments expected')
+
+    options = {}
+    if cmd_options.config:
+        options = ophelia.util.read_config(cmd_options.config)
+        for key in ('host', 'port', 'site', 'template_root'):
+            options.pop(key, None)
+    parameters = dict(
+        depth=cmd_options.depth, width=cmd_options.width,
+        macros=cmd_options.macros, page_size=cmd_options.page_size,
+        iterations=cmd_options.iterations, options=options)
+
+    template_root = tempfile.mkdtemp()
+    try:
+        paths = generate_tree(
+            template_root, cmd_options.depth, cmd_options.width,
+            cmd_options.macros, cmd_options.page_size)
+        results = Benchmark(
+            template_root, paths, options, cmd_options.iterations)()
+    finally:
+        shutil.rmtree(template_root)
+
+    report(results)
+    if cmd_options.output:
+        json.dump(dict(environment=environment(), parameters=parameters,
+                       results=results),
+                  open(cmd_options.output, 'w'), indent=2, sort_keys=True)
+
+    if cmd_options.compare:
+        baseline = json.load(open(cmd_options.compare))
+        if baseline.get('parameters') != parameters:
+            sys.stdout.write('\nWarning: benchmark parameters differ.\n')
+        regressed = False
+        sys.stdout.write('\n%-14s %10s %10s %8s\n' % (
+                'phase', 'p50 before', 'p50 now', 'change'))
+        for phase, before, after, regression in compare(
+            results, baseline['results'], cmd_options.tolerance):
+            sys.stdout.write('%-14s %10.3f %10.3f %+7.1f%%%s\n' % (
+                    phase, before, after,
+                    (after / before - 1) * 100 if before else 0,
+                    '  REGRESSION' if regression else ''))
+            regressed = regressed or regression
+        sys.exit(1 if regressed else 0)
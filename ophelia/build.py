@@ -0,0 +1,246 @@
+# Copyright (c) 2013 Thomas Lotze
+# See also LICENSE.txt
+
+"""Pre-rendering all pages of an Ophelia site into a directory of static files.
+"""
+
+import StringIO
+import json
+import multiprocessing
+import ophelia.cache
+import ophelia.request
+import ophelia.util
+import optparse
+import os
+import os.path
+import sys
+import time
+
+
+def discover(template_root, index_name="index.html"):
+    """Find the paths of all pages that may be built from a template tree.
+
+    Any file except for directory __init__ files, hidden files and editor
+    backup files is taken to describe a page. Directories containing an index
+    file give rise to a page whose path ends with '/'.
+
+    template_root: str, file system path to the template root
+    index_name: str, file name of directory index templates
+
+    returns iterable of str, paths relative to the site root
+    """
+    template_root = os.path.abspath(template_root)
+    for dir_path, dir_names, file_names in os.walk(template_root):
+        dir_names[:] = sorted(name for name in dir_names
+                              if not name.startswith('.'))
+        prefix = os.path.relpath(dir_path, template_root)
+        prefix = '' if prefix == '.' else prefix.replace(os.sep, '/') + '/'
+        for name in sorted(file_names):
+            if (name == '__init__' or name.startswith('.') or
+                name.endswith('~')):
+                continue
+            if name == index_name:
+                yield prefix
+            else:
+                yield prefix + name
+
+
+def output_path(output_dir, path, index_name="index.html"):
+    """Compute the file system path to write a page to.
+
+    returns str
+    """
+    if not path or path.endswith('/'):
+        path += index_name
+    return os.path.join(output_dir, *path.split('/'))
+
+
+_options = None
+
+
+def _init_worker(options):
+    global _options
+    _options = options
+
+
+def render(path, options=None):
+    """Render a single page through an Ophelia request.
+
+    path: str, path of the page relative to the site root
+    options: dict of configuration settings, defaults to those the worker
+             process has been initialized with
+
+    returns (str, str, str or None, float, dict): path, status ("ok",
+            "redirect", "not found" or "error"), page content or error
+            message, the number of seconds spent rendering, and the input
+            files the page depends upon as recorded by the request
+    """
+    if options is None:
+        options = _options
+    env = dict(options)
+    env.update({
+        'wsgi.input': StringIO.StringIO(),
+        'REQUEST_METHOD': 'GET',
+        'PATH_INFO': '/' + path,
+        'QUERY_STRING': '',
+        })
+    template_root = env.pop('template_root')
+    site = env.pop('site')
+
+    start = time.time()
+    request = ophelia.request.Request(path, template_root, site, **env)
+    try:
+        headers, content = request()
+    except ophelia.request.Redirect, e:
+        status, content = 'redirect', e.uri
+    except ophelia.request.NotFound:
+        status, content = 'not found', None
+    except Exception:
+        status = 'error'
+        content = ophelia.util.format_exception()
+    else:
+        status = 'ok'
+        if isinstance(content, list):
+            content = ''.join(content)
+    return (path, status, content, time.time() - start,
+            request.dependencies)
+
+
+class Builder(object):
+    """Renders pages in a pool of worker processes and writes them to disk.
+
+    Instantiate as Builder(options, output_dir, jobs=None, out=sys.stdout).
+
+    options: dict of configuration settings as for the WSGI application
+    output_dir: str, file system path to the directory to write pages to
+    jobs: int, number of worker processes, defaults to the number of CPUs
+    out: file to write the report to
+
+    The input files each page depends upon are recorded in a manifest file
+    in the output directory. Subsequent builds only render pages whose input
+    files have changed, been added or removed since, and remove pages whose
+    input files are gone.
+    """
+
+    manifest_name = '.ophelia-build.json'
+
+    def __init__(self, options, output_dir, jobs=None, out=sys.stdout):
+        self.options = options
+        self.output_dir = os.path.abspath(output_dir)
+        self.jobs = jobs or multiprocessing.cpu_count()
+        self.out = out
+        self.index_name = options.get('index_name', 'index.html')
+        self.manifest_path = os.path.join(self.output_dir, self.manifest_name)
+        self.timings = []
+        self.errors = []
+        self.unchanged = 0
+
+    def __call__(self, paths=None, full=False):
+        """Build pages and report on the progress.
+
+        paths: iterable of page paths, defaults to all pages discovered
+        full: bool, whether to render pages even if their input is unchanged
+
+        returns int, the number of pages that failed to render
+        """
+        all_paths = paths is None
+        if all_paths:
+            paths = list(discover(
+                self.options['template_root'], self.index_name))
+        self.pages = {} if full else self.load_manifest()
+
+        if all_paths:
+            for path in set(self.pages).difference(paths):
+                self.remove(path)
+        outdated = [path for path in paths
+                    if path not in self.pages or
+                    ophelia.cache.dependencies_changed(
+                        self.pages[path]['dependencies'])]
+        self.unchanged = len(paths) - len(outdated)
+
+        start = time.time()
+        if outdated:
+            pool = multiprocessing.Pool(
+                self.jobs, _init_worker, (self.options,))
+            try:
+                for result in pool.imap_unordered(render, outdated):
+                    self.handle(*result)
+            finally:
+                pool.close()
+                pool.join()
+        self.save_manifest()
+        self.report(time.time() - start)
+        return len(self.errors)
+
+    def handle(self, path, status, content, duration, dependencies):
+        self.timings.append((duration, path))
+        if status == 'ok':
+            ophelia.cache.write_atomically(
+                output_path(self.output_dir, path, self.index_name), content)
+        else:
+            self.remove(path)
+        if status == 'error':
+            # always retry failed pages
+            self.errors.append(path)
+        else:
+            self.pages[path] = dict(
+                status=status, dependencies=dependencies)
+        self.out.write('%8.1f ms  %-9s /%s\n' % (
+            duration * 1000, status, path))
+        if status == 'error':
+            self.out.write(content)
+
+    def remove(self, path):
+        page = self.pages.pop(path, None)
+        if page is not None and page['status'] == 'ok':
+            try:
+                os.remove(
+                    output_path(self.output_dir, path, self.index_name))
+            except OSError:
+                pass
+
+    def load_manifest(self):
+        try:
+            manifest = json.load(open(self.manifest_path))
+        except (IOError, ValueError):
+            return {}
+        if manifest.get('options') != self.options:
+            return {}
+        return manifest['pages']
+
+    def save_manifest(self):
+        ophelia.cache.write_atomically(self.manifest_path, json.dumps(dict(
+            options=self.options, pages=self.pages)))
+
+    def report(self, total, slowest=10):
+        count = len(self.timings)
+        self.out.write(
+            '\n%d pages in %.2f s (%.1f pages/s) using %d processes, '
+            '%d errors, %d pages unchanged\n' % (
+                count, total, count / total if total else 0,
+                self.jobs, len(self.errors), self.unchanged))
+        if count:
+            self.out.write('Slowest pages:\n')
+            for duration, path in sorted(self.timings, reverse=True)[
+                :slowest]:
+                self.out.write('%8.1f ms  /%s\n' % (duration * 1000, path))
+
+
+def main():
+    parser = optparse.OptionParser(
+        usage='%prog [options] config_file output_dir',
+        description='Pre-render all pages of an Ophelia site.')
+    parser.add_option(
+        '-j', '--jobs', type='int', default=None,
+        help='number of worker processes, defaults to the number of CPUs')
+    parser.add_option(
+        '-f', '--full', action='store_true', default=False,
+        help='render all pages even if their input files are unchanged')
+    cmd_options, args = parser.parse_args()
+    if len(args) != 2:
+        parser.error('need a configuration file and an output directory')
+    config_file, output_dir = args
+
+    options = ophelia.util.read_config(config_file)
+    builder = Builder(options, output_dir, cmd_options.jobs)
+    sys.exit(1 if builder(full=cmd_options.full) else 0)
@@ -0,0 +1,186 @@
+# Copyright (c) 2013 Thomas Lotze
+# See also LICENSE.txt
+
+"""Packing a template tree into a single file that workers load quickly.
+
+A bundle holds the directory listings of the tree and, for each input file,
+its content, split parts, compiled script and cooked template program. It
+starts with a header and an index of all files, followed by one record per
+file, all of them written by marshal. Since code objects are stored, a
+bundle can only be used with the Python version that made it.
+"""
+
+import errno
+import imp
+import marshal
+import mmap
+import ophelia.cache
+import ophelia.frozen
+import ophelia.input
+import ophelia.pagetemplate
+import ophelia.request
+import ophelia.util
+import optparse
+import os
+import os.path
+import struct
+import sys
+import time
+
+
+MAGIC = "OPHB"
+VERSION = 1
+
+# magic, format version, Python's byte-code magic, length of the index
+HEADER = struct.Struct("=4sI4sQ")
+
+
+def write_bundle(tree, bundle_path):
+    """Store a frozen template tree in a bundle file.
+
+    Template programs are exported so loading them doesn't involve parsing
+    the template text again; templates whose programs can't be stored are
+    cooked from their text when first used.
+
+    tree: ophelia.frozen.FrozenTree
+    bundle_path: str, file system path of the bundle file to write, which is
+                 replaced atomically if it exists
+    """
+    def relative(path):
+        return path[len(tree.template_root) + 1:]
+
+    records = []
+    files = {}
+    offset = 0
+    for file_path, entry in sorted(tree.files.iteritems()):
+        templates = []
+        for text, template_offset in entry.templates:
+            data = ophelia.pagetemplate.export_program(
+                text, file_path, template_offset)
+            if data is not None:
+                templates.append(((text, template_offset), data))
+        record = marshal.dumps((
+                entry.signature, entry.content,
+                [(key, tuple(parts)) for key, parts in entry.parts.items()],
+                entry.codes.items(), templates))
+        files[relative(file_path)] = (offset, len(record))
+        records.append(record)
+        offset += len(record)
+    directories = dict((relative(dir_path), entries)
+                       for dir_path, entries in tree.directories.iteritems())
+    index = marshal.dumps((directories, files))
+    ophelia.cache.write_atomically(bundle_path, "".join(
+            [HEADER.pack(MAGIC, VERSION, imp.get_magic(), len(index)),
+             index] + records))
+
+
+class Bundle(ophelia.frozen.FrozenTree):
+    """Frozen template tree loaded from a bundle file.
+
+    Instantiate as Bundle(bundle_path, template_root).
+
+    bundle_path: str, file system path of the bundle file
+    template_root: str, file system path to the template root, which the
+                   paths stored in the bundle are relative to
+
+    The bundle file is memory-mapped so that processes using the same file
+    share its pages. Only the index is read when loading the bundle, each
+    file's record is read when the file is first used. The size attribute is
+    therefore the size of the bundle file on disk rather than an estimate of
+    the memory taken up by the decoded tree.
+
+    raises ValueError if the file isn't a bundle made by this version of
+           Ophelia and Python
+    """
+
+    def __init__(self, bundle_path, template_root):
+        self.template_root = os.path.abspath(template_root)
+        self.errors = []
+        with open(bundle_path, 'rb') as bundle_file:
+            self.map = mmap.mmap(
+                bundle_file.fileno(), 0, access=mmap.ACCESS_READ)
+        if len(self.map) < HEADER.size:
+            raise ValueError("%s is not a bundle file." % bundle_path)
+        magic, version, python_magic, index_length = HEADER.unpack(
+            self.map[:HEADER.size])
+        if (magic, version) != (MAGIC, VERSION):
+            raise ValueError("%s is not a bundle file." % bundle_path)
+        if python_magic != imp.get_magic():
+            raise ValueError(
+                "%s was made by another version of Python." % bundle_path)
+        start = HEADER.size + index_length
+        directories, records = marshal.loads(self.map[HEADER.size:start])
+        self.directories = dict(
+            (self.absolute(path), entries)
+            for path, entries in directories.iteritems())
+        self.records = dict(
+            (self.absolute(path), (start + offset, length))
+            for path, (offset, length) in records.iteritems())
+        self.files = {}
+        self.file_count = len(self.records)
+        self.size = len(self.map)
+
+    def absolute(self, path):
+        if not path:
+            return self.template_root
+        return os.path.join(self.template_root, path)
+
+    def kind(self, path):
+        path = os.path.normpath(path)
+        if path in self.directories:
+            return ophelia.request.DIRECTORY
+        if path in self.records:
+            return ophelia.request.FILE
+
+    def file(self, file_path):
+        entry = self.files.get(file_path)
+        if entry is not None:
+            return entry
+        record = self.records.get(file_path)
+        if record is None:
+            file_path = os.path.normpath(file_path)
+            record = self.records.get(file_path)
+            if record is None:
+                raise OSError(errno.ENOENT, os.strerror(errno.ENOENT),
+                              file_path)
+        offset, length = record
+        signature, content, parts, codes, templates = marshal.loads(
+            self.map[offset:offset + length])
+        entry = ophelia.frozen.FrozenFile(signature, content)
+        entry.parts = dict((key, ophelia.input.InputParts(*value))
+                           for key, value in parts)
+        entry.codes = dict(codes)
+        for (text, template_offset), (program, macros) in templates:
+            entry.templates[(text, template_offset)] = \
+                ophelia.pagetemplate.import_program(
+                    text, file_path, template_offset, program, macros)
+        # concurrent requests may both read the record, which is harmless
+        self.files[file_path] = entry
+        return entry
+
+
+def main():
+    parser = optparse.OptionParser(
+        usage='%prog config_file bundle_file',
+        description='Pack the template tree of an Ophelia site into a bundle '
+        'file which the WSGI application loads if the bundle_file option is '
+        'set. Reports errors in any of the input files and exits with status '
+        '1 without writing the bundle if there were errors.')
+    cmd_options, args = parser.parse_args()
+    if len(args) != 2:
+        parser.error('need a configuration file and a bundle file')
+    config_file, bundle_path = args
+
+    options = ophelia.util.read_config(config_file)
+    start = time.time()
+    tree = ophelia.frozen.FrozenTree(options['template_root'], options)
+    for file_path, msg in tree.errors:
+        sys.stdout.write('Error in %s:\n%s\n' % (file_path, msg))
+    if tree.errors:
+        sys.stdout.write('%d errors, bundle not written\n' % len(tree.errors))
+        sys.exit(1)
+    write_bundle(tree, bundle_path)
+    sys.stdout.write('%d files in %.2f s, %d bytes written to %s\n' % (
+            tree.file_count, time.time() - start,
+            os.path.getsize(bundle_path), bundle_path))
+    sys.exit(0)
@@ -0,0 +1,755 @@
+# Copyright (c) 2013 Thomas Lotze
+# See also LICENSE.txt
+
+"""Process-wide caches of information derived from input files.
+"""
+
+import errno
+import fcntl
+import hashlib
+import json
+import marshal
+import mmap
+import os
+import os.path
+import struct
+import tempfile
+import threading
+import time
+
+
+# signatures of files in watched directory trees, see SignatureCache
+signature_cache = None
+
+
+def file_signature(file_path):
+    """Compute the signature by which to tell whether a file has changed.
+
+    If the file lies within a directory tree watched for changes, the
+    signature is taken from the signature cache.
+
+    file_path: str, file system path
+
+    returns (float, int, int): the file's mtime, size and inode number
+
+    raises OSError if the file cannot be stat'ed
+    """
+    if signature_cache is not None:
+        return signature_cache.get(file_path)
+    return stat_signature(file_path)
+
+
+def stat_signature(file_path):
+    """Compute a file's signature by looking at the file system.
+
+    returns (float, int, int): the file's mtime, size and inode number
+
+    raises OSError if the file cannot be stat'ed
+    """
+    st = os.stat(file_path)
+    return (st.st_mtime, st.st_size, st.st_ino)
+
+
+class SignatureCache(object):
+    """Thread-safe cache of file signatures that are kept until a watcher
+    reports a change.
+
+    Instantiate as SignatureCache(max_size=10000).
+
+    max_size: int, maximum number of signatures kept
+
+    Only files within the directory trees registered as roots are cached;
+    signatures of other files are always computed from the file system.
+    Missing files are remembered as well, which is why the number of
+    entries is bounded, dropping least recently used ones first.
+    """
+
+    hits = 0
+    misses = 0
+
+    def __init__(self, max_size=10000):
+        self.lock = threading.Lock()
+        self.roots = []
+        self.signatures = LRUCache(max_size)
+        self.generation = 0
+
+    def add_roots(self, roots):
+        """Start caching signatures of files within some directory trees.
+
+        Roots should only be added once changes to them are being reported.
+
+        roots: iterable of str, file system paths of directories
+        """
+        with self.lock:
+            self.roots.extend(os.path.abspath(root) for root in roots)
+
+    def remove_roots(self, roots):
+        """Stop caching signatures of files within some directory trees.
+
+        Roots that have been added several times stay in effect until they
+        have been removed as often.
+
+        roots: iterable of str, file system paths of directories
+        """
+        with self.lock:
+            for root in roots:
+                root = os.path.abspath(root)
+                self.roots.remove(root)
+                if root not in self.roots:
+                    self._discard(root)
+
+    def get(self, file_path):
+        """Look up the signature of a file, computing it if needed.
+
+        returns (float, int, int): the file's mtime, size and inode number
+
+        raises OSError if the file doesn't exist
+        """
+        file_path = os.path.normpath(file_path)
+        signature = self.signatures.get(file_path, _missing)
+        if signature is _missing:
+            if not self.watched(file_path):
+                return stat_signature(file_path)
+            generation = self.generation
+            try:
+                signature = stat_signature(file_path)
+            except OSError, e:
+                if e.errno not in (errno.ENOENT, errno.ENOTDIR):
+                    raise
+                signature = None
+            with self.lock:
+                self.misses += 1
+                # a change reported meanwhile may have made the result stale
+                if generation == self.generation:
+                    self.signatures.set(file_path, signature)
+        else:
+            with self.lock:
+                self.hits += 1
+        if signature is None:
+            raise OSError(errno.ENOENT, os.strerror(errno.ENOENT), file_path)
+        return signature
+
+    def watched(self, file_path):
+        for root in self.roots:
+            if file_path == root or file_path.startswith(root + os.sep):
+                return True
+        return False
+
+    def invalidate(self, path):
+        """Forget the signatures of a file or directory that has changed.
+
+        Signatures of anything within a directory are forgotten along with
+        the directory's own, as is the signature of the containing directory
+        whose modification time changes when entries are added or removed.
+
+        path: str, file system path of the changed file or directory
+        """
+        path = os.path.normpath(path)
+        with self.lock:
+            self.generation += 1
+            self.signatures.pop(os.path.dirname(path))
+            self._discard(path)
+
+    def clear(self):
+        with self.lock:
+            self.generation += 1
+            self.signatures.clear()
+
+    def stats(self):
+        """Report the cache's usage.
+
+        returns dict: hit and miss counts and number of entries
+        """
+        return dict(hits=self.hits, misses=self.misses,
+                    entries=len(self.signatures))
+
+    def _discard(self, path):
+        # must be called with the lock held
+        self.signatures.pop(path)
+        prefix = path.rstrip(os.sep) + os.sep
+        for file_path in self.signatures.entries.keys():
+            if file_path.startswith(prefix):
+                self.signatures.pop(file_path)
+
+
+_missing = object()
+
+
+def dependencies_changed(dependencies, get_signature=None):
+    """Tell whether any input file has changed since a page was rendered.
+
+    dependencies: mapping of file paths to signatures as recorded by the
+                  request that rendered the page, None for absent files
+    get_signature: callable computing a file's current signature, raising
+                   OSError for absent files, defaults to file_signature
+
+    returns bool
+    """
+    if get_signature is None:
+        get_signature = file_signature
+    for file_path, signature in dependencies.iteritems():
+        try:
+            current = list(get_signature(file_path))
+        except OSError:
+            current = None
+        if signature is not None:
+            signature = list(signature)
+        if current != signature:
+            return True
+    return False
+
+
+def write_atomically(file_path, content):
+    """Write a file such that readers never see it incomplete.
+    """
+    dir_path = os.path.dirname(file_path)
+    if not os.path.isdir(dir_path):
+        os.makedirs(dir_path)
+    fd, tmp_path = tempfile.mkstemp(dir=dir_path, prefix='.ophelia-')
+    try:
+        with os.fdopen(fd, 'wb') as tmp_file:
+            tmp_file.write(content)
+    except:
+        os.remove(tmp_path)
+        raise
+    os.chmod(tmp_path, 0644)
+    os.rename(tmp_path, file_path)
+
+
+class LRUCache(object):
+    """Thread-safe mapping of bounded size that drops least recently used
+    entries first.
+
+    Instantiate as LRUCache(max_size).
+
+    max_size: int, upper bound of the summed sizes of all entries
+
+    Each entry has a size that defaults to 1, making max_size the maximum
+    number of entries unless sizes are given explicitly when storing values.
+    """
+
+    hits = 0
+    misses = 0
+
+    def __init__(self, max_size=1000):
+        self.max_size = max_size
+        self.lock = threading.Lock()
+        self.clear()
+
+    def clear(self):
+        """Remove all entries, leaving the hit and miss counters alone.
+        """
+        with self.lock:
+            self.entries = {}
+            # circular doubly linked list of [prev, next, key, value, size],
+            # the root's successor being the least recently used entry
+            self.root = root = []
+            root[:] = [root, root, None, None, 0]
+            self.size = 0
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __contains__(self, key):
+        return key in self.entries
+
+    def get(self, key, default=None):
+        """Look up a value, marking it as recently used.
+
+        Counts a hit if the key is present and a miss otherwise.
+        """
+        with self.lock:
+            link = self._touch(key)
+            if link is None:
+                self.misses += 1
+                return default
+            self.hits += 1
+            return link[3]
+
+    def set(self, key, value, size=1):
+        """Store a value, dropping least recently used entries if needed.
+
+        Values larger than the cache as a whole are not stored at all.
+        """
+        if size > self.max_size:
+            self.pop(key)
+            return
+        with self.lock:
+            link = self.entries.pop(key, None)
+            if link is not None:
+                self._unlink(link)
+                self.size -= link[4]
+            while self.size + size > self.max_size:
+                oldest = self.root[1]
+                self._unlink(oldest)
+                del self.entries[oldest[2]]
+                self.size -= oldest[4]
+            link = [None, None, key, value, size]
+            self._append(link)
+            self.entries[key] = link
+            self.size += size
+
+    def pop(self, key, default=None):
+        """Remove an entry if present, returning its value.
+        """
+        with self.lock:
+            link = self.entries.pop(key, None)
+            if link is None:
+                return default
+            self._unlink(link)
+            self.size -= link[4]
+            return link[3]
+
+    def stats(self):
+        """Report the cache's usage.
+
+        returns dict: hit and miss counts, number of entries and summed size
+        """
+        return dict(hits=self.hits, misses=self.misses,
+                    entries=len(self.entries), size=self.size)
+
+    def _touch(self, key):
+        # must be called with the lock held
+        link = self.entries.get(key)
+        if link is not None:
+            self._unlink(link)
+            self._append(link)
+        return link
+
+    def _unlink(self, link):
+        prev, next = link[0], link[1]
+        prev[1] = next
+        next[0] = prev
+
+    def _append(self, link):
+        root = self.root
+        last = root[0]
+        link[0], link[1] = last, root
+        last[1] = root[0] = link
+
+
+class FileCache(LRUCache):
+    """LRU cache of values derived from files, validated by file signature.
+
+    Keys are file paths, possibly combined with further information the
+    cached value depends upon, and will be looked up along with the file's
+    current signature. An entry stored for a different signature is
+    considered stale and doesn't count as a hit.
+    """
+
+    def lookup(self, key, signature):
+        """Look up the value stored for a key and file signature.
+
+        returns the value, or None if no entry is valid for the signature
+        """
+        with self.lock:
+            link = self._touch(key)
+            if link is None or link[3][0] != signature:
+                self.misses += 1
+                return None
+            self.hits += 1
+            return link[3][1]
+
+    def store(self, key, signature, value, size=1):
+        """Store a value computed from the file that has a given signature.
+        """
+        self.set(key, (signature, value), size)
+
+
+class NegativeCache(LRUCache):
+    """LRU cache of lookups that didn't find anything, such as requests for
+    pages that don't exist.
+
+    Instantiate as NegativeCache(max_size, ttl=10).
+
+    ttl: number of seconds for which an entry is trusted without checking
+         whether any of the files involved have changed
+
+    Entries record the signatures of the files involved in the lookup,
+    including those that were found missing. An entry becomes invalid as
+    soon as any of these files changes, is added or removed.
+    """
+
+    def __init__(self, max_size=1000, ttl=10):
+        super(NegativeCache, self).__init__(max_size)
+        self.ttl = ttl
+
+    def lookup(self, key):
+        """Tell whether a lookup is known to find nothing.
+
+        returns bool
+        """
+        now = time.time()
+        with self.lock:
+            link = self._touch(key)
+            if link is not None:
+                checked, dependencies = link[3]
+                if checked + self.ttl > now:
+                    self.hits += 1
+                    return True
+        if link is None or dependencies_changed(dependencies):
+            self.pop(key)
+            with self.lock:
+                self.misses += 1
+            return False
+        with self.lock:
+            link[3] = (now, dependencies)
+            self.hits += 1
+        return True
+
+    def store(self, key, dependencies):
+        """Record that a lookup didn't find anything.
+
+        dependencies: mapping of file paths to signatures, None for absent
+                      files
+        """
+        self.set(key, (time.time(), dependencies))
+
+
+class ResponseCache(LRUCache):
+    """LRU cache of complete HTTP responses that expire after some time.
+
+    Instantiate as ResponseCache(max_size) where max_size is the number of
+    bytes that the bodies and headers of all stored responses may take up.
+    """
+
+    def lookup(self, key):
+        """Look up a response that hasn't expired yet.
+
+        returns (status, headers, body chunks) or None
+        """
+        with self.lock:
+            link = self._touch(key)
+            if link is None or link[3][0] < time.time():
+                self.misses += 1
+                return None
+            self.hits += 1
+            return link[3][1]
+
+    def store(self, key, response, ttl):
+        """Store a response for a number of seconds.
+
+        response: (str, list of (str, str), list of str), status, headers and
+                  chunks of the body
+        ttl: number of seconds after which the response expires
+        """
+        status, headers, body = response
+        size = (sum(len(chunk) for chunk in body) +
+                sum(len(name) + len(value) for name, value in headers))
+        self.set(key, (time.time() + ttl, response), size)
+
+
+class SharedResponseCache(object):
+    """Cache of complete HTTP responses in a memory-mapped file that may be
+    shared by any number of processes.
+
+    Instantiate as SharedResponseCache(file_path, max_size, slot_size=65536).
+
+    file_path: str, path of the cache file, created if it doesn't exist
+    max_size: int, number of bytes to reserve for response data
+    slot_size: int, number of bytes reserved for each response, larger
+               responses are not stored
+
+    The file holds a fixed number of slots that are grouped in sets of up to
+    eight. A key is hashed to determine its set, and storing a response
+    replaces an expired entry of that set or else the least recently used
+    one. Each set is guarded by an fcntl lock on its part of the index, so
+    processes only contend for the same set. All processes must use the same
+    size parameters; a file created with different ones is reinitialized.
+
+    Provides the same lookup and store methods as ResponseCache. Hit and miss
+    counts are those of the current process.
+    """
+
+    hits = 0
+    misses = 0
+
+    magic = "OPHRC001"
+    header = struct.Struct("=8sIII")
+    header_size = 4096
+    # expiry time, last use time, data length, digest of the key
+    entry = struct.Struct("=ddI16s4x")
+    ways = 8
+
+    def __init__(self, file_path, max_size, slot_size=65536):
+        self.file_path = file_path
+        self.slot_size = slot_size
+        slots = max(max_size // slot_size, 1)
+        self.ways = min(self.ways, slots)
+        self.sets = slots // self.ways
+        self.data_offset = self.header_size + (
+            self.sets * self.ways * self.entry.size)
+        self.file_size = self.data_offset + self.sets * self.ways * slot_size
+        # fcntl locks don't exclude threads of the same process
+        self.lock = threading.Lock()
+
+        self.fd = os.open(file_path, os.O_RDWR | os.O_CREAT, 0600)
+        fcntl.lockf(self.fd, fcntl.LOCK_EX, self.header_size, 0)
+        try:
+            expected = self.header.pack(
+                self.magic, self.sets, self.ways, slot_size)
+            if os.fstat(self.fd).st_size != self.file_size:
+                os.ftruncate(self.fd, 0)
+                os.ftruncate(self.fd, self.file_size)
+            self.map = mmap.mmap(self.fd, self.file_size)
+            if self.map[:self.header.size] != expected:
+                self.map[self.header_size:self.data_offset] = (
+                    "\0" * (self.data_offset - self.header_size))
+                self.map[:self.header.size] = expected
+        finally:
+            fcntl.lockf(self.fd, fcntl.LOCK_UN, self.header_size, 0)
+
+    def __len__(self):
+        now = time.time()
+        return sum(1 for i in xrange(self.sets * self.ways)
+                   if self._entry(i)[0] > now)
+
+    def close(self):
+        self.map.close()
+        os.close(self.fd)
+
+    def clear(self):
+        """Remove all entries, leaving the hit and miss counters alone.
+        """
+        with self.lock:
+            for set_index in xrange(self.sets):
+                self._lock(set_index, fcntl.LOCK_EX)
+                try:
+                    for i in self._slots(set_index):
+                        self.entry.pack_into(
+                            self.map, self._entry_offset(i), 0, 0, 0, "")
+                finally:
+                    self._lock(set_index, fcntl.LOCK_UN)
+
+    def lookup(self, key):
+        """Look up a response that hasn't expired yet.
+
+        returns (status, headers, body chunks) or None
+        """
+        digest, set_index = self._hash(key)
+        now = time.time()
+        with self.lock:
+            self._lock(set_index, fcntl.LOCK_EX)
+            try:
+                for i in self._slots(set_index):
+                    expires, used, length, entry_digest = self._entry(i)
+                    if entry_digest == digest and expires > now:
+                        offset = self.data_offset + i * self.slot_size
+                        stored_key, status, headers, body = marshal.loads(
+                            self.map[offset:offset + length])
+                        if stored_key != key:
+                            break
+                        self.entry.pack_into(
+                            self.map, self._entry_offset(i),
+                            expires, now, length, digest)
+                        self.hits += 1
+                        return status, headers, [body]
+            finally:
+                self._lock(set_index, fcntl.LOCK_UN)
+            self.misses += 1
+            return None
+
+    def store(self, key, response, ttl):
+        """Store a response for a number of seconds.
+
+        response: (str, list of (str, str), list of str), status, headers and
+                  chunks of the body
+        ttl: number of seconds after which the response expires
+        """
+        status, headers, body = response
+        data = marshal.dumps((key, status, headers, "".join(body)))
+        if len(data) > self.slot_size:
+            return
+        digest, set_index = self._hash(key)
+        now = time.time()
+        with self.lock:
+            self._lock(set_index, fcntl.LOCK_EX)
+            try:
+                victim = None
+                for i in self._slots(set_index):
+                    expires, used, length, entry_digest = self._entry(i)
+                    if entry_digest == digest:
+                        victim = i
+                        break
+                    if expires <= now:
+                        used = -1
+                    if victim is None or used < victim_used:
+                        victim, victim_used = i, used
+                offset = self.data_offset + victim * self.slot_size
+                self.map[offset:offset + len(data)] = data
+                self.entry.pack_into(
+                    self.map, self._entry_offset(victim),
+                    now + ttl, now, len(data), digest)
+            finally:
+                self._lock(set_index, fcntl.LOCK_UN)
+
+    def stats(self):
+        """Report the cache's usage.
+
+        returns dict: hit and miss counts of this process, number of entries
+                and summed size of the responses stored
+        """
+        now = time.time()
+        entries = size = 0
+        for i in xrange(self.sets * self.ways):
+            expires, used, length, digest = self._entry(i)
+            if expires > now:
+                entries += 1
+                size += length
+        return dict(hits=self.hits, misses=self.misses,
+                    entries=entries, size=size)
+
+    def _hash(self, key):
+        digest = hashlib.md5(marshal.dumps(key)).digest()
+        set_index = struct.unpack_from("=Q", digest)[0] % self.sets
+        return digest, set_index
+
+    def _slots(self, set_index):
+        return xrange(set_index * self.ways, (set_index + 1) * self.ways)
+
+    def _entry_offset(self, i):
+        return self.header_size + i * self.entry.size
+
+    def _entry(self, i):
+        return self.entry.unpack_from(self.map, self._entry_offset(i))
+
+    def _lock(self, set_index, operation):
+        # lock the set's part of the index, covering its data slots as well
+        length = self.ways * self.entry.size
+        fcntl.lockf(self.fd, operation, length,
+                    self.header_size + set_index * length)
+
+
+class RenderCache(object):
+    """Cache of rendered pages in a directory that persists across restarts.
+
+    Instantiate as RenderCache(directory).
+
+    directory: str, file system path of the cache directory, created if it
+               doesn't exist
+
+    Each page is stored as a body file that a front-end server may send
+    itself, along with a file of metadata: the status and headers of the
+    response, the name of the body file, the signatures of the input files
+    it was rendered from and an optional expiry time. An entry is valid as
+    long as none of the input files has changed and it hasn't expired.
+
+    Body files are named after their content and never rewritten, and the
+    metadata is written last, so readers never pair a page's metadata with
+    another version of its body. The body replaced by storing a page is
+    removed when the page is stored the next time.
+    """
+
+    hits = 0
+    misses = 0
+
+    def __init__(self, directory):
+        # the X-Sendfile application refuses paths involving symbolic links
+        self.directory = os.path.realpath(directory)
+        if not os.path.isdir(self.directory):
+            os.makedirs(self.directory)
+
+    def metadata_path(self, key):
+        """Compute the path of the file holding a page's metadata.
+
+        Body files are named by appending a digest of their content to the
+        metadata file's name without its extension.
+
+        returns str, path relative to the cache directory
+        """
+        digest = hashlib.md5(repr(key)).hexdigest()
+        return os.path.join(digest[:2], digest + '.json')
+
+    def lookup(self, key, get_signature=None):
+        """Look up a page that is still valid.
+
+        get_signature: callable computing the current signatures of the
+                       input files, see dependencies_changed
+
+        returns (str, list of (str, str), str) or None: status, headers
+                and the path of the body file relative to the cache directory
+        """
+        try:
+            with open(os.path.join(self.directory, self.metadata_path(key))
+                      ) as metadata_file:
+                metadata = json.load(metadata_file)
+        except (IOError, ValueError):
+            metadata = None
+        if (metadata is None or
+            metadata['key'] != repr(key) or
+            'body' not in metadata or
+            metadata['expires'] is not None and
+            metadata['expires'] < time.time() or
+            dependencies_changed(metadata['dependencies'], get_signature)):
+            self.misses += 1
+            return None
+        self.hits += 1
+        # JSON turned the str values into unicode by decoding them as UTF-8
+        headers = [(name.encode('utf-8'), value.encode('utf-8'))
+                   for name, value in metadata['headers']]
+        body_path = os.path.join(os.path.dirname(self.metadata_path(key)),
+                                 metadata['body'].encode('utf-8'))
+        return metadata['status'].encode('utf-8'), headers, body_path
+
+    def store(self, key, response, dependencies, ttl=None, compress=None):
+        """Store a page.
+
+        response: (str, list of (str, str), list of str), status, headers and
+                  chunks of the body
+        dependencies: mapping of file paths to signatures as recorded by the
+                      request that rendered the page, None for absent files
+        ttl: number of seconds after which the page expires, None to keep it
+             until its input files change
+        compress: optional callable that takes the body chunks and returns a
+                  gzip-compressed variant of the body to store alongside it
+
+        returns nothing
+        """
+        status, headers, body = response
+        metadata_path = os.path.join(self.directory, self.metadata_path(key))
+        dir_path, metadata_name = os.path.split(metadata_path)
+        prefix = metadata_name[:-len('.json')] + '.'
+        try:
+            with open(metadata_path) as metadata_file:
+                previous = json.load(metadata_file).get('body')
+        except (IOError, ValueError):
+            previous = None
+
+        content = ''.join(body)
+        body_name = prefix + hashlib.md5(content).hexdigest()
+        body_path = os.path.join(dir_path, body_name)
+        write_atomically(body_path, content)
+        if compress is not None:
+            write_atomically(body_path + '.gz', compress(body))
+        elif os.path.exists(body_path + '.gz'):
+            os.remove(body_path + '.gz')
+        write_atomically(metadata_path, json.dumps(dict(
+                    key=repr(key),
+                    status=status,
+                    headers=headers,
+                    body=body_name,
+                    dependencies=dependencies,
+                    expires=None if ttl is None else time.time() + ttl,
+                    )))
+
+        # readers may still be sending the body just replaced
+        keep = (metadata_name, body_name, previous)
+        for name in os.listdir(dir_path):
+            if not name.startswith(prefix):
+                continue
+            if name.endswith('.gz'):
+                base = name[:-len('.gz')]
+            else:
+                base = name
+            if base not in keep:
+                try:
+                    os.remove(os.path.join(dir_path, name))
+                except OSError:
+                    pass
+
+    def stats(self):
+        """Report the cache's usage.
+
+        returns dict: hit and miss counts of this process
+        """
+        return dict(hits=self.hits, misses=self.misses)
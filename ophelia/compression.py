@@ -0,0 +1,69 @@
+# Copyright (c) 2013 Thomas Lotze
+# See also LICENSE.txt
+
+"""Content negotiation for gzip-compressed responses.
+"""
+
+import zlib
+
+
+COMPRESSIBLE_TYPES = ('text/', 'application/xml', 'application/xhtml+xml',
+                      'application/javascript', 'application/json',
+                      'image/svg+xml')
+
+
+def accepts_gzip(env):
+    """Tell whether the client accepts gzip-encoded responses.
+
+    env: the WSGI environment
+
+    returns bool
+    """
+    accepted = False
+    for coding in env.get('HTTP_ACCEPT_ENCODING', '').split(','):
+        params = coding.split(';')
+        name = params[0].strip().lower()
+        if name not in ('gzip', 'x-gzip', '*'):
+            continue
+        quality = 1.0
+        for param in params[1:]:
+            key, sep, value = param.partition('=')
+            if key.strip().lower() == 'q':
+                try:
+                    quality = float(value)
+                except ValueError:
+                    quality = 0.0
+        if name == '*':
+            # an explicit preference for gzip overrides the wild card
+            accepted = accepted or quality > 0
+        elif quality > 0:
+            return True
+        else:
+            return False
+    return accepted
+
+
+def compressible(content_type):
+    """Tell whether content of some type benefits from being compressed.
+
+    content_type: str, value of a Content-Type header
+
+    returns bool
+    """
+    content_type = content_type.lower()
+    return any(content_type.startswith(prefix)
+               for prefix in COMPRESSIBLE_TYPES)
+
+
+def compress(chunks, level=6):
+    """Compress data into the gzip format.
+
+    chunks: iterable of str
+    level: int, compression level from 1 (fastest) to 9 (smallest)
+
+    returns str
+    """
+    compressor = zlib.compressobj(level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    data = [compressor.compress(chunk) for chunk in chunks]
+    data.append(compressor.flush())
+    return ''.join(data)
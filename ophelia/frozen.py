@@ -0,0 +1,195 @@
+# Copyright (c) 2013 Thomas Lotze
+# See also LICENSE.txt
+
+"""Serving a template tree from memory as it was when it was loaded.
+"""
+
+import copy
+import errno
+import ophelia.input
+import ophelia.pagetemplate
+import ophelia.request
+import ophelia.timing
+import ophelia.util
+import ophelia.watch
+import os
+import os.path
+import stat
+import sys
+import types
+
+
+class FrozenFile(object):
+    """An input file's content and everything derived from it.
+
+    Derived information is keyed by what it depends upon besides the
+    content: split parts by input encodings, code objects by script and line
+    offset, and cooked templates by text and offset.
+    """
+
+    __slots__ = ('signature', 'content', 'parts', 'codes', 'templates')
+
+    def __init__(self, signature, content):
+        self.signature = signature
+        self.content = content
+        self.parts = {}
+        self.codes = {}
+        self.templates = {}
+
+
+class FrozenTree(object):
+    """In-memory copy of a template tree that requests traverse instead of
+    the file system.
+
+    Instantiate as FrozenTree(template_root, options=None).
+
+    template_root: str, file system path to the template root
+    options: dict of configuration settings, the input encodings being used
+             to split, compile and cook all files when loading the tree
+
+    Changes to the files on disk don't take effect until a new tree is
+    loaded. Files that can't be decoded with the configured encodings are
+    split again when a request asks for other encodings; files that fail to
+    compile are listed in the errors attribute and fail again when
+    requested. The size attribute estimates the memory taken up by the tree
+    in bytes.
+    """
+
+    def __init__(self, template_root, options=None):
+        options = options or {}
+        self.template_root = os.path.abspath(template_root)
+        self.directories = {}
+        self.files = {}
+        self.errors = []
+        splitter = ophelia.input.Splitter(**options)
+        for path, st in ophelia.watch.walk(self.template_root):
+            if stat.S_ISDIR(st.st_mode):
+                kind = ophelia.request.DIRECTORY
+                self.directories[path] = {}
+            elif stat.S_ISREG(st.st_mode):
+                kind = ophelia.request.FILE
+                self.load_file(path, st, splitter)
+            else:
+                continue
+            if path != self.template_root:
+                dir_path, name = os.path.split(path)
+                self.directories[dir_path][name] = kind
+        self.file_count = len(self.files)
+        self.size = memory_usage(self)
+
+    def load_file(self, file_path, st, splitter):
+        try:
+            content = open(file_path, 'rb').read()
+        except IOError:
+            return
+        self.files[file_path] = FrozenFile(
+            (st.st_mtime, st.st_size, st.st_ino), content)
+        try:
+            try:
+                script, text, offset, script_offset = self.read(
+                    splitter, file_path)
+            except UnicodeError:
+                return
+            if script:
+                self.compile_script(script, file_path, script_offset)
+            self.get_template(text, file_path, offset)
+        except Exception:
+            self.errors.append((file_path, ophelia.util.format_exception()))
+
+    def kind(self, path):
+        """Tell what kind of entry a path points to.
+
+        returns ophelia.request.FILE, ophelia.request.DIRECTORY or None
+        """
+        path = os.path.normpath(path)
+        if path in self.directories:
+            return ophelia.request.DIRECTORY
+        if path in self.files:
+            return ophelia.request.FILE
+
+    def list_directory(self, dir_path):
+        entries = self.directories.get(dir_path)
+        if entries is None:
+            entries = self.directories.get(os.path.normpath(dir_path))
+        return entries
+
+    def file(self, file_path):
+        entry = self.files.get(file_path)
+        if entry is None:
+            entry = self.files.get(os.path.normpath(file_path))
+            if entry is None:
+                raise OSError(errno.ENOENT, os.strerror(errno.ENOENT),
+                              file_path)
+        return entry
+
+    def file_signature(self, file_path):
+        return self.file(file_path).signature
+
+    def read(self, splitter, file_path, signature=None,
+             timer=ophelia.timing.null_timer):
+        entry = self.file(file_path)
+        key = (splitter.script_encoding, splitter.template_encoding)
+        parts = entry.parts.get(key)
+        if parts is None:
+            with timer("split", file_path):
+                parts = entry.parts[key] = splitter.split(entry.content)
+        return parts
+
+    def compile_script(self, script, file_path, line_offset=0,
+                       signature=None, cache_dir=None):
+        entry = self.file(file_path)
+        key = (script, line_offset)
+        code = entry.codes.get(key)
+        if code is None:
+            code = entry.codes[key] = ophelia.input.compile_code(
+                script, file_path, line_offset)
+        return code
+
+    def get_template(self, text, file_path, offset=(0, 0), signature=None):
+        entry = self.file(file_path)
+        key = (text, offset)
+        template = entry.templates.get(key)
+        if template is None:
+            template = entry.templates[key] = \
+                ophelia.pagetemplate.PageTemplate(
+                    text, file_path=file_path, offset=offset)
+        return copy.copy(template)
+
+
+# shared objects that don't count towards the memory taken up by a tree
+SHARED_TYPES = (type, types.ClassType, types.ModuleType, types.FunctionType,
+                types.BuiltinFunctionType, types.MethodType)
+
+
+def memory_usage(obj):
+    """Estimate the memory taken up by an object and all objects it refers to.
+
+    Classes, modules and functions are not counted, nor are objects referred
+    to more than once counted more than once.
+
+    returns int, number of bytes
+    """
+    seen = set()
+    stack = [obj]
+    size = 0
+    while stack:
+        obj = stack.pop()
+        if id(obj) in seen or isinstance(obj, SHARED_TYPES):
+            continue
+        seen.add(id(obj))
+        size += sys.getsizeof(obj)
+        if isinstance(obj, dict):
+            stack.extend(obj.iterkeys())
+            stack.extend(obj.itervalues())
+        elif isinstance(obj, (list, tuple, set, frozenset)):
+            stack.extend(obj)
+        elif isinstance(obj, types.CodeType):
+            stack.extend([obj.co_code, obj.co_consts, obj.co_names,
+                          obj.co_varnames, obj.co_lnotab])
+        else:
+            stack.extend(getattr(obj, name)
+                         for name in getattr(type(obj), '__slots__', ())
+                         if hasattr(obj, name))
+            if hasattr(obj, '__dict__'):
+                stack.append(obj.__dict__)
+    return size
@@ -1,16 +1,34 @@
 # Copyright (c) 2006-2008 Thomas Lotze
 # See also LICENSE.txt
 
+import collections
+import hashlib
+import imp
+import marshal
+import os
+import os.path
 import re
+import tempfile
 
 import zope.interface
 
+import ophelia.cache
 import ophelia.interfaces
+import ophelia.timing
 
 
 XML_DECLARATION = re.compile("(<\?xml([^<>]*)\?>)")
 CODING_PATTERN = re.compile("coding[=:]\s*\"?\s*([-\w.]+)\s*\"?")
 
+# split input files and compiled scripts by file path, shared by all requests
+# of the process
+split_cache = ophelia.cache.FileCache(1000)
+code_cache = ophelia.cache.FileCache(1000)
+
+
+InputParts = collections.namedtuple(
+    "InputParts", "script template offset script_offset")
+
 
 class Splitter(object):
     """Splitter decomposing a file into Python script and template.
@@ -34,6 +52,18 @@ class Splitter(object):
 
         returns (unicode, unicode): Python script and template
 
+        may raise ValueError if <?xml ... ?> is not closed
+        """
+        return self.split(content)[:2]
+
+    def split(self, content):
+        """Split file content into Python script and template, with offsets.
+
+        content: str
+
+        returns InputParts: Python script and template (unicode), the
+                template's line and row offset, the script's line offset
+
         may raise ValueError if <?xml ... ?> is not closed
         """
         parts = XML_DECLARATION.split(content, 1)
@@ -46,10 +76,6 @@ class Splitter(object):
             line_offset = len(pre_lines) - 1
             row_offset = len(pre_lines[-1])
 
-        # XXX This is a bad hack in order to keep the splitter API backwards
-        # compatible during the 0.3 series:
-        self._last_template_offset = (line_offset, row_offset)
-
         template_encoding = self.template_encoding
         coding_match = CODING_PATTERN.search(xml_options)
         if coding_match:
@@ -58,15 +84,123 @@ class Splitter(object):
         template = template.decode(template_encoding)
 
         script_encoding = self.script_encoding
-        script = script.strip()
+        stripped = script.lstrip()
+        script_offset = script[:len(script) - len(stripped)].count("\n")
+        script = stripped.rstrip()
         if script.startswith("#"):
             lines = script.splitlines(True)
             coding_match = CODING_PATTERN.search(lines[0])
             if coding_match:
                 script_encoding = coding_match.group(1)
                 del lines[0]
+                script_offset += 1
             script = "".join(lines)
 
         script = script.decode(script_encoding)
 
-        return script, template
+        return InputParts(
+            script, template, (line_offset, row_offset), script_offset)
+
+    def read(self, file_path, signature=None,
+             timer=ophelia.timing.null_timer):
+        """Read and split an input file.
+
+        Results are kept in the process-wide split cache and reused as long as
+        neither the file's signature nor the splitter's encodings changed.
+
+        file_path: str, path of the input file
+        signature: file signature as computed by ophelia.cache.file_signature,
+                   computed from file_path if not given
+        timer: ophelia.timing.Timer to measure reading and splitting with
+
+        returns InputParts as returned by split()
+        """
+        if signature is None:
+            signature = ophelia.cache.file_signature(file_path)
+        key = (file_path, self.script_encoding, self.template_encoding)
+        parts = split_cache.lookup(key, signature)
+        if parts is None:
+            with timer("read", file_path):
+                content = open(file_path).read()
+            with timer("split", file_path):
+                parts = self.split(content)
+            split_cache.store(key, signature, parts)
+        return parts
+
+
+def compile_script(script, file_path, line_offset=0, signature=None,
+                   cache_dir=None):
+    """Compile the script read from an input file to a code object.
+
+    Code objects are kept in the process-wide code cache and reused as long as
+    neither the file's signature nor the script changed. If a cache directory
+    is given, compiled code is also stored there (similar to Python's
+    __pycache__ directories) so other processes can load it without compiling
+    the script again.
+
+    script: unicode, Python script as returned by the splitter
+    file_path: str, path of the input file the script was read from
+    line_offset: int, number of lines preceding the script in the file
+    signature: file signature as computed by ophelia.cache.file_signature,
+               computed from file_path if not given
+    cache_dir: str, optional path of a directory to store code in
+
+    returns code object whose line numbers refer to the input file
+
+    raises SyntaxError if the script can't be compiled
+    """
+    if signature is None:
+        signature = ophelia.cache.file_signature(file_path)
+    entry = code_cache.lookup(file_path, signature)
+    if entry is not None and entry[:2] == (script, line_offset):
+        return entry[2]
+
+    code = None
+    if cache_dir:
+        digest = hashlib.md5(script.encode("utf-8")).hexdigest()
+        cache_path = os.path.join(
+            cache_dir, hashlib.md5(file_path).hexdigest() + ".ophc")
+        code = _load_code(cache_path, file_path, line_offset, digest)
+    if code is None:
+        code = compile_code(script, file_path, line_offset)
+        if cache_dir:
+            _dump_code(cache_path, code, file_path, line_offset, digest)
+
+    code_cache.store(file_path, signature, (script, line_offset, code))
+    return code
+
+
+def compile_code(script, file_path, line_offset=0):
+    """Compile the script read from an input file without any caching.
+
+    returns code object whose line numbers refer to the input file
+    """
+    # padding the source makes line numbers refer to the input file
+    return compile("\n" * line_offset + script, file_path, "exec")
+
+
+def _load_code(cache_path, file_path, line_offset, digest):
+    try:
+        data = open(cache_path, "rb").read()
+        header, code = marshal.loads(data)
+    except (IOError, EOFError, ValueError, TypeError):
+        return None
+    if header != (imp.get_magic(), file_path, line_offset, digest):
+        return None
+    return code
+
+
+def _dump_code(cache_path, code, file_path, line_offset, digest):
+    header = (imp.get_magic(), file_path, line_offset, digest)
+    try:
+        if not os.path.isdir(os.path.dirname(cache_path)):
+            os.makedirs(os.path.dirname(cache_path))
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(cache_path))
+        try:
+            os.write(fd, marshal.dumps((header, code)))
+        finally:
+            os.close(fd)
+        os.rename(tmp_path, cache_path)
+    except (IOError, OSError):
+        # like Python's own byte-code cache, this is an optimization only
+        pass
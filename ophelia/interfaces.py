@@ -74,6 +74,14 @@ class IRequestAPI(zope.interface.Interface):
         to a file named like the index_name.
         """)
 
+    cache_ttl = zope.interface.Attribute(
+        """Number of seconds for which the application may cache the response.
+
+        None, the default, lets the application's configuration decide; 0
+        marks the response as uncacheable. Only applies if the application
+        has been configured to cache responses at all.
+        """)
+
     # Components.
 
     splitter = zope.interface.Attribute(
@@ -120,6 +128,12 @@ class IRequestAPI(zope.interface.Interface):
 
         None during traversal and template rendering. After that, consists of
         an XML declaration and the encoded current innerslot value.
+
+        If the incremental_encoding option is set, the outermost template is
+        rendered right into an incremental encoder, the content is a list of
+        str chunks rather than a str, and the innerslot is reset to None.
+        Header expressions computing the length of the body need to sum up
+        the lengths of the chunks.
         """)
 
     # Traversal and rendering state meant for use by those who know what
@@ -155,6 +169,24 @@ class IRequestAPI(zope.interface.Interface):
         is at the bottom of the stack (i.e. at index 0).
         """)
 
+    dependencies = zope.interface.Attribute(
+        """Input files the response depends upon.
+
+        Mapping of absolute file system paths of all input files processed so
+        far to their signatures as computed by ophelia.cache.file_signature.
+        Paths of directory __init__ files that didn't exist when traversing
+        the directory are mapped to None.
+        """)
+
+    timer = zope.interface.Attribute(
+        """Measures the time spent in the phases of processing the request.
+
+        An ophelia.timing.Timer if the timing option is set or timing hooks
+        have been passed through the environment as ``ophelia.timing_hooks``,
+        otherwise a timer which doesn't measure anything. Phases are "read",
+        "split", "cook", "compile", "script", "render", and "headers".
+        """)
+
     # Methods for processing further files.
 
     def load_macros(name):
@@ -211,6 +243,25 @@ class ISplitterAPI(zope.interface.Interface):
         String, defaults to "ascii".
         """)
 
+    def split(content):
+        """Split file content into Python script and template, with offsets.
+
+        content: str
+
+        Returns a tuple of the Python script and template (unicode), the
+        template's line and row offset within the content, and the number of
+        lines stripped off the start of the script.
+        """
+
+    def read(file_path):
+        """Read an input file and split its content.
+
+        file_path: str, absolute file system path to the file.
+
+        Returns the same as split() but may reuse earlier results for as long
+        as the file and the splitter's encodings remain unchanged.
+        """
+
 
 # APIs used internally.
 
@@ -226,6 +277,22 @@ class IRequestTraversal(zope.interface.Interface):
         that processing step.
         """)
 
+    incremental_encoding = zope.interface.Attribute(
+        """Whether to render the outermost template into an incremental
+        encoder.
+
+        Bool, defaults to False. If True, the content is built as a list of
+        encoded chunks of text instead of a single string. The content is
+        still complete before the response is returned.
+        """)
+
+    script_cache_dir = zope.interface.Attribute(
+        """File system path of a directory to store compiled scripts in.
+
+        String or None, defaults to None which means compiled scripts are
+        cached in memory only.
+        """)
+
     def __call__(**context):
         """Process the request, return response headers and body.
 
@@ -325,3 +392,34 @@ class IRequestTraversal(zope.interface.Interface):
 
         Returns nothing.
         """
+
+
+class IWatcher(zope.interface.Interface):
+    """Reports changes to files within directory trees.
+    """
+
+    roots = zope.interface.Attribute(
+        """Absolute file system paths of the directories being watched.
+
+        List of str.
+        """)
+
+    listeners = zope.interface.Attribute(
+        """Callables to notify of changes.
+
+        List of callables that take the file system path of the file or
+        directory that was modified, added, removed or renamed. They are
+        called from the watcher's own thread.
+        """)
+
+    def start():
+        """Start watching, reporting changes from then on.
+
+        Returns nothing.
+        """
+
+    def stop():
+        """Stop watching and wait for the watcher's thread to finish.
+
+        Returns nothing.
+        """
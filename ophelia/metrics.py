@@ -0,0 +1,153 @@
+# Copyright (c) 2013 Thomas Lotze
+# See also LICENSE.txt
+
+"""Counters and latency histograms exposed in the Prometheus text format.
+"""
+
+import bisect
+import threading
+
+
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+
+class Metrics(object):
+    """Thread-safe collection of request metrics.
+
+    Instantiate as Metrics(buckets=BUCKETS, max_segments=100).
+
+    buckets: sorted sequence of upper bounds of latency histogram buckets
+             in seconds
+    max_segments: int, number of distinct top-level path segments to keep
+                  separate histograms for, latencies of requests for any
+                  further segments are counted under the "other" label
+
+    Latencies are grouped by top-level path segment, which is an unbounded
+    set as far as requests for non-existent resources are concerned, hence
+    the limit on the number of histograms.
+    """
+
+    def __init__(self, buckets=BUCKETS, max_segments=100):
+        self.buckets = tuple(buckets)
+        self.max_segments = max_segments
+        self.lock = threading.Lock()
+        self.requests = {}
+        self.histograms = {}
+        self.sendfile = 0
+        self.errors = 0
+
+    def observe(self, path, status, duration):
+        """Count a request that has been answered.
+
+        path: str, the requested path
+        status: str, the HTTP status line or code
+        duration: float, number of seconds it took to answer the request
+        """
+        segment = "/" + path.lstrip("/").split("/", 1)[0]
+        code = status[:3]
+        index = bisect.bisect_left(self.buckets, duration)
+        with self.lock:
+            self.requests[code] = self.requests.get(code, 0) + 1
+            histogram = self.histograms.get(segment)
+            if histogram is None:
+                if len(self.histograms) >= self.max_segments:
+                    segment = "other"
+                    histogram = self.histograms.get(segment)
+                if histogram is None:
+                    # counts per bucket and for +Inf, then the sum
+                    histogram = self.histograms[segment] = (
+                        [0] * (len(self.buckets) + 1) + [0.0])
+            histogram[index] += 1
+            histogram[-1] += duration
+
+    def count_sendfile(self):
+        """Count a request that has been passed on to the static file server.
+        """
+        with self.lock:
+            self.sendfile += 1
+
+    def count_error(self):
+        """Count a request whose processing raised an unexpected exception.
+        """
+        with self.lock:
+            self.errors += 1
+
+    def render(self, caches=(), gauges=()):
+        """Format all metrics in the Prometheus text exposition format.
+
+        caches: iterable of (str, ophelia.cache.LRUCache), caches to report
+                hits and misses of by name
+        gauges: iterable of (str, str, number), names, help texts and current
+                values of further metrics to report
+
+        returns str
+        """
+        with self.lock:
+            requests = sorted(self.requests.items())
+            histograms = sorted((segment, list(histogram))
+                                for segment, histogram
+                                in self.histograms.items())
+            sendfile, errors = self.sendfile, self.errors
+
+        lines = []
+
+        def header(name, type_, help):
+            lines.append("# HELP %s %s" % (name, help))
+            lines.append("# TYPE %s %s" % (name, type_))
+
+        header("ophelia_requests_total", "counter",
+               "Number of requests answered, by status code.")
+        for code, count in requests:
+            lines.append('ophelia_requests_total{status="%s"} %s' % (
+                    escape(code), count))
+
+        name = "ophelia_request_duration_seconds"
+        header(name, "histogram",
+               "Time taken to answer requests, by top-level path segment.")
+        for segment, histogram in histograms:
+            label = 'segment="%s"' % escape(segment)
+            cumulative = 0
+            for bound, count in zip(self.buckets + ("+Inf",), histogram):
+                cumulative += count
+                lines.append('%s_bucket{%s,le="%s"} %s' % (
+                        name, label, bound, cumulative))
+            lines.append("%s_sum{%s} %r" % (name, label, histogram[-1]))
+            lines.append("%s_count{%s} %s" % (name, label, cumulative))
+
+        header("ophelia_sendfile_total", "counter",
+               "Number of requests passed on to the static file server.")
+        lines.append("ophelia_sendfile_total %s" % sendfile)
+
+        header("ophelia_errors_total", "counter",
+               "Number of requests that raised an unexpected exception.")
+        lines.append("ophelia_errors_total %s" % errors)
+
+        caches = [(cache_name, cache.stats())
+                  for cache_name, cache in caches if cache is not None]
+        for metric, type_, help, value in [
+            ("hits_total", "counter", "Number of cache hits, by cache.",
+             lambda stats: stats["hits"]),
+            ("misses_total", "counter", "Number of cache misses, by cache.",
+             lambda stats: stats["misses"]),
+            ("hit_ratio", "gauge", "Ratio of cache hits to lookups, by cache.",
+             lambda stats: (float(stats["hits"]) /
+                            (stats["hits"] + stats["misses"])
+                            if stats["hits"] + stats["misses"] else 0.0)),
+            ]:
+            header("ophelia_cache_" + metric, type_, help)
+            for cache_name, stats in caches:
+                lines.append('ophelia_cache_%s{cache="%s"} %s' % (
+                        metric, escape(cache_name), value(stats)))
+
+        for name, help, value in gauges:
+            header(name, "gauge", help)
+            lines.append("%s %s" % (name, value))
+
+        return "\n".join(lines) + "\n"
+
+
+def escape(value):
+    return (value.replace("\\", "\\\\").replace('"', '\\"')
+            .replace("\n", "\\n"))
@@ -1,7 +1,22 @@
 # Copyright (c) 2007-2008 Thomas Lotze
 # See also LICENSE.txt
 
+import copy
+import marshal
+import ophelia.cache
+import ophelia.util
+import sys
 import zope.pagetemplate.pagetemplate
+import zope.tal.htmltalparser
+import zope.tal.talgenerator
+import zope.tal.talinterpreter
+import zope.tal.talparser
+
+
+# cooked templates by file path, shared by all requests of the process
+template_cache = ophelia.cache.FileCache(1000)
+
+BASE_NAMES = {"None": None}
 
 
 class PageTemplateTracebackSupplement(object):
@@ -50,9 +65,15 @@ class PageTemplate(zope.pagetemplate.pagetemplate.PageTemplate):
     """Page templates with supplemented tracebacks and source tracking.
 
     Call parameters: the namespace of file context variables
+
+    Templates are cooked into TAL programs and interpreted by zope.tal
+    directly rather than by whichever page template engine zope.pagetemplate
+    provides, so the program is available for streaming and export with any
+    version of zope.pagetemplate.
     """
 
     file_path = None
+    engine = None # TALES engine to compile expressions with if not default
 
     def __init__(self, text, file_path=None, offset=(0, 0)):
         super(PageTemplate, self).__init__()
@@ -62,17 +83,268 @@ class PageTemplate(zope.pagetemplate.pagetemplate.PageTemplate):
 
     def _cook(self):
         __traceback_supplement__ = (PageTemplateTracebackSupplement, self)
-        super(PageTemplate, self)._cook()
+        engine = self.pt_getEngine()
+        source_file = self.pt_source_file()
+        if self.content_type == 'text/html':
+            generator = zope.tal.talgenerator.TALGenerator(
+                engine, xml=0, source_file=source_file)
+            parser = zope.tal.htmltalparser.HTMLTALParser(generator)
+        else:
+            generator = zope.tal.talgenerator.TALGenerator(
+                engine, source_file=source_file)
+            parser = zope.tal.talparser.TALParser(generator)
+
+        self._v_errors = ()
+        try:
+            parser.parseString(self._text)
+            self._v_program, self._v_macros = parser.getCode()
+        except Exception:
+            etype, e = sys.exc_info()[:2]
+            self._v_errors = ["Compilation failed", "%s.%s: %s" % (
+                    etype.__module__, etype.__name__, e)]
+        self._v_cooked = 1
         if self._v_errors:
             raise ValueError("There were errors in the page template text.")
 
+    def pt_getEngine(self):
+        if self.engine is not None:
+            return self.engine
+        return super(PageTemplate, self).pt_getEngine()
+
     def pt_getContext(self, namespaces, names):
-        context = {"None": None,
-                   }
-        for namespace in namespaces:
-            context.update(namespace)
-        context.update(names)
-        return context
+        return ophelia.util.LayeredNamespace(
+            list(reversed(namespaces)) + [BASE_NAMES], **names)
 
     def pt_source_file(self):
         return self.file_path
+
+    def pt_render(self, namespace, source=False, sourceAnnotations=False,
+                  showtal=False):
+        # an empty stream would be taken for no stream at all
+        stream = zope.tal.talinterpreter.FasterStringIO(u'')
+        self.interpret(namespace, stream, tal=not source, showtal=showtal,
+                       sourceAnnotations=sourceAnnotations)
+        return stream.getvalue()
+
+    def render_to(self, stream, *args, **kwargs):
+        """Render the template, writing the output to a file-like object.
+
+        Takes the same arguments as calling the template, plus the stream to
+        write to. This avoids building the output as one string.
+        """
+        self.interpret(self.pt_getContext(args, kwargs), stream)
+
+    def interpret(self, namespace, stream, **options):
+        """Run the TAL program, writing the output to a file-like object.
+
+        namespace: dict, the TALES names to render with
+        stream: file-like object
+        options: keyword arguments to the TAL interpreter
+
+        returns nothing
+        """
+        self._cook_check()
+        __traceback_supplement__ = (
+            zope.pagetemplate.pagetemplate.PageTemplateTracebackSupplement,
+            self, namespace)
+        if self._v_errors:
+            raise zope.pagetemplate.pagetemplate.PTRuntimeError(
+                str(self._v_errors))
+        options.setdefault('tal', True)
+        options.setdefault('showtal', False)
+        zope.tal.talinterpreter.TALInterpreter(
+            self._v_program, self._v_macros,
+            self.pt_getEngineContext(namespace), stream=stream,
+            strictinsert=0, **options)()
+
+
+def get_template(text, file_path, offset=(0, 0), signature=None):
+    """Get a page template for the template text read from an input file.
+
+    Cooking is expensive, so cooked templates are kept in the process-wide
+    template cache and reused as long as neither the file's signature nor the
+    text changed. Each call returns a fresh shallow copy of the cached
+    template so callers may write to it without affecting other requests.
+
+    text: unicode, template text
+    file_path: str, path of the input file the text was read from
+    offset: (int, int), line and row offset of the template in the file
+    signature: file signature as computed by ophelia.cache.file_signature,
+               computed from file_path if not given
+
+    returns PageTemplate
+    """
+    if signature is None:
+        signature = ophelia.cache.file_signature(file_path)
+    template = template_cache.lookup(file_path, signature)
+    if (template is None or
+        template._text != text or template.offset != offset):
+        template = PageTemplate(text, file_path=file_path, offset=offset)
+        template_cache.store(file_path, signature, template)
+    return copy.copy(template)
+
+
+class MacroLibrary(dict):
+    """Immutable mapping of macro names to macros shared by all requests.
+
+    Instantiate as MacroLibrary(macros, signatures).
+
+    macros: dict mapping macro names to compiled macros
+    signatures: dict mapping the paths of the files the macros were loaded
+                from to the file signatures at the time of loading
+    """
+
+    def __init__(self, macros, signatures):
+        dict.__init__(self, macros)
+        self.signatures = signatures
+
+    def _immutable(self, *args, **kwargs):
+        raise TypeError("Macro libraries are immutable.")
+
+    __setitem__ = __delitem__ = _immutable
+    clear = pop = popitem = setdefault = update = _immutable
+
+
+def load_macro_library(file_paths, splitter):
+    """Cook the templates of macro files and collect their macros.
+
+    Macro files must not contain scripts since the library is loaded once,
+    independently of any request. Later files' macros override those of
+    earlier files by the same name.
+
+    file_paths: sequence of str, paths of the macro files
+    splitter: ophelia.input.Splitter to read the files with
+
+    returns MacroLibrary
+
+    raises ValueError if any of the files contains a script
+    """
+    macros = {}
+    signatures = {}
+    for file_path in file_paths:
+        signature = ophelia.cache.file_signature(file_path)
+        script, text, offset, script_offset = splitter.read(
+            file_path, signature)
+        if script:
+            raise ValueError(
+                "Macro file %s must not contain a script." % file_path)
+        template = get_template(text, file_path, offset, signature)
+        macros.update(template.macros)
+        signatures[file_path] = signature
+    return MacroLibrary(macros, signatures)
+
+
+# marks compiled TALES expressions in exported template programs
+EXPRESSION = "\0ophelia.expression"
+
+
+class ExpressionRecorder(object):
+    """TALES engine wrapper remembering the source of compiled expressions.
+    """
+
+    def __init__(self, engine):
+        self.engine = engine
+        # the compiled expressions are kept so their ids stay unique
+        self.sources = {}
+
+    def compile(self, expression):
+        compiled = self.engine.compile(expression)
+        self.sources[id(compiled)] = (compiled, expression)
+        return compiled
+
+    def __getattr__(self, name):
+        return getattr(self.engine, name)
+
+
+def export_program(text, file_path, offset=(0, 0)):
+    """Cook template text into a program that can be stored by marshal.
+
+    Compiled TALES expressions in the TAL program and macros are replaced
+    by markers holding the expression source, which import_program()
+    compiles again. This is much cheaper than parsing the template text.
+
+    text: unicode, template text
+    file_path: str, path of the input file the text was read from
+    offset: (int, int), line and row offset of the template in the file
+
+    returns (list, dict): the TAL program and macros, or None if the program
+            contains objects that can't be stored
+
+    raises ValueError if the template text contains errors
+    """
+    template = PageTemplate.__new__(PageTemplate)
+    template.engine = recorder = ExpressionRecorder(template.pt_getEngine())
+    template.__init__(text, file_path, offset)
+    sources = recorder.sources
+    defined = set()
+
+    def export(value):
+        if isinstance(value, list):
+            return [export(item) for item in value]
+        if isinstance(value, tuple):
+            if (len(value) == 2 and value[0] == "defineMacro" and
+                isinstance(value[1], tuple) and len(value[1]) == 2):
+                defined.add((value[1][0], id(value[1][1])))
+            return tuple(export(item) for item in value)
+        if isinstance(value, dict):
+            return dict((export(key), export(item))
+                        for key, item in value.iteritems())
+        source = sources.get(id(value))
+        if source is not None and source[0] is value:
+            return (EXPRESSION, source[1])
+        return value
+
+    program = export(template._v_program)
+    macros = template._v_macros
+    if all((name, id(block)) in defined for name, block in macros.items()):
+        # the macros will be found again while importing the program
+        macros = None
+    else:
+        macros = export(macros)
+    data = (program, macros)
+    try:
+        marshal.dumps(data)
+    except ValueError:
+        return None
+    return data
+
+
+def import_program(text, file_path, offset, program, macros):
+    """Make a cooked page template from a program exported before.
+
+    returns PageTemplate
+    """
+    template = PageTemplate.__new__(PageTemplate)
+    engine = template.pt_getEngine()
+    # expressions used several times need to be compiled only once
+    compiled = {}
+    defined = {}
+
+    def restore(value):
+        if isinstance(value, list):
+            return [restore(item) for item in value]
+        if isinstance(value, tuple):
+            if len(value) == 2 and value[0] == EXPRESSION:
+                expression = compiled.get(value[1])
+                if expression is None:
+                    expression = compiled[value[1]] = engine.compile(
+                        value[1])
+                return expression
+            value = tuple(restore(item) for item in value)
+            if (len(value) == 2 and value[0] == "defineMacro" and
+                isinstance(value[1], tuple) and len(value[1]) == 2):
+                defined[value[1][0]] = value[1][1]
+            return value
+        if isinstance(value, dict):
+            return dict((restore(key), restore(item))
+                        for key, item in value.iteritems())
+        return value
+
+    template.file_path = file_path
+    template.offset = offset
+    template._text = text
+    template._v_program = restore(program)
+    template._v_macros = defined if macros is None else restore(macros)
+    template._v_errors = ()
+    template._v_cooked = 1
+    return template
@@ -2,16 +2,21 @@
 # See also LICENSE.txt
 
 import functools
+import os
 import os.path
+import stat
 import threading
 import urlparse
 
 import zope.interface
 from zope.tales.engine import Engine as TALESEngine
 
+import ophelia.cache
 import ophelia.interfaces
 import ophelia.input
 import ophelia.pagetemplate
+import ophelia.timing
+import ophelia.util
 from ophelia.util import Namespace
 
 
@@ -50,6 +55,23 @@ class ThreadContext(threading.local):
 
 _thread_context = ThreadContext()
 
+# scripts' builtins mess up traceback supplements listing the TALES namespace
+HIDE_BUILTINS = {"__builtins__": ophelia.util.HIDDEN}
+
+CONTENT_TYPE_EXPRESSION = \
+    "python:'text/html; charset=' + __request__.response_encoding"
+
+# compiled response header expressions by expression text, shared by all
+# requests of the process
+header_cache = ophelia.cache.LRUCache(1000)
+
+# listings of template directories by directory path, shared by all requests
+# of the process
+directory_cache = ophelia.cache.FileCache(1000)
+
+FILE = "file"
+DIRECTORY = "directory"
+
 
 def push_request(func):
     @functools.wraps(func)
@@ -92,6 +114,7 @@ class Request(object):
 
     innerslot = None
     content = None
+    cache_ttl = None
     compiled_headers = None
     history = None # XXX deprecated, planned to be removed in 0.3.1
 
@@ -121,16 +144,26 @@ class Request(object):
         self.context = Namespace(
             __request__=self,
             )
-        self.macros = Namespace()
+        # macros preloaded by the application are shared by all requests
+        self.macro_library = env.get("ophelia.macros")
+        if self.macro_library is None:
+            self.macros = Namespace()
+        else:
+            self.macros = ophelia.util.LayeredNamespace([self.macro_library])
 
         preset_response_headers = env.get('ophelia.response_headers', {})
         self.response_headers = Namespace(
             (key, 'string:' + value)
             for key, value in preset_response_headers.iteritems())
-        self.response_headers['Content-Type'] = \
-            "python:'text/html; charset=' + __request__.response_encoding"
+        self.response_headers['Content-Type'] = CONTENT_TYPE_EXPRESSION
 
         self.stack = []
+        self.dependencies = {}
+        self.directories = {}
+        # a frozen tree loaded by the application replaces the file system
+        self.tree = env.get("ophelia.tree")
+        if self.tree is None:
+            self.tree = live_tree
 
         self.splitter = ophelia.input.Splitter(**env)
         self.response_encoding = env.get("response_encoding", "utf-8")
@@ -143,6 +176,22 @@ class Request(object):
         self.redirect_index = redirect_index
 
         self.immediate_result = env.get("immediate_result", False)
+        self.script_cache_dir = env.get("script_cache_dir")
+
+        incremental_encoding = env.get("incremental_encoding", False)
+        if incremental_encoding not in (True, False):
+            incremental_encoding = incremental_encoding.lower() in (
+                "on", "true", "yes")
+        self.incremental_encoding = incremental_encoding
+
+        timing = env.get("timing", False)
+        if timing not in (True, False):
+            timing = timing.lower() in ("on", "true", "yes")
+        timing_hooks = env.get("ophelia.timing_hooks", ())
+        if timing or timing_hooks:
+            self.timer = ophelia.timing.Timer(self, timing_hooks)
+        else:
+            self.timer = ophelia.timing.null_timer
 
     def __call__(self, **context):
         self.traverse(**context)
@@ -154,7 +203,7 @@ class Request(object):
         self.history = [self.current]
 
         # traverse the template root
-        if not os.path.isdir(self.template_root):
+        if self.list_directory(self.template_root) is None:
             raise RuntimeError(
                 "The Ophelia template root must be a file system directory.")
 
@@ -180,12 +229,20 @@ class Request(object):
             name = next or self.index_name
         next_path = os.path.join(self.dir_path, name)
 
-        if os.path.isdir(next_path):
+        if name in (os.curdir, os.pardir) or os.sep in name:
+            # a name set by a script may be a relative path
+            kind = self.tree.kind(next_path)
+        else:
+            kind = (self.list_directory(self.dir_path) or {}).get(name)
+
+        if kind is DIRECTORY:
             self.dir_path = next_path
             self.traverse_dir()
-        elif os.path.isfile(next_path):
+        elif kind is FILE:
             self.traverse_file(next_path)
         else:
+            # adding the file later would make the page exist
+            self.dependencies[next_path] = None
             raise NotFound
 
     def get_next(self):
@@ -209,8 +266,20 @@ class Request(object):
             raise Redirect(path=self.current + '/')
 
         file_path = os.path.join(self.dir_path, "__init__")
-        if os.path.isfile(file_path):
+        if (self.list_directory(self.dir_path) or {}).get("__init__") is FILE:
             self.traverse_file(file_path)
+        else:
+            # adding the file later would change the page
+            self.dependencies[file_path] = None
+
+    def list_directory(self, dir_path):
+        # each directory is looked at only once per request
+        try:
+            return self.directories[dir_path]
+        except KeyError:
+            entries = self.directories[dir_path] = self.tree.list_directory(
+                dir_path)
+            return entries
 
     def traverse_file(self, file_path):
         file_context, stop_traversal = self.process_file(file_path,
@@ -222,16 +291,20 @@ class Request(object):
         __traceback_info__ = "Processing " + file_path
 
         # get script and template
-        script, text = self.splitter(open(file_path).read())
-        # XXX bad hack:
-        offset = self.splitter._last_template_offset
+        signature = self.tree.file_signature(file_path)
+        self.dependencies[file_path] = signature
+        script, text, offset, script_offset = self.tree.read(
+            self.splitter, file_path, signature, self.timer)
+
+        with self.timer("cook", file_path):
+            template = self.tree.get_template(
+                text, file_path, offset, signature)
 
         # get_file_context() will find the file context by its name
         file_context = Namespace(
             __file__ = file_path,
             __text__ = text,
-            __template__ = ophelia.pagetemplate.PageTemplate(
-                text, file_path=file_path, offset=offset),
+            __template__ = template,
             )
         if insert:
             self.stack.append(file_context)
@@ -240,6 +313,10 @@ class Request(object):
         # so any script that might be calling this method can rely on those
         stop_traversal = None
         if script:
+            with self.timer("compile", file_path):
+                code = self.tree.compile_script(
+                    script, file_path, script_offset, signature,
+                    self.script_cache_dir)
             if context is None:
                 context = self.context
             old_predef_vars = dict((key, context.get(key))
@@ -248,7 +325,8 @@ class Request(object):
             _thread_context.file_contexts.append(file_context)
             try:
                 try:
-                    exec script in context
+                    with self.timer("script", file_path):
+                        exec code in context
                 except StopTraversal, e:
                     stop_traversal = e
                     if  e.text is not None:
@@ -264,15 +342,14 @@ class Request(object):
         return file_context, stop_traversal
 
     def tales_namespace(self, file_context={}):
-        tales_ns = Namespace(
-            innerslot=self.innerslot,
-            macros=self.macros,
-            )
-        tales_ns.update(TALESEngine.getBaseNames())
-        tales_ns.update(self.context)
-        tales_ns.update(file_context)
-        tales_ns.pop("__builtins__", None)
-        return tales_ns
+        # layering saves copying the whole script context for each template
+        return ophelia.util.LayeredNamespace([
+            HIDE_BUILTINS,
+            file_context,
+            self.context,
+            TALESEngine.getBaseNames(),
+            dict(innerslot=self.innerslot, macros=self.macros),
+            ])
 
     def build(self):
         self.build_content()
@@ -281,6 +358,7 @@ class Request(object):
 
     @push_request
     def build_content(self):
+        incremental = self.incremental_encoding and not self.immediate_result
         while self.stack:
             # get_file_context() will find the file context by its name
             file_context = self.stack.pop()
@@ -292,26 +370,56 @@ class Request(object):
                 continue
 
             __traceback_info__ = "Template at " + file_context.__file__
-            self.innerslot = template(self.tales_namespace(file_context))
+            tales_ns = self.tales_namespace(file_context)
+            if incremental and not any(fc.__template__._text.strip()
+                                     for fc in self.stack):
+                # render the outermost template right into the encoder
+                writer = ophelia.util.EncodingWriter(self.response_encoding)
+                writer.write_encoded(self.xml_declaration())
+                with self.timer("render", file_context.__file__):
+                    template.render_to(writer, tales_ns)
+                self.innerslot = None
+                self.content = writer.close()
+                return
+            with self.timer("render", file_context.__file__):
+                self.innerslot = template(tales_ns)
 
         self.content = self.innerslot
         if not self.immediate_result:
-            self.content = """<?xml version="%s" encoding="%s" ?>\n%s""" % (
-                self.xml_version,
-                self.response_encoding,
-                self.content.encode(self.response_encoding))
+            self.content = self.xml_declaration() + self.content.encode(
+                self.response_encoding)
+
+    def xml_declaration(self):
+        return """<?xml version="%s" encoding="%s" ?>\n""" % (
+            self.xml_version, self.response_encoding)
 
     @push_request
     def build_headers(self):
         self.compiled_headers = {}
-        tales_context = TALESEngine.getContext(self.tales_namespace())
-
-        for name, expression in self.response_headers.iteritems():
-            __traceback_info__ = "Header %s: %s" % (name, expression)
-            self.compiled_headers[name] = tales_context.evaluate(expression)
+        with self.timer("headers"):
+            tales_context = None
+            for name, expression in self.response_headers.iteritems():
+                __traceback_info__ = "Header %s: %s" % (name, expression)
+                compiled = compile_header(expression)
+                if isinstance(compiled, ConstantExpression):
+                    self.compiled_headers[name] = compiled.value
+                    continue
+                if tales_context is None:
+                    tales_context = TALESEngine.getContext(
+                        self.tales_namespace())
+                self.compiled_headers[name] = tales_context.evaluate(compiled)
 
     def load_macros(self, name):
-        self.process_file(os.path.join(self.dir_path, name))
+        file_path = os.path.join(self.dir_path, name)
+        if self.macro_library is not None:
+            file_path = os.path.normpath(file_path)
+            signature = self.macro_library.signatures.get(file_path)
+            if (signature is not None and
+                signature == self.tree.file_signature(file_path)):
+                # the macros are in the shared library already
+                self.dependencies[file_path] = signature
+                return
+        self.process_file(file_path)
 
     def insert_template(self, name):
         self.process_file(os.path.join(self.dir_path, name), insert=True)
@@ -319,4 +427,120 @@ class Request(object):
     def render_template(self, name):
         file_context, stop_traversal = self.process_file(
             os.path.join(self.dir_path, name))
-        return file_context.__template__(self.tales_namespace(file_context))
+        with self.timer("render", file_context.__file__):
+            return file_context.__template__(
+                self.tales_namespace(file_context))
+
+
+def list_directory(dir_path):
+    """List the files and subdirectories of a directory.
+
+    Listings are kept in the process-wide directory cache and reused as long
+    as the directory's signature doesn't change, which happens whenever
+    entries are added, removed or renamed. Symbolic links are followed when
+    the listing is made.
+
+    dir_path: str, file system path of the directory
+
+    returns dict mapping names to FILE or DIRECTORY, leaving out other kinds
+            of entries; None if there is no directory at the path
+    """
+    try:
+        signature = ophelia.cache.file_signature(dir_path)
+    except OSError:
+        return None
+    entries = directory_cache.lookup(dir_path, signature)
+    if entries is None:
+        try:
+            names = os.listdir(dir_path)
+        except OSError:
+            # remember that the path doesn't point to a directory
+            directory_cache.store(dir_path, signature, False)
+            return None
+        entries = {}
+        for name in names:
+            try:
+                mode = os.stat(os.path.join(dir_path, name)).st_mode
+            except OSError:
+                continue
+            if stat.S_ISDIR(mode):
+                entries[name] = DIRECTORY
+            elif stat.S_ISREG(mode):
+                entries[name] = FILE
+        directory_cache.store(dir_path, signature, entries)
+    if entries is False:
+        return None
+    return entries
+
+
+class LiveTree(object):
+    """Access to the input files of a template tree on the file system.
+
+    Information derived from the files is kept in the process-wide caches and
+    used as long as the files' signatures don't change.
+    """
+
+    def kind(self, path):
+        """Tell what kind of entry a path points to, following symlinks.
+
+        returns FILE, DIRECTORY or None
+        """
+        if os.path.isdir(path):
+            return DIRECTORY
+        if os.path.isfile(path):
+            return FILE
+
+    def list_directory(self, dir_path):
+        return list_directory(dir_path)
+
+    def file_signature(self, file_path):
+        return ophelia.cache.file_signature(file_path)
+
+    def read(self, splitter, file_path, signature=None,
+             timer=ophelia.timing.null_timer):
+        return splitter.read(file_path, signature, timer)
+
+    def compile_script(self, script, file_path, line_offset=0,
+                       signature=None, cache_dir=None):
+        return ophelia.input.compile_script(
+            script, file_path, line_offset, signature, cache_dir)
+
+    def get_template(self, text, file_path, offset=(0, 0), signature=None):
+        return ophelia.pagetemplate.get_template(
+            text, file_path, offset, signature)
+
+
+live_tree = LiveTree()
+
+
+class ConstantExpression(object):
+    """Compiled TALES expression whose value doesn't depend on any variables.
+    """
+
+    def __init__(self, value):
+        self.value = value
+
+    def __call__(self, econtext):
+        return self.value
+
+
+def compile_header(expression):
+    """Compile a response header expression, reusing earlier results.
+
+    Expressions of the "string:" type which don't interpolate any variables
+    are not compiled by the TALES engine but turned into constants right away.
+
+    expression: str, TALES expression
+
+    returns compiled expression, ConstantExpression for constant strings
+
+    raises zope.tales.tales.CompilerError if the expression can't be compiled
+    """
+    compiled = header_cache.get(expression)
+    if compiled is None:
+        if expression.startswith("string:") and "$" not in expression:
+            compiled = ConstantExpression(expression[len("string:"):])
+        else:
+            compiled = TALESEngine.compile(expression)
+        header_cache.set(expression, compiled)
+    return compiled
@@ -0,0 +1,187 @@
+# Copyright (c) 2013 Thomas Lotze
+# See also LICENSE.txt
+
+"""A multi-threaded HTTP server for running Ophelia sites in production.
+"""
+
+import Queue
+import ophelia.util
+import ophelia.wsgi
+import optparse
+import signal
+import socket
+import sys
+import threading
+import wsgiref.simple_server
+
+
+class ServerHandler(wsgiref.simple_server.ServerHandler):
+
+    def cleanup_headers(self):
+        wsgiref.simple_server.ServerHandler.cleanup_headers(self)
+        request_handler = self.request_handler
+        if ('Content-Length' not in self.headers and
+            not self.status.startswith(('1', '204', '304'))):
+            # without a length, the end of the body is the end of connection
+            request_handler.close_connection = 1
+        if request_handler.server.stopping:
+            request_handler.close_connection = 1
+        if request_handler.close_connection:
+            self.headers['Connection'] = 'close'
+
+
+class RequestHandler(wsgiref.simple_server.WSGIRequestHandler):
+    """Handles any number of requests made through one connection.
+    """
+
+    protocol_version = "HTTP/1.1"
+
+    def setup(self):
+        self.timeout = self.server.keep_alive_timeout
+        wsgiref.simple_server.WSGIRequestHandler.setup(self)
+
+    def handle(self):
+        self.close_connection = 1
+        self.handle_one_request()
+        while not self.close_connection:
+            self.handle_one_request()
+
+    def handle_one_request(self):
+        try:
+            self.raw_requestline = self.rfile.readline(65537)
+        except socket.timeout:
+            # an idle keep-alive connection shouldn't block a thread forever
+            self.close_connection = 1
+            return
+        if len(self.raw_requestline) > 65536:
+            self.requestline = self.request_version = self.command = ''
+            self.send_error(414)
+            self.close_connection = 1
+            return
+        if not self.raw_requestline:
+            self.close_connection = 1
+            return
+        if not self.parse_request():
+            return
+        if (self.headers.get('Content-Length', '0') != '0' or
+            'Transfer-Encoding' in self.headers):
+            # the application may not read the whole request body, which
+            # would make the rest of it look like the next request
+            self.close_connection = 1
+
+        handler = ServerHandler(
+            self.rfile, self.wfile, self.get_stderr(), self.get_environ())
+        handler.request_handler = self
+        if self.request_version == 'HTTP/1.1':
+            handler.http_version = '1.1'
+        handler.run(self.server.get_app())
+
+
+class ThreadPoolServer(wsgiref.simple_server.WSGIServer):
+    """WSGI server handling connections by a fixed number of threads.
+
+    Instantiate as ThreadPoolServer(server_address, app, threads=10,
+                                    queue_size=100, keep_alive_timeout=5).
+
+    server_address: (str, int), host and port to listen on
+    app: WSGI application
+    threads: int, number of worker threads handling connections
+    queue_size: int, number of accepted connections that may wait for a
+                worker thread, further connections are answered with
+                "503 Service unavailable"
+    keep_alive_timeout: float, number of seconds to wait for the next request
+                        on a persistent connection
+
+    After serve_forever() returned due to shutdown() having been called,
+    stop() finishes all requests accepted so far.
+    """
+
+    rejected_response = (
+        "HTTP/1.1 503 Service unavailable\r\n"
+        "Content-Type: text/plain\r\n"
+        "Content-Length: 20\r\n"
+        "Retry-After: 1\r\n"
+        "Connection: close\r\n"
+        "\r\n"
+        "Server is too busy.\n")
+
+    def __init__(self, server_address, app, threads=10, queue_size=100,
+                 keep_alive_timeout=5):
+        # let the listening socket hold as many pending connections as the
+        # queue, the default of 5 would make further clients retry later
+        self.request_queue_size = max(queue_size, 5)
+        wsgiref.simple_server.WSGIServer.__init__(
+            self, server_address, RequestHandler)
+        self.set_app(app)
+        self.keep_alive_timeout = keep_alive_timeout
+        self.stopping = False
+        self.connections = Queue.Queue(queue_size)
+        self.workers = []
+        for i in xrange(threads):
+            worker = threading.Thread(target=self.work)
+            worker.daemon = True
+            worker.start()
+            self.workers.append(worker)
+
+    def process_request(self, request, client_address):
+        try:
+            self.connections.put_nowait((request, client_address))
+        except Queue.Full:
+            self.reject(request)
+
+    def reject(self, request):
+        try:
+            request.sendall(self.rejected_response)
+        except socket.error:
+            pass
+        self.close_request(request)
+
+    def work(self):
+        while True:
+            connection = self.connections.get()
+            if connection is None:
+                break
+            request, client_address = connection
+            try:
+                self.finish_request(request, client_address)
+            except Exception:
+                self.handle_error(request, client_address)
+            self.close_request(request)
+
+    def stop(self):
+        """Finish all accepted requests, then stop the worker threads.
+        """
+        self.stopping = True
+        self.server_close()
+        for worker in self.workers:
+            self.connections.put(None)
+        for worker in self.workers:
+            worker.join()
+
+
+def main():
+    parser = optparse.OptionParser(
+        usage='%prog config_file',
+        description='Serve an Ophelia site by a multi-threaded HTTP server.')
+    cmd_options, args = parser.parse_args()
+    if len(args) != 1:
+        parser.error('need a configuration file')
+
+    options = ophelia.util.read_config(args[0])
+    server_address = (options.pop('host'), int(options.pop('port')))
+    threads = int(options.pop('threads', 10))
+    queue_size = int(options.pop('queue_size', 100))
+    keep_alive_timeout = float(options.pop('keep_alive_timeout', 5))
+    server = ThreadPoolServer(
+        server_address, ophelia.wsgi.Application(options), threads,
+        queue_size, keep_alive_timeout)
+
+    def terminate(signum, frame):
+        # shutdown() waits for serve_forever() which runs in this very thread
+        threading.Thread(target=server.shutdown).start()
+    signal.signal(signal.SIGTERM, terminate)
+    signal.signal(signal.SIGINT, terminate)
+
+    server.serve_forever()
+    server.stop()
+    sys.exit(0)
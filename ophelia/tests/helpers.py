@@ -0,0 +1,56 @@
+# Copyright (c) 2013 Thomas Lotze
+# See also LICENSE.txt
+
+"""Helpers shared by the test modules.
+"""
+
+import StringIO
+import os
+import os.path
+import wsgiref.util
+
+
+def write(file_path, content):
+    """Write a file such that its signature and its directory's change.
+
+    The modification times are moved ahead as rewriting a file within the
+    resolution of the file system's clock might otherwise go unnoticed.
+
+    file_path: str, file system path
+    content: str
+
+    returns str, the file path
+    """
+    open(file_path, 'w').write(content)
+    for path in (file_path, os.path.dirname(file_path)):
+        os.utime(path, (0, os.stat(path).st_mtime + 10))
+    return file_path
+
+
+def get(app, path, method='GET', **env):
+    """Call a WSGI application as a server would for a request.
+
+    app: WSGI application
+    path: str, PATH_INFO of the request
+    method: str, REQUEST_METHOD of the request
+    env: further WSGI environment variables
+
+    returns (str, dict, iterable of str): status line, headers by lower-case
+            name and the body as returned by the application
+    """
+    env['PATH_INFO'] = path
+    env['REQUEST_METHOD'] = method
+    env.setdefault('SCRIPT_NAME', '')
+    env.setdefault('wsgi.input', StringIO.StringIO())
+    wsgiref.util.setup_testing_defaults(env)
+    response = []
+
+    def start_response(status, headers, exc_info=None):
+        response[:] = [status, dict((key.lower(), value)
+                                    for key, value in headers)]
+    body = app(env, start_response)
+    if not response:
+        # the application may start the response when iterated only
+        body = list(body)
+    status, headers = response
+    return status, headers, body
@@ -0,0 +1,74 @@
+# Copyright (c) 2013 Thomas Lotze
+# See also LICENSE.txt
+
+import ophelia.benchmark
+import ophelia.wsgi
+import shutil
+import tempfile
+import webtest
+
+try:
+    import unittest2 as unittest
+except ImportError:
+    import unittest
+
+
+class GenerateTreeTest(unittest.TestCase):
+
+    def setUp(self):
+        self.template_root = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.template_root)
+
+    def test_generated_pages_can_be_rendered(self):
+        paths = ophelia.benchmark.generate_tree(
+            self.template_root, depth=1, width=2, macros=3, page_size=5)
+        self.assertEqual(['page0.html', 'page1.html',
+                          'dir0/page0.html', 'dir0/page1.html',
+                          'dir1/page0.html', 'dir1/page1.html'], paths)
+        app = webtest.TestApp(ophelia.wsgi.Application({
+                    'site': 'http://localhost/',
+                    'template_root': self.template_root,
+                    }))
+        body = app.get('/dir1/page0.html', status=200).body
+        self.assertIn('<div class="level1">\n<div><h1>Benchmark</h1>', body)
+        self.assertEqual(3, body.count('<div class="macro">'))
+        self.assertEqual(5, body.count('Lorem ipsum'))
+
+    def test_benchmark_reports_all_phases(self):
+        paths = ophelia.benchmark.generate_tree(
+            self.template_root, depth=0, width=2, macros=1, page_size=1)
+        results = ophelia.benchmark.Benchmark(
+            self.template_root, paths, iterations=5)()
+        self.assertEqual(
+            ['application', 'build_content', 'build_headers', 'request',
+             'startup', 'startup_bundle', 'traverse'], sorted(results))
+        for stats in results.values():
+            self.assertEqual(5, stats['count'])
+            self.assertTrue(
+                stats['min'] <= stats['p50'] <= stats['p99'] <= stats['max'])
+
+
+class StatisticsTest(unittest.TestCase):
+
+    def test_percentiles(self):
+        stats = ophelia.benchmark.statistics(
+            [i / 1000.0 for i in range(100, 0, -1)], total=0.5)
+        self.assertEqual(100, stats['count'])
+        self.assertEqual(200, stats['throughput'])
+        self.assertAlmostEqual(1, stats['min'])
+        self.assertAlmostEqual(51, stats['p50'])
+        self.assertAlmostEqual(91, stats['p90'])
+        self.assertAlmostEqual(100, stats['p99'])
+        self.assertAlmostEqual(100, stats['max'])
+        self.assertAlmostEqual(50.5, stats['mean'])
+
+    def test_compare_detects_regressions(self):
+        baseline = {'traverse': {'p50': 1.0}, 'application': {'p50': 2.0}}
+        results = {'traverse': {'p50': 1.05}, 'application': {'p50': 2.5},
+                   'request': {'p50': 3.0}}
+        self.assertEqual(
+            [('application', 2.0, 2.5, True),
+             ('traverse', 1.0, 1.05, False)],
+            ophelia.benchmark.compare(results, baseline, tolerance=0.1))
@@ -0,0 +1,149 @@
+# Copyright (c) 2013 Thomas Lotze
+# See also LICENSE.txt
+
+from ophelia.tests.helpers import write
+import StringIO
+import ophelia.build
+import os.path
+import pkg_resources
+import shutil
+import tempfile
+
+try:
+    import unittest2 as unittest
+except ImportError:
+    import unittest
+
+
+FIXTURES = pkg_resources.resource_filename('ophelia', 'tests/fixtures')
+
+
+def fixture(*parts):
+    return os.path.join(FIXTURES, *parts)
+
+
+class DiscoverTest(unittest.TestCase):
+
+    def test_finds_pages_and_directory_indexes(self):
+        paths = list(ophelia.build.discover(fixture('documents')))
+        self.assertEqual(['', 'smoke-document.html', 'folder/'], paths)
+
+    def test_index_name_is_configurable(self):
+        paths = list(ophelia.build.discover(
+            fixture('documents'), 'smoke-document.html'))
+        self.assertEqual(['index.html', '', 'folder/index.html'], paths)
+
+    def test_output_path_of_directory_is_its_index_file(self):
+        self.assertEqual('/out/folder/index.html',
+                         ophelia.build.output_path('/out', 'folder/'))
+        self.assertEqual('/out/index.html',
+                         ophelia.build.output_path('/out', ''))
+        self.assertEqual('/out/folder/foo.html',
+                         ophelia.build.output_path('/out', 'folder/foo.html'))
+
+
+class BuilderTest(unittest.TestCase):
+
+    def setUp(self):
+        self.output_dir = tempfile.mkdtemp()
+        self.out = StringIO.StringIO()
+        self.builder = ophelia.build.Builder({
+                'site': 'http://localhost/',
+                'template_root': fixture('templates'),
+                }, self.output_dir, jobs=2, out=self.out)
+
+    def tearDown(self):
+        shutil.rmtree(self.output_dir)
+
+    def test_renders_pages_to_output_directory(self):
+        self.builder(['smoke.html'])
+        content = open(os.path.join(self.output_dir, 'smoke.html')).read()
+        self.assertIn('<p>bar</p>', content)
+        self.assertTrue(content.startswith('<?xml'))
+
+    def test_reports_errors_and_skips_redirects(self):
+        errors = self.builder()
+        self.assertEqual(2, errors)
+        self.assertEqual(
+            sorted(['.ophelia-build.json', 'cookie.html', 'language.html',
+                    'private.html', 'smoke.html', 'time.html',
+                    'uncacheable.html']),
+            sorted(os.listdir(self.output_dir)))
+        report = self.out.getvalue()
+        self.assertIn('error     /raise.html', report)
+        self.assertIn('redirect  /redirect.html', report)
+        self.assertIn('Exception: message', report)
+        self.assertIn('9 pages in', report)
+        self.assertIn('Slowest pages:', report)
+
+
+class IncrementalBuildTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.template_root = os.path.join(self.tmpdir, 'templates')
+        self.output_dir = os.path.join(self.tmpdir, 'output')
+        os.mkdir(self.template_root)
+        os.mkdir(os.path.join(self.template_root, 'folder'))
+        self.write('layout.html', '<div metal:define-macro="page" />')
+        self.write('folder/page.html', """\
+__request__.load_macros('../layout.html')
+<?xml?>
+<p metal:use-macro="macros/page" />""")
+        self.write('other.html', '<p>other</p>')
+        self.build()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def write(self, path, content):
+        write(os.path.join(self.template_root, path), content)
+
+    def build(self, **kw):
+        self.out = StringIO.StringIO()
+        builder = ophelia.build.Builder({
+                'site': 'http://localhost/',
+                'template_root': self.template_root,
+                }, self.output_dir, jobs=1, out=self.out)
+        builder(**kw)
+        return sorted(path for duration, path in builder.timings)
+
+    def read(self, path):
+        return open(os.path.join(self.output_dir, path)).read()
+
+    def test_unchanged_pages_are_not_rendered_again(self):
+        self.assertEqual([], self.build())
+        self.assertIn('3 pages unchanged', self.out.getvalue())
+
+    def test_full_build_renders_all_pages(self):
+        self.assertEqual(['folder/page.html', 'layout.html', 'other.html'],
+                         self.build(full=True))
+
+    def test_changed_macro_file_causes_dependent_pages_to_be_rendered(self):
+        self.write('layout.html', '<div metal:define-macro="page">x</div>')
+        self.assertEqual(['folder/page.html', 'layout.html'], self.build())
+        self.assertIn('<div>x</div>', self.read('folder/page.html'))
+
+    def test_added_init_file_causes_pages_below_to_be_rendered(self):
+        self.write('folder/__init__',
+                   '<body tal:content="structure innerslot" />')
+        self.assertEqual(['folder/page.html'], self.build())
+        self.assertIn('<body>', self.read('folder/page.html'))
+
+    def test_added_page_is_rendered(self):
+        self.write('new.html', '<p>new</p>')
+        self.assertEqual(['new.html'], self.build())
+        self.assertIn('<p>new</p>', self.read('new.html'))
+
+    def test_output_of_deleted_page_is_removed(self):
+        os.remove(os.path.join(self.template_root, 'other.html'))
+        self.assertEqual([], self.build())
+        self.assertFalse(
+            os.path.exists(os.path.join(self.output_dir, 'other.html')))
+
+    def test_pages_depending_on_deleted_file_are_rendered_again(self):
+        os.remove(os.path.join(self.template_root, 'layout.html'))
+        self.assertEqual(['folder/page.html'], self.build())
+        self.assertIn('error', self.out.getvalue())
+        self.assertFalse(os.path.exists(
+            os.path.join(self.output_dir, 'folder', 'page.html')))
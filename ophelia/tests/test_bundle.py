@@ -0,0 +1,139 @@
+# Copyright (c) 2013 Thomas Lotze
+# See also LICENSE.txt
+
+from ophelia.tests.helpers import write
+import StringIO
+import __builtin__
+import marshal
+import ophelia.bundle
+import ophelia.frozen
+import ophelia.pagetemplate
+import ophelia.request
+import ophelia.wsgi
+import os
+import os.path
+import shutil
+import tempfile
+import wsgiref.util
+
+try:
+    import unittest2 as unittest
+except ImportError:
+    import unittest
+
+
+class BundleTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.template_root = os.path.join(self.tmpdir, 'templates')
+        self.bundle_path = os.path.join(self.tmpdir, 'site.bundle')
+        os.mkdir(self.template_root)
+        os.mkdir(os.path.join(self.template_root, 'folder'))
+        self.write('__init__', """\
+__request__.load_macros('macros.html')
+title = u'Site'
+<?xml?>
+<html tal:content="structure innerslot" />
+""")
+        self.write('macros.html', """\
+<div metal:define-macro="heading"><h1 tal:content="title" /></div>
+""")
+        self.write('folder/page.html', """\
+items = [1, 2]
+<?xml?>
+<div><div metal:use-macro="macros/heading" />
+<p tal:repeat="item items" tal:content="item" /></div>
+""")
+        ophelia.bundle.write_bundle(
+            ophelia.frozen.FrozenTree(self.template_root), self.bundle_path)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def write(self, path, content):
+        write(os.path.join(self.template_root, path), content)
+
+    def request(self, tree, path):
+        return ophelia.request.Request(
+            path, self.template_root, 'http://localhost/',
+            **{'wsgi.input': StringIO.StringIO(), 'ophelia.tree': tree})
+
+    def test_bundle_renders_like_the_template_tree(self):
+        bundle = ophelia.bundle.Bundle(self.bundle_path, self.template_root)
+        tree = ophelia.frozen.FrozenTree(self.template_root)
+        self.assertEqual(tree.directories, bundle.directories)
+        self.assertEqual(3, bundle.file_count)
+        self.assertEqual(os.path.getsize(self.bundle_path), bundle.size)
+        self.assertEqual(self.request(tree, 'folder/page.html')(),
+                         self.request(bundle, 'folder/page.html')())
+
+    def test_files_are_read_when_first_used(self):
+        bundle = ophelia.bundle.Bundle(self.bundle_path, self.template_root)
+        self.assertEqual({}, bundle.files)
+        file_path = os.path.join(self.template_root, 'folder', 'page.html')
+        entry = bundle.file(file_path)
+        self.assertIs(entry, bundle.file(file_path))
+        self.assertEqual(1, len(entry.codes))
+        self.assertEqual(1, len(entry.templates))
+        self.assertRaises(OSError, bundle.file,
+                          os.path.join(self.template_root, 'missing.html'))
+
+    def test_bundle_contains_template_programs(self):
+        bundle = ophelia.bundle.Bundle(self.bundle_path, self.template_root)
+        for file_path, (offset, length) in bundle.records.items():
+            templates = marshal.loads(bundle.map[offset:offset + length])[4]
+            self.assertEqual(1, len(templates), file_path)
+            (text, template_offset), (program, macros) = templates[0]
+            self.assertIsInstance(program, list)
+
+    def test_traversal_doesnt_look_at_the_template_tree(self):
+        bundle = ophelia.bundle.Bundle(self.bundle_path, self.template_root)
+        shutil.rmtree(self.template_root)
+
+        def fail(*args):
+            raise AssertionError('file system access %r' % (args,))
+        saved = os.stat, os.lstat, os.listdir, __builtin__.open
+        os.stat = os.lstat = os.listdir = __builtin__.open = fail
+        try:
+            headers, content = self.request(bundle, 'folder/page.html')()
+        finally:
+            os.stat, os.lstat, os.listdir, __builtin__.open = saved
+        self.assertIn('<h1>Site</h1>', content)
+        self.assertIn('<p>2</p>', content)
+
+    def test_other_files_are_rejected(self):
+        self.write('other', 'OPHB but not a bundle file at all')
+        self.assertRaises(
+            ValueError, ophelia.bundle.Bundle,
+            os.path.join(self.template_root, 'other'), self.template_root)
+
+    def test_application_loads_bundle(self):
+        self.write('folder/page.html', '<p>changed</p>')
+        app = ophelia.wsgi.Application({
+                'site': 'http://localhost/',
+                'template_root': self.template_root,
+                'bundle_file': self.bundle_path,
+                })
+        self.assertIsInstance(app.tree, ophelia.bundle.Bundle)
+        env = {'PATH_INFO': '/folder/page.html',
+               'wsgi.input': StringIO.StringIO()}
+        wsgiref.util.setup_testing_defaults(env)
+        body = ''.join(app(env, lambda *args: None))
+        self.assertIn('<p>2</p>', body)
+
+
+class ProgramExportTest(unittest.TestCase):
+
+    def test_exported_program_is_restored(self):
+        text = u"""\
+<div metal:define-macro="outer"><p tal:content="title" />
+<span metal:define-macro="inner" tal:replace="python:1 + 1" /></div>"""
+        data = ophelia.pagetemplate.export_program(text, '/page.html')
+        program, macros = marshal.loads(marshal.dumps(data))
+        template = ophelia.pagetemplate.import_program(
+            text, '/page.html', (0, 0), program, macros)
+        cooked = ophelia.pagetemplate.PageTemplate(text, '/page.html')
+        self.assertEqual(repr(cooked._v_program), repr(template._v_program))
+        self.assertEqual(sorted(cooked.macros), sorted(template.macros))
+        self.assertEqual(cooked(title=u'Title'), template(title=u'Title'))
@@ -0,0 +1,335 @@
+# Copyright (c) 2013 Thomas Lotze
+# See also LICENSE.txt
+
+from ophelia.cache import LRUCache, FileCache, file_signature
+from ophelia.cache import NegativeCache, RenderCache, SharedResponseCache
+import ophelia.pagetemplate
+import os
+import os.path
+import shutil
+import tempfile
+import threading
+import time
+
+try:
+    import unittest2 as unittest
+except ImportError:
+    import unittest
+
+
+class LRUCacheTest(unittest.TestCase):
+
+    def test_stored_values_can_be_retrieved(self):
+        cache = LRUCache(10)
+        cache.set('foo', 1)
+        self.assertEqual(1, cache.get('foo'))
+        self.assertIn('foo', cache)
+        self.assertEqual(1, len(cache))
+
+    def test_missing_key_returns_default(self):
+        cache = LRUCache(10)
+        self.assertEqual(None, cache.get('foo'))
+        self.assertEqual(2, cache.get('foo', 2))
+
+    def test_counts_hits_and_misses(self):
+        cache = LRUCache(10)
+        cache.set('foo', 1)
+        cache.get('foo')
+        cache.get('foo')
+        cache.get('bar')
+        self.assertEqual(dict(hits=2, misses=1, entries=1, size=1),
+                         cache.stats())
+
+    def test_least_recently_used_entry_is_dropped_first(self):
+        cache = LRUCache(2)
+        cache.set('foo', 1)
+        cache.set('bar', 2)
+        cache.get('foo')
+        cache.set('baz', 3)
+        self.assertIn('foo', cache)
+        self.assertNotIn('bar', cache)
+        self.assertIn('baz', cache)
+
+    def test_entry_sizes_are_summed_up_against_the_bound(self):
+        cache = LRUCache(10)
+        cache.set('foo', 'x', 6)
+        cache.set('bar', 'y', 3)
+        cache.set('baz', 'z', 3)
+        self.assertNotIn('foo', cache)
+        self.assertEqual(6, cache.size)
+
+    def test_replacing_a_value_updates_the_size(self):
+        cache = LRUCache(10)
+        cache.set('foo', 'x', 6)
+        cache.set('foo', 'y', 2)
+        self.assertEqual('y', cache.get('foo'))
+        self.assertEqual(2, cache.size)
+
+    def test_values_larger_than_the_cache_are_not_stored(self):
+        cache = LRUCache(10)
+        cache.set('foo', 'x', 2)
+        cache.set('foo', 'y', 11)
+        self.assertNotIn('foo', cache)
+        self.assertEqual(0, cache.size)
+
+    def test_popping_removes_an_entry(self):
+        cache = LRUCache(10)
+        cache.set('foo', 1)
+        self.assertEqual(1, cache.pop('foo'))
+        self.assertEqual(None, cache.pop('foo'))
+        self.assertEqual(0, cache.size)
+
+    def test_concurrent_use_keeps_the_cache_consistent(self):
+        cache = LRUCache(50)
+
+        def work(offset):
+            for i in range(1000):
+                cache.set((offset + i) % 80, i)
+                cache.get((offset + i * 7) % 80)
+
+        threads = [threading.Thread(target=work, args=(n * 13,))
+                   for n in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(50, len(cache))
+        self.assertEqual(50, cache.size)
+
+
+class FileCacheTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmpdir, 'file')
+        open(self.path, 'w').write('foo')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_value_is_valid_for_unchanged_file(self):
+        cache = FileCache(10)
+        cache.store(self.path, file_signature(self.path), 'value')
+        self.assertEqual(
+            'value', cache.lookup(self.path, file_signature(self.path)))
+        self.assertEqual(1, cache.hits)
+
+    def test_value_is_stale_after_file_changed(self):
+        cache = FileCache(10)
+        cache.store(self.path, file_signature(self.path), 'value')
+        open(self.path, 'w').write('foobar')
+        self.assertEqual(
+            None, cache.lookup(self.path, file_signature(self.path)))
+        self.assertEqual(0, cache.hits)
+        self.assertEqual(1, cache.misses)
+
+
+class SharedResponseCacheTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.file_path = os.path.join(self.tmpdir, 'cache')
+        self.caches = []
+
+    def tearDown(self):
+        for cache in self.caches:
+            cache.close()
+        shutil.rmtree(self.tmpdir)
+
+    def cache(self, max_size=4000, slot_size=1000):
+        cache = SharedResponseCache(self.file_path, max_size, slot_size)
+        self.caches.append(cache)
+        return cache
+
+    def response(self, body):
+        return ('200 OK', [('Content-Type', 'text/plain')], [body])
+
+    def test_stored_responses_can_be_retrieved(self):
+        cache = self.cache()
+        cache.store(('/foo', ''), ('200 OK', [('X-Foo', 'bar')],
+                                   ['foo', 'bar']), 60)
+        self.assertEqual(('200 OK', [('X-Foo', 'bar')], ['foobar']),
+                         cache.lookup(('/foo', '')))
+        self.assertEqual(None, cache.lookup(('/bar', '')))
+        self.assertEqual(dict(hits=1, misses=1, entries=1, size=cache.stats()[
+                    'size']), cache.stats())
+        self.assertEqual(1, len(cache))
+
+    def test_responses_expire(self):
+        cache = self.cache()
+        cache.store('foo', self.response('foo'), 0.0001)
+        time.sleep(0.01)
+        self.assertEqual(None, cache.lookup('foo'))
+        self.assertEqual(0, len(cache))
+
+    def test_storing_again_replaces_the_response(self):
+        cache = self.cache()
+        cache.store('foo', self.response('foo'), 60)
+        cache.store('foo', self.response('bar'), 60)
+        self.assertEqual(['bar'], cache.lookup('foo')[2])
+        self.assertEqual(1, len(cache))
+
+    def test_least_recently_used_responses_are_dropped_first(self):
+        cache = self.cache()
+        self.assertEqual((1, 4), (cache.sets, cache.ways))
+        for key in 'abcd':
+            cache.store(key, self.response(key), 60)
+        cache.lookup('a')
+        cache.store('e', self.response('e'), 60)
+        self.assertEqual(None, cache.lookup('b'))
+        for key in 'acde':
+            self.assertEqual([key], cache.lookup(key)[2])
+
+    def test_responses_larger_than_a_slot_are_not_stored(self):
+        cache = self.cache()
+        cache.store('foo', self.response('x' * 1000), 60)
+        self.assertEqual(None, cache.lookup('foo'))
+
+    def test_cache_is_shared_by_processes(self):
+        cache = self.cache()
+        pid = os.fork()
+        if not pid:
+            try:
+                other = SharedResponseCache(self.file_path, 4000, 1000)
+                other.store('foo', self.response('child'), 60)
+            finally:
+                os._exit(0)
+        os.waitpid(pid, 0)
+        self.assertEqual(['child'], cache.lookup('foo')[2])
+
+    def test_file_is_reinitialized_for_other_parameters(self):
+        self.cache().store('foo', self.response('foo'), 60)
+        cache = self.cache(max_size=8000)
+        self.assertEqual(None, cache.lookup('foo'))
+
+    def test_clear(self):
+        cache = self.cache()
+        cache.store('foo', self.response('foo'), 60)
+        cache.clear()
+        self.assertEqual(None, cache.lookup('foo'))
+
+
+class NegativeCacheTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.file_path = os.path.join(self.tmpdir, 'missing')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_entries_are_trusted_within_ttl(self):
+        cache = NegativeCache(10, ttl=60)
+        self.assertFalse(cache.lookup('foo'))
+        cache.store('foo', {self.file_path: None})
+        open(self.file_path, 'w').write('')
+        self.assertTrue(cache.lookup('foo'))
+        self.assertEqual(dict(hits=1, misses=1, entries=1, size=1),
+                         cache.stats())
+
+    def test_entries_are_validated_after_ttl(self):
+        cache = NegativeCache(10, ttl=0)
+        cache.store('foo', {self.file_path: None})
+        self.assertTrue(cache.lookup('foo'))
+        open(self.file_path, 'w').write('')
+        self.assertFalse(cache.lookup('foo'))
+        self.assertNotIn('foo', cache)
+
+    def test_concurrent_lookups_are_all_counted(self):
+        cache = NegativeCache(10, ttl=0)
+        cache.store('foo', {self.file_path: None})
+
+        def work():
+            for i in xrange(1000):
+                cache.lookup('foo')
+
+        threads = [threading.Thread(target=work) for n in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(dict(hits=8000, misses=0, entries=1, size=1),
+                         cache.stats())
+
+
+class RenderCacheTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.cache = RenderCache(os.path.join(self.tmpdir, 'cache'))
+        self.input_path = os.path.join(self.tmpdir, 'page.html')
+        open(self.input_path, 'w').write('page')
+        self.dependencies = {
+            self.input_path: file_signature(self.input_path),
+            os.path.join(self.tmpdir, '__init__'): None,
+            }
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_stored_pages_can_be_looked_up(self):
+        self.cache.store(('/page.html', ''), (
+                '200 OK', [('Content-Type', 'text/html')], ['foo', 'bar']),
+                         self.dependencies)
+        status, headers, body_path = self.cache.lookup(('/page.html', ''))
+        self.assertEqual('200 OK', status)
+        self.assertEqual([('Content-Type', 'text/html')], headers)
+        self.assertEqual('foobar', open(
+                os.path.join(self.cache.directory, body_path)).read())
+        self.assertEqual(None, self.cache.lookup(('/other.html', '')))
+        self.assertEqual(dict(hits=1, misses=1), self.cache.stats())
+
+    def test_pages_expire(self):
+        self.cache.store('foo', ('200 OK', [], ['foo']), {}, 0.0001)
+        time.sleep(0.01)
+        self.assertEqual(None, self.cache.lookup('foo'))
+
+    def test_changed_dependencies_invalidate_pages(self):
+        self.cache.store('foo', ('200 OK', [], ['foo']), self.dependencies)
+        os.remove(self.input_path)
+        self.assertEqual(None, self.cache.lookup('foo'))
+
+    def test_restored_page_leaves_the_previous_body_alone(self):
+        self.cache.store('foo', ('200 OK', [], ['first']), {})
+        first = os.path.join(self.cache.directory, self.cache.lookup('foo')[2])
+        self.cache.store('foo', ('200 OK', [], ['second']), {})
+        second = os.path.join(
+            self.cache.directory, self.cache.lookup('foo')[2])
+        self.assertNotEqual(first, second)
+        self.assertEqual('first', open(first).read())
+        self.assertEqual('second', open(second).read())
+
+        self.cache.store('foo', ('200 OK', [], ['third']), {})
+        self.assertFalse(os.path.exists(first))
+        self.assertTrue(os.path.exists(second))
+        self.assertEqual(3, len(os.listdir(os.path.dirname(second))))
+
+
+class TemplateCacheTest(unittest.TestCase):
+
+    def setUp(self):
+        ophelia.pagetemplate.template_cache.clear()
+        self.tmpdir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmpdir, 'file')
+        open(self.path, 'w').write('<p>foo</p>')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_template_is_cooked_only_once(self):
+        first = ophelia.pagetemplate.get_template(u'<p>foo</p>', self.path)
+        second = ophelia.pagetemplate.get_template(u'<p>foo</p>', self.path)
+        self.assertIsNot(first, second)
+        self.assertIs(first._v_program, second._v_program)
+        self.assertEqual(u'<p>foo</p>', second())
+
+    def test_changed_text_is_cooked_again(self):
+        ophelia.pagetemplate.get_template(u'<p>foo</p>', self.path)
+        template = ophelia.pagetemplate.get_template(u'<p>bar</p>', self.path)
+        self.assertEqual(u'<p>bar</p>', template())
+
+    def test_writing_to_a_template_leaves_the_cached_one_alone(self):
+        template = ophelia.pagetemplate.get_template(u'<p>foo</p>', self.path)
+        template.write(u'<p>bar</p>')
+        template = ophelia.pagetemplate.get_template(u'<p>foo</p>', self.path)
+        self.assertEqual(u'<p>foo</p>', template())
@@ -0,0 +1,177 @@
+# Copyright (c) 2013 Thomas Lotze
+# See also LICENSE.txt
+
+from ophelia.tests.helpers import get, write
+import StringIO
+import __builtin__
+import ophelia.frozen
+import ophelia.request
+import ophelia.wsgi
+import os
+import os.path
+import shutil
+import signal
+import tempfile
+import time
+
+try:
+    import unittest2 as unittest
+except ImportError:
+    import unittest
+
+
+class FrozenTreeTest(unittest.TestCase):
+
+    def setUp(self):
+        self.template_root = tempfile.mkdtemp()
+        os.mkdir(os.path.join(self.template_root, 'folder'))
+        self.write('__init__', '<div tal:replace="structure innerslot" />')
+        self.write('folder/page.html', """\
+title = u'Page'
+<?xml?>
+<p tal:content="title" />
+""")
+        self.write('folder/other.html', '<p>other</p>')
+        os.symlink(os.path.join(self.template_root, 'folder'),
+                   os.path.join(self.template_root, 'link'))
+
+    def tearDown(self):
+        shutil.rmtree(self.template_root)
+
+    def write(self, path, content):
+        write(os.path.join(self.template_root, path), content)
+
+    def path(self, *parts):
+        return os.path.join(self.template_root, *parts)
+
+    def test_directories_and_files_are_loaded(self):
+        tree = ophelia.frozen.FrozenTree(self.template_root)
+        self.assertEqual({
+                '__init__': ophelia.request.FILE,
+                'folder': ophelia.request.DIRECTORY,
+                'link': ophelia.request.DIRECTORY,
+                }, tree.list_directory(self.template_root))
+        self.assertEqual(
+            ophelia.request.list_directory(self.path('link')),
+            tree.list_directory(self.path('link')))
+        self.assertEqual(5, len(tree.files))
+        self.assertEqual(ophelia.request.FILE,
+                         tree.kind(self.path('folder', '..', '__init__')))
+        self.assertIsNone(tree.list_directory(self.path('missing')))
+        self.assertRaises(OSError, tree.file_signature,
+                          self.path('missing.html'))
+
+    def test_files_are_split_compiled_and_cooked_when_loading(self):
+        tree = ophelia.frozen.FrozenTree(self.template_root)
+        entry = tree.files[self.path('folder', 'page.html')]
+        self.assertEqual(1, len(entry.parts))
+        self.assertEqual(1, len(entry.codes))
+        self.assertEqual(1, len(entry.templates))
+        self.assertEqual([], tree.errors)
+
+    def test_errors_are_reported(self):
+        self.write('broken.html', '<p tal:content="foo bar" />')
+        tree = ophelia.frozen.FrozenTree(self.template_root)
+        self.assertEqual(1, len(tree.errors))
+        self.assertEqual(self.path('broken.html'), tree.errors[0][0])
+
+    def test_memory_usage_is_estimated(self):
+        tree = ophelia.frozen.FrozenTree(self.template_root)
+        content = sum(len(entry.content) for entry in tree.files.values())
+        self.assertGreater(tree.size, content)
+        self.write('large.html', '<p>%s</p>' % ('x' * 100000))
+        self.assertGreater(
+            ophelia.frozen.FrozenTree(self.template_root).size,
+            tree.size + 100000)
+
+    def test_traversal_doesnt_look_at_the_file_system(self):
+        self.write('__init__', """\
+if __request__.tail == ['relative.html']:
+    __request__.next_name = 'folder/../link/other.html'
+<?xml?>
+<div tal:replace="structure innerslot" />
+""")
+        tree = ophelia.frozen.FrozenTree(self.template_root)
+
+        def request(path):
+            return ophelia.request.Request(
+                path, self.template_root, 'http://localhost/',
+                **{'wsgi.input': StringIO.StringIO(), 'ophelia.tree': tree})
+
+        def fail(*args):
+            raise AssertionError('file system access %r' % (args,))
+        saved = os.stat, os.lstat, os.listdir, __builtin__.open
+        os.stat = os.lstat = os.listdir = __builtin__.open = fail
+        try:
+            headers, content = request('folder/page.html')()
+            self.assertIn('<p>Page</p>', content)
+            headers, content = request('link/other.html')()
+            self.assertIn('<p>other</p>', content)
+            headers, content = request('relative.html')()
+            self.assertIn('<p>other</p>', content)
+            self.assertRaises(ophelia.request.NotFound,
+                              request('folder/missing.html'))
+        finally:
+            os.stat, os.lstat, os.listdir, __builtin__.open = saved
+
+
+class FrozenApplicationTest(unittest.TestCase):
+
+    def setUp(self):
+        self.template_root = tempfile.mkdtemp()
+        self.write('page.html', '<p>page</p>')
+        self.app = ophelia.wsgi.Application({
+                'site': 'http://localhost/',
+                'template_root': self.template_root,
+                'not_found_cache_size': '100',
+                'metrics_path': '/_metrics',
+                'frozen': 'on',
+                })
+
+    def tearDown(self):
+        shutil.rmtree(self.template_root)
+
+    def write(self, path, content):
+        write(os.path.join(self.template_root, path), content)
+
+    def get(self, path):
+        status, headers, body = get(self.app, path)
+        return status, ''.join(body).split('?>\n')[-1]
+
+    def test_frozen_mode_is_off_by_default(self):
+        app = ophelia.wsgi.Application({
+                'site': 'http://localhost/',
+                'template_root': self.template_root,
+                })
+        self.assertIsNone(app.tree)
+
+    def test_changes_take_effect_when_the_tree_is_reloaded(self):
+        self.assertEqual(('200 OK', '<p>page</p>'), self.get('/page.html'))
+        self.write('page.html', '<p>changed</p>')
+        self.write('new.html', '<p>new</p>')
+        self.assertEqual('404 Not found', self.get('/new.html')[0])
+        self.assertEqual(('200 OK', '<p>page</p>'), self.get('/page.html'))
+        self.app.load_tree()
+        self.assertEqual(('200 OK', '<p>changed</p>'), self.get('/page.html'))
+        self.assertEqual(('200 OK', '<p>new</p>'), self.get('/new.html'))
+
+    def test_tree_is_reloaded_on_signal(self):
+        tree = self.app.tree
+        saved = signal.getsignal(signal.SIGUSR1)
+        try:
+            self.app.reload_on_signal('USR1')
+            os.kill(os.getpid(), signal.SIGUSR1)
+            deadline = time.time() + 5
+            while self.app.tree is tree and time.time() < deadline:
+                time.sleep(0.01)
+        finally:
+            signal.signal(signal.SIGUSR1, saved)
+        self.assertIsNot(tree, self.app.tree)
+        self.assertRaises(ValueError, self.app.reload_on_signal, 'FOO')
+
+    def test_memory_usage_is_reported(self):
+        status, body = self.get('/_metrics')
+        lines = body.splitlines()
+        self.assertIn('ophelia_frozen_tree_files 1', lines)
+        self.assertIn(
+            'ophelia_frozen_tree_bytes %s' % self.app.tree.size, lines)
@@ -0,0 +1,67 @@
+# Copyright (c) 2013 Thomas Lotze
+# See also LICENSE.txt
+
+from ophelia.input import Splitter, compile_script, code_cache
+import os
+import os.path
+import shutil
+import sys
+import tempfile
+import traceback
+
+try:
+    import unittest2 as unittest
+except ImportError:
+    import unittest
+
+
+class CompileScriptTest(unittest.TestCase):
+
+    def setUp(self):
+        code_cache.clear()
+        self.tmpdir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmpdir, 'input.html')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def compile(self, content, **kw):
+        open(self.path, 'w').write(content)
+        parts = Splitter().split(content)
+        return compile_script(
+            parts.script, self.path, parts.script_offset, **kw)
+
+    def raising_line(self, code):
+        try:
+            exec code in {}
+        except ZeroDivisionError:
+            return traceback.extract_tb(sys.exc_info()[2])[-1][1]
+
+    def test_traceback_refers_to_line_of_input_file(self):
+        code = self.compile('\n\n# coding: ascii\nx = 1\n1/0\n<?xml?>\n')
+        self.assertEqual(5, self.raising_line(code))
+
+    def test_code_is_loaded_from_cache_directory(self):
+        cache_dir = os.path.join(self.tmpdir, 'cache')
+        self.compile('\n1/0\n<?xml?>\n', cache_dir=cache_dir)
+        code_cache.clear()
+        hits = code_cache.hits
+        code = self.compile('\n1/0\n<?xml?>\n', cache_dir=cache_dir)
+        self.assertEqual(hits, code_cache.hits)
+        self.assertEqual(2, self.raising_line(code))
+
+    def test_stale_code_in_cache_directory_is_ignored(self):
+        cache_dir = os.path.join(self.tmpdir, 'cache')
+        self.compile('x = 1\n<?xml?>\n', cache_dir=cache_dir)
+        code_cache.clear()
+        code = self.compile('\n1/0\n<?xml?>\n', cache_dir=cache_dir)
+        self.assertEqual(2, self.raising_line(code))
+
+    def test_unreadable_cache_file_is_ignored(self):
+        cache_dir = os.path.join(self.tmpdir, 'cache')
+        self.compile('x = 1\n<?xml?>\n', cache_dir=cache_dir)
+        for name in os.listdir(cache_dir):
+            open(os.path.join(cache_dir, name), 'w').write('garbage')
+        code_cache.clear()
+        code = self.compile('1/0\n<?xml?>\n', cache_dir=cache_dir)
+        self.assertEqual(1, self.raising_line(code))
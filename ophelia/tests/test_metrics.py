@@ -0,0 +1,87 @@
+# Copyright (c) 2013 Thomas Lotze
+# See also LICENSE.txt
+
+import ophelia.cache
+import ophelia.metrics
+import threading
+
+try:
+    import unittest2 as unittest
+except ImportError:
+    import unittest
+
+
+class MetricsTest(unittest.TestCase):
+
+    def setUp(self):
+        self.metrics = ophelia.metrics.Metrics(
+            buckets=(0.1, 1), max_segments=2)
+
+    def lines(self, *args):
+        return self.metrics.render(*args).splitlines()
+
+    def test_requests_are_counted_by_status(self):
+        self.metrics.observe('/foo', '200 OK', 0.05)
+        self.metrics.observe('/bar', '200 OK', 0.05)
+        self.metrics.observe('/foo', '404 Not found', 0.05)
+        lines = self.lines()
+        self.assertIn('ophelia_requests_total{status="200"} 2', lines)
+        self.assertIn('ophelia_requests_total{status="404"} 1', lines)
+
+    def test_latency_histogram_is_cumulative(self):
+        self.metrics.observe('/foo/bar.html', '200 OK', 0.05)
+        self.metrics.observe('/foo/', '200 OK', 0.1)
+        self.metrics.observe('/foo', '200 OK', 0.5)
+        self.metrics.observe('/foo', '200 OK', 2)
+        name = 'ophelia_request_duration_seconds'
+        self.assertEqual([
+                '%s_bucket{segment="/foo",le="0.1"} 2' % name,
+                '%s_bucket{segment="/foo",le="1"} 3' % name,
+                '%s_bucket{segment="/foo",le="+Inf"} 4' % name,
+                '%s_sum{segment="/foo"} 2.65' % name,
+                '%s_count{segment="/foo"} 4' % name,
+                ], [line for line in self.lines()
+                    if line.startswith(name)])
+
+    def test_number_of_histograms_is_limited(self):
+        for path in ('/', '/foo', '/bar', '/baz'):
+            self.metrics.observe(path, '200 OK', 0.5)
+        count = 'ophelia_request_duration_seconds_count'
+        segments = [line.split('"')[1] for line in self.lines()
+                    if line.startswith(count)]
+        self.assertEqual(['/', '/foo', 'other'], segments)
+
+    def test_sendfile_and_errors_are_counted(self):
+        self.metrics.count_sendfile()
+        self.metrics.count_error()
+        self.metrics.count_error()
+        lines = self.lines()
+        self.assertIn('ophelia_sendfile_total 1', lines)
+        self.assertIn('ophelia_errors_total 2', lines)
+
+    def test_cache_hits_are_reported(self):
+        cache = ophelia.cache.LRUCache()
+        cache.set('foo', 1)
+        for key in ('foo', 'foo', 'foo', 'bar'):
+            cache.get(key)
+        lines = self.lines([('test', cache), ('absent', None)])
+        self.assertIn('ophelia_cache_hits_total{cache="test"} 3', lines)
+        self.assertIn('ophelia_cache_misses_total{cache="test"} 1', lines)
+        self.assertIn('ophelia_cache_hit_ratio{cache="test"} 0.75', lines)
+        self.assertFalse([line for line in lines if 'absent' in line])
+
+    def test_labels_are_escaped(self):
+        self.metrics.observe('/a"b\\c\n', '200 OK', 0.5)
+        self.assertIn('segment="/a\\"b\\\\c\\n"', self.metrics.render())
+
+    def test_counting_is_thread_safe(self):
+        def observe():
+            for i in range(1000):
+                self.metrics.observe('/foo', '200 OK', 0.05)
+        threads = [threading.Thread(target=observe) for i in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertIn('ophelia_requests_total{status="200"} 8000',
+                      self.lines())
@@ -0,0 +1,168 @@
+# Copyright (c) 2013 Thomas Lotze
+# See also LICENSE.txt
+
+from ophelia.tests.helpers import write
+import StringIO
+import ophelia.pagetemplate
+import ophelia.request
+import os
+import os.path
+import shutil
+import sys
+import tempfile
+import zope.exceptions.exceptionformatter
+
+try:
+    import unittest2 as unittest
+except ImportError:
+    import unittest
+
+
+class DirectoryListingTest(unittest.TestCase):
+
+    def setUp(self):
+        self.template_root = tempfile.mkdtemp()
+        os.mkdir(os.path.join(self.template_root, 'folder'))
+        self.write('__init__', '<div tal:replace="structure innerslot" />')
+        self.write('folder/page.html', '<p>page</p>')
+        self.write('folder/other.html', '<p>other</p>')
+        os.symlink(os.path.join(self.template_root, 'folder'),
+                   os.path.join(self.template_root, 'link'))
+        os.symlink(os.path.join(self.template_root, 'nonexistent'),
+                   os.path.join(self.template_root, 'broken'))
+
+    def tearDown(self):
+        shutil.rmtree(self.template_root)
+
+    def write(self, path, content):
+        write(os.path.join(self.template_root, path), content)
+
+    def request(self, path):
+        return ophelia.request.Request(
+            path, self.template_root, 'http://localhost/',
+            **{'wsgi.input': StringIO.StringIO()})
+
+    def test_list_directory(self):
+        self.assertEqual({
+                '__init__': ophelia.request.FILE,
+                'folder': ophelia.request.DIRECTORY,
+                'link': ophelia.request.DIRECTORY,
+                }, ophelia.request.list_directory(self.template_root))
+        self.assertEqual(
+            None, ophelia.request.list_directory(
+                os.path.join(self.template_root, 'nonexistent')))
+        self.assertEqual(
+            None, ophelia.request.list_directory(
+                os.path.join(self.template_root, '__init__')))
+
+    def test_listing_is_cached_until_directory_changes(self):
+        cache = ophelia.request.directory_cache
+        ophelia.request.list_directory(self.template_root)
+        hits = cache.hits
+        ophelia.request.list_directory(self.template_root)
+        self.assertEqual(hits + 1, cache.hits)
+        self.write('new.html', '')
+        self.assertIn(
+            'new.html', ophelia.request.list_directory(self.template_root))
+
+    def test_traversal_uses_listings(self):
+        headers, content = self.request('folder/page.html')()
+        self.assertIn('<p>page</p>', content)
+        headers, content = self.request('link/other.html')()
+        self.assertIn('<p>other</p>', content)
+        self.assertRaises(ophelia.request.NotFound,
+                          self.request('folder/missing.html'))
+        self.assertRaises(ophelia.request.NotFound,
+                          self.request('broken/page.html'))
+
+    def test_added_file_is_found(self):
+        self.assertRaises(ophelia.request.NotFound,
+                          self.request('folder/new.html'))
+        self.write('folder/new.html', '<p>new</p>')
+        headers, content = self.request('folder/new.html')()
+        self.assertIn('<p>new</p>', content)
+
+    def test_scripts_may_set_relative_paths_as_next_name(self):
+        self.write('__init__', """\
+__request__.next_name = 'folder/page.html'
+<?xml?>
+<div tal:replace="structure innerslot" />
+""")
+        headers, content = self.request('anything.html')()
+        self.assertIn('<p>page</p>', content)
+
+
+class TemplateErrorTest(unittest.TestCase):
+
+    def setUp(self):
+        self.template_root = tempfile.mkdtemp()
+        open(os.path.join(self.template_root, 'page.html'), 'w').write("""\
+title = u'Page'
+<?xml?>
+<p tal:content="python:title + 1" />
+""")
+
+    def tearDown(self):
+        shutil.rmtree(self.template_root)
+
+    def test_traceback_lists_names(self):
+        request = ophelia.request.Request(
+            'page.html', self.template_root, 'http://localhost/',
+            **{'wsgi.input': StringIO.StringIO()})
+        try:
+            request()
+        except TypeError:
+            msg = ''.join(zope.exceptions.exceptionformatter.format_exception(
+                    *sys.exc_info()))
+        else:
+            self.fail('rendering should have failed')
+        self.assertIn('   - Names:', msg)
+        self.assertIn("'title': u'Page'", msg)
+        self.assertNotIn("'modules'", msg)
+        self.assertNotIn('KeyError', msg)
+
+
+class IncrementalEncodingTest(unittest.TestCase):
+
+    def setUp(self):
+        self.template_root = tempfile.mkdtemp()
+        open(os.path.join(self.template_root, 'page.html'), 'w').write("""\
+__request__.response_headers['X-Chunks'] = \\
+    'python:str(len(__request__.content))'
+__request__.response_headers['X-Length'] = \\
+    'python:str(sum(map(len, __request__.content)))'
+<?xml?>
+<p>page</p>
+""")
+
+    def tearDown(self):
+        shutil.rmtree(self.template_root)
+
+    def request(self, **env):
+        env['wsgi.input'] = StringIO.StringIO()
+        return ophelia.request.Request(
+            'page.html', self.template_root, 'http://localhost/', **env)
+
+    def test_content_is_a_list_of_chunks(self):
+        headers, content = self.request(incremental_encoding='on')()
+        self.assertIsInstance(content, list)
+        self.assertEqual(str(len(''.join(content))), headers['X-Length'])
+        self.assertEqual(str(len(content)), headers['X-Chunks'])
+        plain_headers, plain_content = self.request()()
+        self.assertEqual(plain_content, ''.join(content))
+        self.assertEqual(headers['X-Length'], plain_headers['X-Chunks'])
+
+    def test_template_is_interpreted_right_into_the_stream(self):
+        template = ophelia.pagetemplate.PageTemplate(
+            u'<div><p tal:content="title" /><p>text</p></div>', '/page.html')
+
+        class Stream(object):
+            def __init__(self):
+                self.chunks = []
+            def write(self, chunk):
+                self.chunks.append(chunk)
+
+        stream = Stream()
+        template.render_to(stream, title=u'Title')
+        self.assertGreater(len(stream.chunks), 1)
+        self.assertEqual(template(title=u'Title'), u''.join(stream.chunks))
@@ -0,0 +1,203 @@
+# Copyright (c) 2013 Thomas Lotze
+# See also LICENSE.txt
+
+import httplib
+import ophelia.server
+import ophelia.wsgi
+import os.path
+import pkg_resources
+import threading
+import time
+
+try:
+    import unittest2 as unittest
+except ImportError:
+    import unittest
+
+
+FIXTURES = pkg_resources.resource_filename('ophelia', 'tests/fixtures')
+
+
+class ServerTest(unittest.TestCase):
+
+    threads = 4
+    queue_size = 10
+
+    def setUp(self):
+        self.server = ophelia.server.ThreadPoolServer(
+            ('127.0.0.1', 0), self.app, self.threads, self.queue_size,
+            keep_alive_timeout=1)
+        self.server.RequestHandlerClass.log_message = lambda *args: None
+        self.thread = threading.Thread(
+            target=self.server.serve_forever, kwargs=dict(poll_interval=0.05))
+        self.thread.start()
+        self.port = self.server.server_address[1]
+
+    def tearDown(self):
+        del self.server.RequestHandlerClass.log_message
+        self.shutdown()
+
+    def shutdown(self):
+        if self.thread.is_alive():
+            self.server.shutdown()
+            self.thread.join()
+            self.server.stop()
+
+    def connect(self):
+        return httplib.HTTPConnection('127.0.0.1', self.port, timeout=5)
+
+    def get(self, path='/'):
+        connection = self.connect()
+        connection.request('GET', path)
+        response = connection.getresponse()
+        return response.status, response.read()
+
+
+class Barrier(object):
+    """Lets threads wait until a number of them have arrived.
+
+    Once they have, waiting doesn't block any more.
+    """
+
+    def __init__(self, parties, timeout=5):
+        self.parties = parties
+        self.timeout = timeout
+        self.arrived = 0
+        self.condition = threading.Condition()
+
+    def wait(self):
+        with self.condition:
+            self.arrived += 1
+            self.condition.notify_all()
+            deadline = time.time() + self.timeout
+            while self.arrived < self.parties:
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    raise RuntimeError('Only %s of %s threads arrived.' % (
+                            self.arrived, self.parties))
+                self.condition.wait(remaining)
+
+
+class ConcurrentRequestTest(ServerTest):
+
+    def app(self, env, start_response):
+        return self.ophelia_app(env, start_response)
+
+    def setUp(self):
+        self.barrier = Barrier(self.threads)
+        self.ophelia_app = ophelia.wsgi.Application({
+                'site': 'http://localhost/',
+                'template_root': os.path.join(FIXTURES, 'threads'),
+                'document_root': os.path.join(FIXTURES, 'documents'),
+                'ophelia.barrier': self.barrier,
+                })
+        super(ConcurrentRequestTest, self).setUp()
+
+    def test_each_thread_sees_its_own_request(self):
+        results = {}
+
+        def get(i):
+            results[i] = self.get('/page.html?%s' % i)
+
+        threads = [threading.Thread(target=get, args=(i,))
+                   for i in range(2 * self.threads)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        # pages only render once all worker threads are rendering at once
+        for i in range(2 * self.threads):
+            status, body = results[i]
+            self.assertEqual(200, status)
+            self.assertIn('<p>%s</p><p>True</p>' % i, body)
+        self.assertEqual(2 * self.threads, self.barrier.arrived)
+
+
+class KeepAliveTest(ServerTest):
+
+    def app(self, env, start_response):
+        body = env['PATH_INFO']
+        headers = [('Content-Type', 'text/plain')]
+        if env['QUERY_STRING'] != 'unknown-length':
+            headers.append(('Content-Length', str(len(body))))
+        start_response('200 OK', headers)
+        return iter([body])
+
+    def test_connection_is_reused(self):
+        connection = self.connect()
+        for path in ('/foo', '/bar'):
+            connection.request('GET', path)
+            response = connection.getresponse()
+            self.assertEqual(path, response.read())
+            self.assertEqual(11, response.version)
+            self.assertIsNone(response.getheader('connection'))
+
+    def test_connection_is_closed_if_asked_to(self):
+        connection = self.connect()
+        connection.request('GET', '/foo', headers={'Connection': 'close'})
+        response = connection.getresponse()
+        self.assertEqual('close', response.getheader('connection'))
+        self.assertEqual('/foo', response.read())
+
+    def test_connection_is_closed_without_content_length(self):
+        connection = self.connect()
+        connection.request('GET', '/foo?unknown-length')
+        response = connection.getresponse()
+        self.assertEqual('close', response.getheader('connection'))
+        self.assertEqual('/foo', response.read())
+
+
+class BlockingServerTest(ServerTest):
+
+    threads = 1
+    queue_size = 1
+
+    def app(self, env, start_response):
+        self.entered.set()
+        self.release.wait(5)
+        start_response('200 OK', [('Content-Type', 'text/plain'),
+                                  ('Content-Length', '2')])
+        return ['ok']
+
+    def setUp(self):
+        self.entered = threading.Event()
+        self.release = threading.Event()
+        super(BlockingServerTest, self).setUp()
+
+    def tearDown(self):
+        self.release.set()
+        super(BlockingServerTest, self).tearDown()
+
+    def start_request(self):
+        connection = self.connect()
+        connection.request('GET', '/')
+        return connection
+
+    def test_connections_beyond_queue_size_are_rejected(self):
+        first = self.start_request()
+        self.assertTrue(self.entered.wait(5) or self.entered.is_set())
+        second = self.start_request()
+        for i in range(100):
+            if self.server.connections.qsize():
+                break
+            time.sleep(0.01)
+        status, body = self.get()
+        self.assertEqual(503, status)
+        self.release.set()
+        self.assertEqual('ok', first.getresponse().read())
+        self.assertEqual('ok', second.getresponse().read())
+
+    def test_shutdown_finishes_accepted_requests(self):
+        first = self.start_request()
+        self.assertTrue(self.entered.wait(5) or self.entered.is_set())
+        shutdown = threading.Thread(target=self.shutdown)
+        shutdown.start()
+        time.sleep(0.1)
+        self.release.set()
+        response = first.getresponse()
+        self.assertEqual('ok', response.read())
+        self.assertEqual('close', response.getheader('connection'))
+        shutdown.join()
+        self.assertFalse(any(worker.is_alive()
+                             for worker in self.server.workers))
@@ -0,0 +1,106 @@
+# Copyright (c) 2013 Thomas Lotze
+# See also LICENSE.txt
+
+import StringIO
+import ophelia.request
+import ophelia.timing
+import os.path
+import pkg_resources
+
+try:
+    import unittest2 as unittest
+except ImportError:
+    import unittest
+
+
+FIXTURES = pkg_resources.resource_filename('ophelia', 'tests/fixtures')
+
+
+class FakeClock(object):
+
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+    def advance(self, seconds):
+        self.now += seconds
+
+
+class TimerTest(unittest.TestCase):
+
+    def test_nested_phases_are_not_counted_towards_enclosing_phase(self):
+        clock = FakeClock()
+        timer = ophelia.timing.Timer(None, clock=clock)
+        with timer('script', 'outer'):
+            clock.advance(0.25)
+            with timer('render', 'inner'):
+                clock.advance(0.5)
+            clock.advance(0.125)
+        self.assertEqual([('render', 'inner', 0.5),
+                          ('script', 'outer', 0.375)], timer.timings)
+        self.assertEqual({'render': 0.5, 'script': 0.375}, timer.totals())
+
+    def test_hooks_are_called_for_each_phase(self):
+        calls = []
+        timer = ophelia.timing.Timer(
+            'request', [lambda *args: calls.append(args)])
+        with timer('read', 'file'):
+            pass
+        self.assertEqual([('request', 'read', 'file')],
+                         [call[:3] for call in calls])
+
+    def test_duration_is_recorded_if_phase_fails(self):
+        timer = ophelia.timing.Timer(None)
+        try:
+            with timer('script'):
+                raise ValueError
+        except ValueError:
+            pass
+        self.assertEqual(['script'], timer.totals().keys())
+
+    def test_null_timer_records_nothing(self):
+        timer = ophelia.timing.null_timer
+        with timer('read', 'file'):
+            pass
+        self.assertEqual((), timer.timings)
+        self.assertEqual({}, timer.totals())
+
+    def test_server_timing(self):
+        self.assertEqual(
+            'read;dur=1.000, render;dur=20.500, custom;dur=0.001',
+            ophelia.timing.server_timing(
+                {'render': 0.0205, 'custom': 0.000001, 'read': 0.001}))
+
+
+class RequestTimingTest(unittest.TestCase):
+
+    def request(self, **env):
+        env.update({'wsgi.input': StringIO.StringIO()})
+        return ophelia.request.Request(
+            'smoke.html', os.path.join(FIXTURES, 'templates'),
+            'http://localhost/', **env)
+
+    def test_timing_is_off_by_default(self):
+        request = self.request()
+        request()
+        self.assertIs(ophelia.timing.null_timer, request.timer)
+
+    def test_phases_are_recorded_per_file(self):
+        request = self.request(timing='on')
+        request()
+        file_path = os.path.join(FIXTURES, 'templates', 'smoke.html')
+        phases = [phase for phase, path, duration in request.timer.timings
+                  if path == file_path]
+        for phase in ('cook', 'compile', 'script', 'render'):
+            self.assertIn(phase, phases)
+        self.assertIn('headers', request.timer.totals())
+
+    def test_hooks_passed_through_the_environment_turn_on_timing(self):
+        calls = []
+        request = self.request(**{'ophelia.timing_hooks': [
+                    lambda request, phase, file_path, duration:
+                        calls.append((request, phase))]})
+        request()
+        self.assertIn((request, 'render'), calls)
@@ -1,7 +1,7 @@
 # Copyright (c) 2013 Thomas Lotze
 # See also LICENSE.txt
 
-from ophelia.util import Namespace
+from ophelia.util import Namespace, EncodingWriter, format_exception
 import gc
 import unittest
 
@@ -53,3 +53,46 @@ class NamespaceTest(unittest.TestCase):
         Namespace()
         gc.collect()
         self.assertEqual(before, count_namespaces())
+
+
+class EncodingWriterTest(unittest.TestCase):
+
+    def test_text_is_encoded(self):
+        writer = EncodingWriter('utf-8')
+        writer.write(u'\xdcber')
+        writer.write('schrift')
+        self.assertEqual(['\xc3\x9cberschrift'], writer.close())
+
+    def test_text_is_collected_in_chunks(self):
+        writer = EncodingWriter('utf-8', chunk_size=4)
+        for char in u'abcdefghij':
+            writer.write(char)
+        self.assertEqual(['abcd', 'efgh', 'ij'], writer.close())
+
+    def test_encoded_data_is_kept_in_order(self):
+        writer = EncodingWriter('utf-8')
+        writer.write(u'foo')
+        writer.write_encoded('bar')
+        writer.write(u'baz')
+        self.assertEqual(['foo', 'bar', 'baz'], writer.close())
+
+    def test_encoder_state_is_kept_across_writes(self):
+        writer = EncodingWriter('utf-16')
+        writer.write(u'a')
+        writer.write(u'b')
+        self.assertEqual(u'ab'.encode('utf-16'), ''.join(writer.close()))
+
+
+class FormatExceptionTest(unittest.TestCase):
+
+    def test_traceback_supplement_is_included_and_encoded(self):
+        def fail():
+            __traceback_info__ = u'\xdcberschrift'
+            raise ValueError('broken')
+        try:
+            fail()
+        except ValueError:
+            msg = format_exception()
+        self.assertIsInstance(msg, str)
+        self.assertIn('\xc3\x9cberschrift', msg)
+        self.assertTrue(msg.endswith('ValueError: broken\n'))
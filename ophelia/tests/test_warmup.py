@@ -0,0 +1,112 @@
+# Copyright (c) 2013 Thomas Lotze
+# See also LICENSE.txt
+
+from ophelia.tests.helpers import write
+import logging
+import ophelia.cache
+import ophelia.input
+import ophelia.pagetemplate
+import ophelia.warmup
+import ophelia.wsgi
+import os
+import os.path
+import shutil
+import tempfile
+
+try:
+    import unittest2 as unittest
+except ImportError:
+    import unittest
+
+
+class WarmUpTest(unittest.TestCase):
+
+    def setUp(self):
+        self.template_root = tempfile.mkdtemp()
+        os.mkdir(os.path.join(self.template_root, 'folder'))
+        os.mkdir(os.path.join(self.template_root, '.hidden'))
+        self.write('__init__', """\
+title = u'Site'
+<?xml?>
+<html tal:content="structure innerslot" />
+""")
+        self.write('page.html', '<p tal:content="title" />')
+        self.write('folder/page.html', """\
+x = 1
+<?xml?>
+<p>folder</p>
+""")
+        self.write('folder/page.html~', 'backup')
+        self.write('.hidden/page.html', 'hidden')
+
+    def tearDown(self):
+        shutil.rmtree(self.template_root)
+
+    def write(self, path, content):
+        return write(os.path.join(self.template_root, path), content)
+
+    def test_input_files(self):
+        self.assertEqual(
+            ['__init__', 'page.html', 'folder/page.html'],
+            [os.path.relpath(path, self.template_root) for path in
+             ophelia.warmup.input_files(self.template_root)])
+
+    def test_caches_are_filled(self):
+        result = ophelia.warmup.warm_up(self.template_root)
+        self.assertEqual((3, [], []), result)
+        file_path = os.path.join(self.template_root, 'folder', 'page.html')
+        signature = ophelia.cache.file_signature(file_path)
+        self.assertIsNotNone(
+            ophelia.pagetemplate.template_cache.lookup(file_path, signature))
+        self.assertIsNotNone(
+            ophelia.input.code_cache.lookup(file_path, signature))
+
+    def test_template_errors_are_reported_with_context(self):
+        file_path = self.write('broken.html', """\
+<?xml?>
+<p>
+<p tal:content="foo bar" />
+""")
+        result = ophelia.warmup.warm_up(self.template_root)
+        self.assertEqual(1, len(result.errors))
+        error_path, msg = result.errors[0]
+        self.assertEqual(file_path, error_path)
+        self.assertIn('   3: <p tal:content="foo bar" />', msg)
+
+    def test_script_errors_are_reported(self):
+        file_path = self.write('broken.html', """\
+if
+<?xml?>
+""")
+        result = ophelia.warmup.warm_up(self.template_root)
+        self.assertEqual(file_path, result.errors[0][0])
+        self.assertIn('SyntaxError', result.errors[0][1])
+
+    def test_files_in_other_encodings_are_skipped(self):
+        file_path = self.write('latin1.html', '<p>\xe4</p>')
+        result = ophelia.warmup.warm_up(self.template_root)
+        self.assertEqual([file_path], result.skipped)
+        self.assertEqual([], result.errors)
+
+    def test_application_warms_up_on_request(self):
+        self.write('broken.html', '<p tal:content="foo bar" />')
+        logger = logging.getLogger('ophelia')
+        messages = []
+        handler = logging.Handler()
+        handler.emit = lambda record: messages.append(record.getMessage())
+        logger.addHandler(handler)
+        try:
+            ophelia.wsgi.Application({
+                    'site': 'http://localhost/',
+                    'template_root': self.template_root,
+                    })
+            self.assertEqual([], messages)
+            ophelia.wsgi.Application({
+                    'site': 'http://localhost/',
+                    'template_root': self.template_root,
+                    'warm_up': 'on',
+                    })
+        finally:
+            logger.removeHandler(handler)
+        self.assertEqual(1, len(messages))
+        self.assertIn('broken.html', messages[0])
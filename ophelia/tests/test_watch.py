@@ -0,0 +1,280 @@
+# Copyright (c) 2013 Thomas Lotze
+# See also LICENSE.txt
+
+from ophelia.tests.helpers import get
+import ophelia.cache
+import ophelia.interfaces
+import ophelia.watch
+import ophelia.wsgi
+import os
+import os.path
+import shutil
+import tempfile
+import threading
+import time
+import zope.interface.verify
+
+try:
+    import unittest2 as unittest
+except ImportError:
+    import unittest
+
+
+def wait_for(condition, timeout=5):
+    deadline = time.time() + timeout
+    while not condition() and time.time() < deadline:
+        time.sleep(0.01)
+    return condition()
+
+
+class WatcherTests(object):
+
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        os.mkdir(os.path.join(self.root, 'folder'))
+        self.write('folder/page.html', 'page')
+        self.changes = []
+        self.watcher = self.make_watcher()
+        self.watcher.listeners.append(self.changes.append)
+        self.watcher.start()
+
+    def tearDown(self):
+        self.watcher.stop()
+        shutil.rmtree(self.root)
+
+    def path(self, *parts):
+        return os.path.join(self.root, *parts)
+
+    def write(self, path, content):
+        open(self.path(path), 'w').write(content)
+
+    def assertReported(self, path):
+        self.assertTrue(self.wait_for(lambda: path in self.changes),
+                        '%s not in %s' % (path, self.changes))
+
+    def test_watcher_provides_interface(self):
+        zope.interface.verify.verifyObject(
+            ophelia.interfaces.IWatcher, self.watcher)
+
+    def test_modified_file_is_reported(self):
+        self.write('folder/page.html', 'changed page')
+        self.assertReported(self.path('folder', 'page.html'))
+
+    def test_atomic_rename_is_reported(self):
+        self.write('folder/.page.tmp', 'new page')
+        os.rename(self.path('folder', '.page.tmp'),
+                  self.path('folder', 'page.html'))
+        self.assertReported(self.path('folder', 'page.html'))
+
+    def test_directory_moves_are_reported(self):
+        os.rename(self.path('folder'), self.path('moved'))
+        self.assertReported(self.path('folder'))
+        self.assertReported(self.path('moved'))
+        del self.changes[:]
+        self.write('moved/page.html', 'changed page')
+        self.assertReported(self.path('moved', 'page.html'))
+
+    def test_files_in_new_directories_are_reported(self):
+        os.mkdir(self.path('new'))
+        self.assertReported(self.path('new'))
+        self.write('new/page.html', 'new page')
+        self.assertReported(self.path('new', 'page.html'))
+
+    def test_changes_are_reported_through_symlinks(self):
+        os.symlink(self.path('folder'), self.path('link'))
+        self.assertReported(self.path('link'))
+        del self.changes[:]
+        self.write('folder/page.html', 'changed page')
+        self.assertReported(self.path('folder', 'page.html'))
+        self.assertReported(self.path('link', 'page.html'))
+
+
+@unittest.skipIf(ophelia.watch.load_libc() is None, 'inotify not available')
+class InotifyWatcherTest(WatcherTests, unittest.TestCase):
+
+    def make_watcher(self):
+        return ophelia.watch.InotifyWatcher([self.root])
+
+    def wait_for(self, condition):
+        return wait_for(condition)
+
+    def test_parse_events(self):
+        data = (ophelia.watch.EVENT.pack(1, ophelia.watch.IN_MODIFY, 0, 16) +
+                'page.html'.ljust(16, '\0') +
+                ophelia.watch.EVENT.pack(2, ophelia.watch.IN_IGNORED, 0, 0))
+        self.assertEqual(
+            [(1, ophelia.watch.IN_MODIFY, 'page.html'),
+             (2, ophelia.watch.IN_IGNORED, '')],
+            list(ophelia.watch.parse_events(data)))
+
+
+class PollingWatcherTest(WatcherTests, unittest.TestCase):
+
+    def make_watcher(self):
+        # poll explicitly instead of waiting for the watcher's thread
+        return ophelia.watch.PollingWatcher([self.root], interval=3600)
+
+    def wait_for(self, condition):
+        self.watcher.poll()
+        return condition()
+
+
+class SignatureCacheTest(unittest.TestCase):
+
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.file_path = os.path.join(self.root, 'page.html')
+        open(self.file_path, 'w').write('page')
+        self.cache = ophelia.cache.SignatureCache()
+        self.cache.add_roots([self.root])
+
+    def tearDown(self):
+        shutil.rmtree(self.root)
+
+    def test_signatures_are_kept_until_invalidated(self):
+        signature = self.cache.get(self.file_path)
+        os.rename(self.file_path, self.file_path + '.old')
+        open(self.file_path, 'w').write('new page')
+        self.assertEqual(signature, self.cache.get(self.file_path))
+        self.cache.invalidate(self.file_path)
+        self.assertNotEqual(signature, self.cache.get(self.file_path))
+
+    def test_missing_files_are_remembered(self):
+        missing = os.path.join(self.root, 'missing.html')
+        self.assertRaises(OSError, self.cache.get, missing)
+        open(missing, 'w').write('page')
+        self.assertRaises(OSError, self.cache.get, missing)
+        self.cache.invalidate(missing)
+        self.cache.get(missing)
+
+    def test_number_of_signatures_is_bounded(self):
+        cache = ophelia.cache.SignatureCache(max_size=3)
+        cache.add_roots([self.root])
+        for i in xrange(10):
+            self.assertRaises(OSError, cache.get,
+                              os.path.join(self.root, 'missing%s' % i))
+        cache.get(self.file_path)
+        self.assertEqual(3, len(cache.signatures))
+        self.assertIn(self.file_path, cache.signatures)
+
+    def test_concurrent_lookups_are_all_counted(self):
+        def work():
+            for i in xrange(1000):
+                self.cache.get(self.file_path)
+                if not i % 100:
+                    self.cache.invalidate(self.file_path)
+
+        threads = [threading.Thread(target=work) for n in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(8000, self.cache.hits + self.cache.misses)
+
+    def test_invalidating_a_directory_drops_its_contents_and_parent(self):
+        self.cache.get(self.root)
+        self.cache.get(self.file_path)
+        self.cache.invalidate(self.root)
+        self.assertEqual(0, len(self.cache.signatures))
+        self.cache.get(self.root)
+        self.cache.get(self.file_path)
+        self.cache.invalidate(self.file_path)
+        self.assertEqual(0, len(self.cache.signatures))
+
+    def test_files_outside_the_roots_are_not_cached(self):
+        other = tempfile.mkdtemp()
+        try:
+            self.cache.get(other)
+            self.assertEqual(0, len(self.cache.signatures))
+        finally:
+            os.rmdir(other)
+
+    def test_removing_the_roots_drops_their_signatures(self):
+        self.cache.get(self.file_path)
+        self.cache.remove_roots([self.root])
+        self.assertEqual(0, len(self.cache.signatures))
+        self.cache.get(self.file_path)
+        self.assertEqual(0, len(self.cache.signatures))
+
+
+class ApplicationWatchTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.template_root = os.path.join(self.tmpdir, 'templates')
+        self.document_root = os.path.join(self.tmpdir, 'documents')
+        os.mkdir(self.template_root)
+        os.mkdir(os.path.join(self.template_root, 'folder'))
+        os.mkdir(self.document_root)
+        open(os.path.join(self.template_root, '__init__'), 'w').write(
+            '<div tal:replace="structure innerslot" />')
+        self.write('folder/page.html', '<p>page</p>')
+        open(os.path.join(self.document_root, 'style.css'), 'w').write(
+            'p {}')
+        self.app = ophelia.wsgi.Application({
+                'site': 'http://localhost/',
+                'template_root': self.template_root,
+                'document_root': self.document_root,
+                'not_found_cache_size': '100',
+                'watch': 'on',
+                })
+
+    def tearDown(self):
+        self.app.close()
+        shutil.rmtree(self.tmpdir)
+
+    def write(self, path, content):
+        file_path = os.path.join(self.template_root, path)
+        open(file_path + '.tmp', 'w').write(content)
+        os.rename(file_path + '.tmp', file_path)
+
+    def get(self, path):
+        status, headers, body = get(self.app, path)
+        # leave out the XML declaration of pages
+        return status, ''.join(body).split('?>\n')[-1]
+
+    def test_watching_is_off_by_default(self):
+        app = ophelia.wsgi.Application({
+                'site': 'http://localhost/',
+                'template_root': self.template_root,
+                })
+        self.assertIsNone(app.watcher)
+
+    def test_no_file_system_lookups_in_steady_state(self):
+        for path in ('/folder/page.html', '/style.css', '/missing.html'):
+            self.get(path)
+
+        def fail(*args):
+            raise AssertionError('file system lookup %r' % (args,))
+        saved = os.stat, os.lstat, os.listdir
+        os.stat = os.lstat = os.listdir = fail
+        try:
+            self.assertEqual(('200 OK', '<p>page</p>'),
+                             self.get('/folder/page.html'))
+            self.assertEqual(('200 OK', 'p {}'), self.get('/style.css'))
+            self.assertEqual('404 Not found', self.get('/missing.html')[0])
+        finally:
+            os.stat, os.lstat, os.listdir = saved
+
+    def test_atomically_replaced_file_is_seen(self):
+        self.get('/folder/page.html')
+        self.write('folder/page.html', '<p>new page</p>')
+        self.assertTrue(wait_for(
+                lambda: self.get('/folder/page.html')[1] ==
+                '<p>new page</p>'))
+
+    def test_moved_directory_is_seen(self):
+        self.get('/folder/page.html')
+        os.rename(os.path.join(self.template_root, 'folder'),
+                  os.path.join(self.template_root, 'moved'))
+        self.assertTrue(wait_for(
+                lambda: self.get('/folder/page.html')[0] == '404 Not found'))
+        self.assertEqual(('200 OK', '<p>page</p>'),
+                         self.get('/moved/page.html'))
+
+    def test_added_page_is_seen_despite_not_found_cache(self):
+        self.get('/new.html')
+        self.get('/new.html')
+        self.write('new.html', '<p>new</p>')
+        self.assertTrue(wait_for(
+                lambda: self.get('/new.html') == ('200 OK', '<p>new</p>')))
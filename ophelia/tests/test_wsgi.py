@@ -1,11 +1,21 @@
 # Copyright (c) 2012 Thomas Lotze
 # See also LICENSE.txt
 
+from ophelia.tests.helpers import get, write
+import StringIO
+import gzip
 import logging
+import ophelia.compression
+import ophelia.input
+import ophelia.request
 import ophelia.wsgi
 import os.path
 import pkg_resources
+import shutil
+import tempfile
+import time
 import webtest
+import wsgiref.util
 
 try:
     import unittest2 as unittest
@@ -54,6 +64,22 @@ class BasicApplicationTest(unittest.TestCase):
             '/raise.html', status=500, extra_environ={'debug': 'on'})
         self.assertIn('message', r.body)
 
+    def test_input_cache_sizes_are_configurable(self):
+        caches = (ophelia.input.split_cache, ophelia.input.code_cache)
+        saved = [cache.max_size for cache in caches]
+        try:
+            ophelia.wsgi.Application({
+                    'site': 'http://localhost/',
+                    'template_root': fixture('templates'),
+                    'split_cache_size': '5000',
+                    'code_cache_size': '3000',
+                    })
+            self.assertEqual([5000, 3000],
+                             [cache.max_size for cache in caches])
+        finally:
+            for cache, max_size in zip(caches, saved):
+                cache.max_size = max_size
+
 
 class OnDiskDocumentsTest(unittest.TestCase):
 
@@ -77,6 +103,13 @@ class OnDiskDocumentsTest(unittest.TestCase):
         r = self.app.get('/folder', status=301)
         self.assertEqual('http://localhost/folder/', r.headers['location'])
 
+    def test_on_disk_directories_stay_out_of_the_directory_cache(self):
+        self.app.get('/folder', status=301)
+        self.assertNotIn(fixture('documents', 'folder'),
+                         ophelia.request.directory_cache.entries)
+        self.assertIn(fixture('documents', 'folder'),
+                      ophelia.wsgi.document_directory_cache.entries)
+
     def test_no_redirect_on_disk_directory_with_index_name(self):
         r = self.app.get('/folder/index.html', status=200)
         self.assertIn('<p>Folder index</p>', r.body)
@@ -109,3 +142,880 @@ class OnDiskDocumentsTest(unittest.TestCase):
         self.assertEqual('/-internal-/smoke-document.html',
                          r.headers['x-accel-redirect'])
         self.assertEqual('', r.body)
+
+
+class StaticFilesTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.document_root = os.path.join(self.tmpdir, 'documents')
+        os.mkdir(self.document_root)
+        self.write('style.css', '0123456789')
+        open(os.path.join(self.tmpdir, 'secret'), 'w').write('secret')
+        self.app = ophelia.wsgi.Application({
+                'site': 'http://localhost/',
+                'template_root': fixture('templates'),
+                'document_root': self.document_root,
+                'static_stat_ttl': '60',
+                })
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def write(self, path, content):
+        write(os.path.join(self.document_root, path), content)
+
+    def get(self, path, method='GET', **env):
+        status, headers, body = get(self.app, path, method, **env)
+        return int(status.split()[0]), headers, body
+
+    def test_file(self):
+        status, headers, body = self.get('/style.css')
+        self.assertEqual(200, status)
+        self.assertEqual('0123456789', ''.join(body))
+        self.assertEqual('text/css', headers['content-type'])
+        self.assertEqual('10', headers['content-length'])
+        self.assertEqual('bytes', headers['accept-ranges'])
+        self.assertIn('etag', headers)
+        self.assertIn('last-modified', headers)
+
+    def test_compressed_file_is_served_as_it_is(self):
+        self.write('archive.tar.gz', 'not really gzip')
+        status, headers, body = self.get('/archive.tar.gz')
+        self.assertEqual(200, status)
+        self.assertEqual('not really gzip', ''.join(body))
+        self.assertEqual('application/gzip', headers['content-type'])
+        self.assertNotIn('content-encoding', headers)
+
+    def test_file_wrapper_is_used_if_available(self):
+        status, headers, body = self.get(
+            '/style.css',
+            **{'wsgi.file_wrapper': lambda file_, block_size: ('wrapped',
+                                                               file_)})
+        self.assertEqual('wrapped', body[0])
+        body[1].close()
+
+    def test_head(self):
+        status, headers, body = self.get('/style.css', 'HEAD')
+        self.assertEqual(200, status)
+        self.assertEqual('10', headers['content-length'])
+        self.assertEqual([], body)
+
+    def test_other_methods_are_not_allowed(self):
+        status, headers, body = self.get('/style.css', 'POST')
+        self.assertEqual(405, status)
+        self.assertEqual('GET, HEAD', headers['allow'])
+
+    def test_not_found(self):
+        status, headers, body = self.get('/missing.css')
+        self.assertEqual(404, status)
+
+    def test_files_outside_the_document_root_are_not_served(self):
+        self.assertIsNone(
+            self.app.static_file(self.document_root, '/../secret'))
+        os.symlink(os.path.join(self.tmpdir, 'secret'),
+                   os.path.join(self.document_root, 'link'))
+        status, headers, body = self.get('/link')
+        self.assertEqual(404, status)
+
+    def test_conditional_get(self):
+        status, headers, body = self.get('/style.css')
+        status, headers, body = self.get(
+            '/style.css', HTTP_IF_NONE_MATCH=headers['etag'])
+        self.assertEqual(304, status)
+        self.assertEqual([], body)
+
+    def test_byte_ranges(self):
+        status, headers, body = self.get('/style.css', HTTP_RANGE='bytes=2-4')
+        self.assertEqual(206, status)
+        self.assertEqual('234', ''.join(body))
+        self.assertEqual('bytes 2-4/10', headers['content-range'])
+        self.assertEqual('3', headers['content-length'])
+        status, headers, body = self.get('/style.css', HTTP_RANGE='bytes=7-')
+        self.assertEqual('789', ''.join(body))
+        status, headers, body = self.get('/style.css', HTTP_RANGE='bytes=-2')
+        self.assertEqual('89', ''.join(body))
+        status, headers, body = self.get(
+            '/style.css', HTTP_RANGE='bytes=8-100')
+        self.assertEqual('89', ''.join(body))
+        self.assertEqual('bytes 8-9/10', headers['content-range'])
+
+    def test_unsatisfiable_range(self):
+        status, headers, body = self.get('/style.css', HTTP_RANGE='bytes=10-')
+        self.assertEqual(416, status)
+        self.assertEqual('bytes */10', headers['content-range'])
+
+    def test_multiple_ranges_are_ignored(self):
+        status, headers, body = self.get(
+            '/style.css', HTTP_RANGE='bytes=0-1,4-5')
+        self.assertEqual(200, status)
+        self.assertEqual('0123456789', ''.join(body))
+
+    def test_if_range(self):
+        status, headers, body = self.get('/style.css')
+        status, headers, body = self.get(
+            '/style.css', HTTP_RANGE='bytes=2-4',
+            HTTP_IF_RANGE=headers['etag'])
+        self.assertEqual(206, status)
+        status, headers, body = self.get(
+            '/style.css', HTTP_RANGE='bytes=2-4', HTTP_IF_RANGE='"other"')
+        self.assertEqual(200, status)
+
+    def test_file_information_is_cached(self):
+        self.get('/style.css')
+        self.write('style.css', 'changed')
+        status, headers, body = self.get('/style.css', 'HEAD')
+        self.assertEqual('10', headers['content-length'])
+        self.app.static_stat_ttl = 0
+        self.app.static_cache.clear()
+        status, headers, body = self.get('/style.css')
+        self.assertEqual('changed', ''.join(body))
+
+    def test_removed_file_is_not_found(self):
+        self.get('/style.css')
+        os.remove(os.path.join(self.document_root, 'style.css'))
+        status, headers, body = self.get('/style.css')
+        self.assertEqual(404, status)
+
+    def test_parse_range(self):
+        parse_range = ophelia.wsgi.parse_range
+        self.assertEqual((0, 9), parse_range('bytes=0-', 10))
+        self.assertEqual((0, 9), parse_range('bytes=-20', 10))
+        self.assertEqual(None, parse_range('bytes=5-2', 10))
+        self.assertEqual(None, parse_range('bytes=a-2', 10))
+        self.assertEqual(None, parse_range('bytes=-', 10))
+        self.assertEqual(None, parse_range('lines=1-2', 10))
+        self.assertRaises(ValueError, parse_range, 'bytes=-0', 10)
+        self.assertRaises(ValueError, parse_range, 'bytes=-1', 0)
+
+
+class NotFoundCacheTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.template_root = os.path.join(self.tmpdir, 'templates')
+        self.document_root = os.path.join(self.tmpdir, 'documents')
+        os.mkdir(self.template_root)
+        os.mkdir(self.document_root)
+        self.options = {
+            'site': 'http://localhost/',
+            'template_root': self.template_root,
+            'document_root': self.document_root,
+            'not_found_cache_size': '100',
+            'not_found_cache_ttl': '0',
+            'static_stat_ttl': '0',
+            }
+        self.app = webtest.TestApp(ophelia.wsgi.Application(self.options))
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    @property
+    def cache(self):
+        return self.app.app.not_found_cache
+
+    def test_cache_is_off_by_default(self):
+        del self.options['not_found_cache_size']
+        app = ophelia.wsgi.Application(self.options)
+        self.assertIsNone(app.not_found_cache)
+
+    def test_missing_pages_are_cached(self):
+        self.app.get('/missing.html', status=404)
+        self.assertEqual(0, self.cache.hits)
+        r = self.app.get('/missing.html', status=404)
+        self.assertEqual(1, self.cache.hits)
+        self.assertIn('404 Not found', r.body)
+
+    def test_cache_is_trusted_for_some_time(self):
+        self.cache.ttl = 60
+        self.app.get('/missing.html', status=404)
+        open(os.path.join(self.template_root, 'missing.html'), 'w').write(
+            '<p>found</p>')
+        self.app.get('/missing.html', status=404)
+
+    def test_added_template_invalidates_entry(self):
+        self.app.get('/missing.html', status=404)
+        open(os.path.join(self.template_root, 'missing.html'), 'w').write(
+            '<p>found</p>')
+        r = self.app.get('/missing.html', status=200)
+        self.assertIn('<p>found</p>', r.body)
+
+    def test_added_document_invalidates_entry(self):
+        self.app.get('/missing.html', status=404)
+        open(os.path.join(self.document_root, 'missing.html'), 'w').write(
+            'found')
+        r = self.app.get('/missing.html', status=200)
+        self.assertEqual('found', r.body)
+
+    def test_added_directory_invalidates_entry(self):
+        self.app.get('/folder/missing.html', status=404)
+        os.mkdir(os.path.join(self.template_root, 'folder'))
+        open(os.path.join(self.template_root, 'folder', 'missing.html'),
+             'w').write('<p>found</p>')
+        self.app.get('/folder/missing.html', status=200)
+
+    def test_scripts_may_prevent_caching(self):
+        open(os.path.join(self.template_root, '__init__'), 'w').write("""\
+__request__.cache_ttl = 0
+<?xml?>
+<div tal:replace="structure innerslot" />
+""")
+        self.app.get('/missing.html', status=404)
+        self.app.get('/missing.html', status=404)
+        self.assertEqual(0, len(self.cache))
+
+
+class ResponseCacheTest(unittest.TestCase):
+
+    def setUp(self):
+        self.app = webtest.TestApp(ophelia.wsgi.Application({
+                    'site': 'http://localhost/',
+                    'template_root': fixture('templates'),
+                    'response_cache_size': '100000',
+                    'response_cache_vary': 'Accept-Language',
+                    }))
+
+    def test_responses_are_cached(self):
+        first = self.app.get('/time.html', status=200)
+        second = self.app.get('/time.html', status=200)
+        self.assertEqual(first.body, second.body)
+        self.assertEqual(first.headers['content-type'],
+                         second.headers['content-type'])
+
+    def test_head_requests_are_answered_from_the_cache(self):
+        self.app.get('/time.html', status=200)
+        r = self.app.head('/time.html', status=200)
+        self.assertEqual('text/html; charset=utf-8', r.headers['content-type'])
+        self.assertEqual(1, self.app.app.response_cache.hits)
+
+    def test_query_string_is_part_of_the_cache_key(self):
+        first = self.app.get('/time.html?foo', status=200)
+        second = self.app.get('/time.html?bar', status=200)
+        self.assertNotEqual(first.body, second.body)
+
+    def test_responses_expire(self):
+        self.app.app.response_cache_ttl = 0.0001
+        first = self.app.get('/time.html', status=200)
+        time.sleep(0.01)
+        second = self.app.get('/time.html', status=200)
+        self.assertNotEqual(first.body, second.body)
+
+    def test_scripts_may_mark_responses_uncacheable(self):
+        first = self.app.get('/uncacheable.html', status=200)
+        second = self.app.get('/uncacheable.html', status=200)
+        self.assertNotEqual(first.body, second.body)
+
+    def test_configured_request_headers_are_part_of_the_cache_key(self):
+        r = self.app.get('/language.html', headers={'Accept-Language': 'de'})
+        self.assertIn('<p>de</p>', r.body)
+        r = self.app.get('/language.html', headers={'Accept-Language': 'en'})
+        self.assertIn('<p>en</p>', r.body)
+        r = self.app.get('/language.html', headers={'Accept-Language': 'de'})
+        self.assertIn('<p>de</p>', r.body)
+
+    def test_errors_are_not_cached(self):
+        self.app.get('/raise.html', status=500)
+        self.app.get('/raise.html', status=500)
+        self.assertEqual(0, len(self.app.app.response_cache))
+
+    def test_responses_setting_cookies_are_not_cached(self):
+        first = self.app.get('/cookie.html', status=200)
+        second = self.app.get('/cookie.html', status=200)
+        self.assertNotEqual(first.headers['set-cookie'],
+                            second.headers['set-cookie'])
+        self.assertEqual(0, len(self.app.app.response_cache))
+
+    def test_private_responses_are_not_cached(self):
+        first = self.app.get('/private.html', status=200)
+        second = self.app.get('/private.html', status=200)
+        self.assertNotEqual(first.body, second.body)
+        self.assertEqual(0, len(self.app.app.response_cache))
+
+
+class SharedResponseCacheTest(ResponseCacheTest):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.app = webtest.TestApp(ophelia.wsgi.Application({
+                    'site': 'http://localhost/',
+                    'template_root': fixture('templates'),
+                    'response_cache_size': '100000',
+                    'response_cache_file': os.path.join(self.tmpdir, 'cache'),
+                    'response_cache_slot_size': '10000',
+                    'response_cache_vary': 'Accept-Language',
+                    }))
+
+    def tearDown(self):
+        self.app.app.response_cache.close()
+        shutil.rmtree(self.tmpdir)
+
+    def test_cache_is_shared_between_applications(self):
+        first = self.app.get('/time.html', status=200)
+        app = webtest.TestApp(ophelia.wsgi.Application({
+                    'site': 'http://localhost/',
+                    'template_root': fixture('templates'),
+                    'response_cache_size': '100000',
+                    'response_cache_file': os.path.join(self.tmpdir, 'cache'),
+                    'response_cache_slot_size': '10000',
+                    'response_cache_vary': 'Accept-Language',
+                    }))
+        second = app.get('/time.html', status=200)
+        self.assertEqual(first.body, second.body)
+        self.assertEqual(1, app.app.response_cache.hits)
+        app.app.response_cache.close()
+
+
+class RenderCacheTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.template_root = os.path.join(self.tmpdir, 'templates')
+        shutil.copytree(fixture('templates'), self.template_root)
+        self.options = {
+            'site': 'http://localhost/',
+            'template_root': self.template_root,
+            'render_cache_dir': os.path.join(self.tmpdir, 'cache'),
+            }
+        self.app = ophelia.wsgi.Application(self.options)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def get(self, path, method='GET', **env):
+        status, headers, body = get(self.app, path, method, **env)
+        return int(status.split()[0]), headers, ''.join(body)
+
+    def test_pages_are_served_from_the_cache(self):
+        status, headers, first = self.get('/time.html')
+        self.assertEqual(0, self.app.render_cache.hits)
+        status, headers, second = self.get('/time.html')
+        self.assertEqual(200, status)
+        self.assertEqual(first, second)
+        self.assertEqual('text/html; charset=utf-8', headers['content-type'])
+        self.assertEqual(str(len(first)), headers['content-length'])
+        self.assertEqual(1, self.app.render_cache.hits)
+
+    def test_cache_survives_restarts(self):
+        status, headers, first = self.get('/time.html')
+        self.app = ophelia.wsgi.Application(self.options)
+        status, headers, second = self.get('/time.html')
+        self.assertEqual(first, second)
+
+    def test_changed_input_file_invalidates_the_page(self):
+        status, headers, first = self.get('/time.html')
+        file_path = os.path.join(self.template_root, 'time.html')
+        os.utime(file_path, (0, os.stat(file_path).st_mtime + 10))
+        status, headers, second = self.get('/time.html')
+        self.assertNotEqual(first, second)
+
+    def test_frozen_tree_decides_whether_page_is_valid(self):
+        self.options['frozen'] = 'on'
+        self.app = ophelia.wsgi.Application(self.options)
+        status, headers, first = self.get('/time.html')
+        file_path = os.path.join(self.template_root, 'time.html')
+        os.utime(file_path, (0, os.stat(file_path).st_mtime + 10))
+        status, headers, second = self.get('/time.html')
+        self.assertEqual(first, second)
+        self.assertEqual(1, self.app.render_cache.hits)
+        self.app.load_tree()
+        status, headers, third = self.get('/time.html')
+        self.assertNotEqual(first, third)
+        self.assertEqual(2, self.app.render_cache.misses)
+
+    def test_rerendered_page_is_sent_with_its_own_length(self):
+        self.options['static_stat_ttl'] = '60'
+        self.app = ophelia.wsgi.Application(self.options)
+        file_path = os.path.join(self.template_root, 'time.html')
+        self.get('/time.html')
+        status, headers, body = self.get('/time.html')
+        self.assertEqual(1, self.app.render_cache.hits)
+        open(file_path, 'w').write('<p>%s</p>' % ('x' * 100))
+        os.utime(file_path, (0, os.stat(file_path).st_mtime + 10))
+        self.get('/time.html')
+        status, headers, body = self.get('/time.html')
+        self.assertEqual(2, self.app.render_cache.hits)
+        self.assertIn('x' * 100, body)
+        self.assertEqual(str(len(body)), headers['content-length'])
+
+    def test_requests_with_query_string_bypass_the_cache(self):
+        self.get('/time.html', QUERY_STRING='a=1')
+        self.get('/time.html', QUERY_STRING='a=2')
+        self.get('/time.html', QUERY_STRING='a=2')
+        self.assertEqual(0, self.app.render_cache.hits)
+        self.assertEqual(0, self.app.render_cache.misses)
+        self.assertEqual([], os.listdir(self.app.render_cache.directory))
+
+    def test_added_input_file_invalidates_the_page(self):
+        status, headers, first = self.get('/time.html')
+        open(os.path.join(self.template_root, '__init__'), 'w').write(
+            '<div tal:content="structure innerslot" />')
+        status, headers, second = self.get('/time.html')
+        self.assertIn('<div>', second)
+
+    def test_scripts_may_mark_pages_uncacheable(self):
+        status, headers, first = self.get('/uncacheable.html')
+        status, headers, second = self.get('/uncacheable.html')
+        self.assertNotEqual(first, second)
+
+    def test_head_requests_are_answered_from_the_cache(self):
+        status, headers, body = self.get('/time.html')
+        status, headers, empty = self.get('/time.html', 'HEAD')
+        self.assertEqual(200, status)
+        self.assertEqual('', empty)
+        self.assertEqual(str(len(body)), headers['content-length'])
+        self.assertEqual(1, self.app.render_cache.hits)
+
+    def test_body_is_handed_to_the_front_end_server(self):
+        self.options['xsendfile'] = 'standard'
+        self.app = ophelia.wsgi.Application(self.options)
+        status, headers, body = self.get('/time.html')
+        status, headers, empty = self.get('/time.html')
+        self.assertEqual('', empty)
+        self.assertEqual('text/html; charset=utf-8', headers['content-type'])
+        self.assertEqual(body, open(headers['x-sendfile']).read())
+
+    def test_nginx_uses_an_internal_location_of_its_own(self):
+        self.options['xsendfile'] = 'nginx'
+        self.app = ophelia.wsgi.Application(self.options)
+        self.get('/time.html')
+        status, headers, empty = self.get('/time.html')
+        self.assertTrue(headers['x-accel-redirect'].startswith(
+                '/-internal-render-/'))
+
+    def test_compressed_variant(self):
+        self.options['gzip'] = 'on'
+        self.options['gzip_min_size'] = '0'
+        self.app = ophelia.wsgi.Application(self.options)
+        status, headers, body = self.get('/time.html')
+        status, headers, data = self.get(
+            '/time.html', HTTP_ACCEPT_ENCODING='gzip')
+        self.assertEqual(1, self.app.render_cache.hits)
+        self.assertEqual('gzip', headers['content-encoding'])
+        self.assertEqual('Accept-Encoding', headers['vary'])
+        self.assertEqual(body, gunzip(data))
+        status, headers, plain = self.get('/time.html')
+        self.assertNotIn('content-encoding', headers)
+        self.assertEqual('Accept-Encoding', headers['vary'])
+        self.assertEqual(body, plain)
+
+    def test_vary_headers_are_sent_as_one(self):
+        open(os.path.join(self.template_root, 'vary.html'), 'w').write("""\
+__request__.response_headers['Vary'] = \\
+    'string:Accept-Language, Accept-Encoding'
+<?xml?>
+<p>page</p>
+""")
+        self.options['gzip'] = 'on'
+        self.options['gzip_min_size'] = '0'
+        self.app = ophelia.wsgi.Application(self.options)
+
+        # get() would fold repeated headers into one dict entry
+        def vary(**env):
+            env.update(SCRIPT_NAME='', PATH_INFO='/vary.html',
+                       REQUEST_METHOD='GET')
+            wsgiref.util.setup_testing_defaults(env)
+            headers = []
+            ''.join(self.app(env, lambda status, response_headers,
+                             exc_info=None: headers.extend(response_headers)))
+            return [value for key, value in headers if key.lower() == 'vary']
+
+        for accept_encoding in ('', 'gzip', '', 'gzip'):
+            self.assertEqual(['Accept-Language, Accept-Encoding'],
+                             vary(HTTP_ACCEPT_ENCODING=accept_encoding))
+        self.assertEqual(3, self.app.render_cache.hits)
+
+    def test_conditional_get(self):
+        self.options['conditional_get'] = 'on'
+        self.app = ophelia.wsgi.Application(self.options)
+        status, headers, body = self.get('/time.html')
+        status, headers, empty = self.get(
+            '/time.html', HTTP_IF_NONE_MATCH=headers['etag'])
+        self.assertEqual(304, status)
+
+
+class ConditionalGetTest(unittest.TestCase):
+
+    def setUp(self):
+        self.app = webtest.TestApp(ophelia.wsgi.Application({
+                    'site': 'http://localhost/',
+                    'template_root': fixture('templates'),
+                    'conditional_get': 'on',
+                    }))
+
+    def test_validators_are_sent_with_the_response(self):
+        r = self.app.get('/smoke.html', status=200)
+        self.assertTrue(r.headers['etag'].startswith('"'))
+        self.assertTrue(r.headers['last-modified'].endswith(' GMT'))
+
+    def test_etag_depends_on_the_path(self):
+        first = self.app.get('/smoke.html', status=200)
+        second = self.app.get('/time.html', status=200)
+        self.assertNotEqual(first.headers['etag'], second.headers['etag'])
+
+    def test_matching_etag_is_answered_with_not_modified(self):
+        etag = self.app.get('/smoke.html', status=200).headers['etag']
+        r = self.app.get('/smoke.html', headers={'If-None-Match': etag},
+                         status=304)
+        self.assertEqual(etag, r.headers['etag'])
+        self.assertEqual('', r.body)
+
+    def test_different_etag_is_answered_with_the_page(self):
+        r = self.app.get('/smoke.html', headers={'If-None-Match': '"foo"'},
+                         status=200)
+        self.assertIn('<p>bar</p>', r.body)
+
+    def test_current_modification_date_is_answered_with_not_modified(self):
+        date = self.app.get('/smoke.html').headers['last-modified']
+        self.app.get('/smoke.html', headers={'If-Modified-Since': date},
+                     status=304)
+
+    def test_earlier_modification_date_is_answered_with_the_page(self):
+        self.app.get(
+            '/smoke.html',
+            headers={'If-Modified-Since': 'Thu, 01 Jan 1970 00:00:00 GMT'},
+            status=200)
+
+    def test_not_modified_is_answered_before_rendering(self):
+        self.app.get('/raise-late.html', status=500)
+        request = ophelia.wsgi.Request(
+            'raise-late.html', fixture('templates'), 'http://localhost/',
+            **{'wsgi.input': None})
+        request.traverse()
+        etag = self.app.app.validators(
+            {'PATH_INFO': '/raise-late.html'}, request)['ETag']
+        self.app.get('/raise-late.html', headers={'If-None-Match': etag},
+                     status=304)
+
+    def test_uncacheable_pages_are_always_rendered(self):
+        r = self.app.get('/uncacheable.html', status=200)
+        self.assertNotIn('etag', r.headers)
+
+    def test_conditional_get_is_off_by_default(self):
+        r = self.app.get('/smoke.html', status=200,
+                         extra_environ={'conditional_get': 'off'})
+        self.assertNotIn('etag', r.headers)
+
+
+class IncrementalEncodingTest(unittest.TestCase):
+
+    def setUp(self):
+        self.app = webtest.TestApp(ophelia.wsgi.Application({
+                    'site': 'http://localhost/',
+                    'template_root': fixture('templates'),
+                    'incremental_encoding': 'on',
+                    }))
+
+    def test_chunked_response_equals_plain_one(self):
+        chunked = self.app.get('/smoke.html', status=200)
+        plain = self.app.get('/smoke.html', status=200,
+                             extra_environ={'incremental_encoding': 'off'})
+        self.assertEqual(plain.body, chunked.body)
+        self.assertEqual(str(len(chunked.body)),
+                         chunked.headers['content-length'])
+
+    def test_response_body_is_returned_in_chunks(self):
+        chunks = self.app.app({
+                'PATH_INFO': '/smoke.html',
+                'REQUEST_METHOD': 'GET',
+                'wsgi.input': None,
+                }, lambda status, headers, exc_info=None: None)
+        self.assertEqual(
+            ['<?xml version="1.1" encoding="utf-8" ?>\n',
+             '\n<html><head></head><body><p>bar</p></body></html>\n'],
+            chunks)
+
+
+def gunzip(data):
+    return gzip.GzipFile(fileobj=StringIO.StringIO(data)).read()
+
+
+class AddVaryTest(unittest.TestCase):
+
+    def test_vary_headers_are_merged(self):
+        self.assertEqual(
+            [('Content-Type', 'text/html'),
+             ('Vary', 'Accept-Language, Cookie, Accept-Encoding')],
+            ophelia.wsgi.add_vary([('Vary', 'Accept-Language, Cookie'),
+                                   ('Content-Type', 'text/html'),
+                                   ('vary', 'accept-language')],
+                                  'Accept-Encoding'))
+
+    def test_no_vary_header_without_names(self):
+        headers = [('Content-Type', 'text/html')]
+        self.assertEqual(headers, ophelia.wsgi.add_vary(headers))
+
+
+class GzipTest(unittest.TestCase):
+
+    def setUp(self):
+        self.document_root = tempfile.mkdtemp()
+        open(os.path.join(self.document_root, 'style.css'), 'w').write(
+            'p {}')
+        open(os.path.join(self.document_root, 'style.css.gz'), 'w').write(
+            ophelia.compression.compress(['p {}']))
+        self.app = ophelia.wsgi.Application({
+                'site': 'http://localhost/',
+                'template_root': fixture('templates'),
+                'document_root': self.document_root,
+                'gzip': 'on',
+                'gzip_min_size': '0',
+                })
+
+    def tearDown(self):
+        shutil.rmtree(self.document_root)
+
+    def get(self, path, accept_encoding=None, **env):
+        # webtest would decode the response body, so call the app directly
+        if accept_encoding is not None:
+            env['HTTP_ACCEPT_ENCODING'] = accept_encoding
+        status, headers, body = get(self.app, path, **env)
+        return int(status.split()[0]), headers, ''.join(body)
+
+    def test_accepts_gzip(self):
+        accepts = lambda value: ophelia.compression.accepts_gzip(
+            {'HTTP_ACCEPT_ENCODING': value})
+        self.assertTrue(accepts('gzip'))
+        self.assertTrue(accepts('deflate, gzip;q=0.5'))
+        self.assertTrue(accepts('*'))
+        self.assertFalse(accepts('gzip;q=0, *'))
+        self.assertFalse(accepts('deflate'))
+        self.assertFalse(accepts(''))
+
+    def test_page_is_compressed_if_accepted(self):
+        status, headers, body = self.get('/smoke.html', 'gzip')
+        self.assertEqual(200, status)
+        self.assertEqual('gzip', headers['content-encoding'])
+        self.assertEqual('Accept-Encoding', headers['vary'])
+        self.assertEqual(str(len(body)), headers['content-length'])
+        self.assertIn('<p>bar</p>', gunzip(body))
+
+    def test_page_is_not_compressed_unless_accepted(self):
+        status, headers, body = self.get('/smoke.html')
+        self.assertNotIn('content-encoding', headers)
+        self.assertEqual('Accept-Encoding', headers['vary'])
+        self.assertIn('<p>bar</p>', body)
+
+    def test_small_pages_are_not_compressed(self):
+        status, headers, body = self.get(
+            '/smoke.html', 'gzip', gzip_min_size='1000')
+        self.assertNotIn('content-encoding', headers)
+        self.assertNotIn('vary', headers)
+
+    def test_compressed_variants_are_cached(self):
+        for i in range(2):
+            self.get('/smoke.html', 'gzip')
+        self.assertEqual(1, self.app.gzip_cache.hits)
+
+    def test_compressed_variant_has_its_own_etag(self):
+        plain_etag = self.get(
+            '/smoke.html', conditional_get='on')[1]['etag']
+        gzip_etag = self.get(
+            '/smoke.html', 'gzip', conditional_get='on')[1]['etag']
+        self.assertNotEqual(plain_etag, gzip_etag)
+        status, headers, body = self.get(
+            '/smoke.html', 'gzip', conditional_get='on',
+            HTTP_IF_NONE_MATCH=gzip_etag)
+        self.assertEqual(304, status)
+        self.assertEqual(gzip_etag, headers['etag'])
+        status, headers, body = self.get(
+            '/smoke.html', conditional_get='on',
+            HTTP_IF_NONE_MATCH=gzip_etag)
+        self.assertEqual(200, status)
+        self.assertEqual(plain_etag, headers['etag'])
+        status, headers, body = self.get(
+            '/smoke.html', conditional_get='on',
+            HTTP_IF_NONE_MATCH=plain_etag)
+        self.assertEqual(304, status)
+        self.assertEqual(plain_etag, headers['etag'])
+
+    def test_precompressed_document_has_its_own_etag(self):
+        plain_etag = self.get('/style.css')[1]['etag']
+        gzip_etag = self.get('/style.css', 'gzip')[1]['etag']
+        self.assertNotEqual(plain_etag, gzip_etag)
+        status, headers, body = self.get(
+            '/style.css', 'gzip', HTTP_IF_NONE_MATCH=gzip_etag)
+        self.assertEqual(304, status)
+        self.assertEqual(gzip_etag, headers['etag'])
+        status, headers, body = self.get(
+            '/style.css', HTTP_IF_NONE_MATCH=gzip_etag)
+        self.assertEqual(200, status)
+
+    def test_precompressed_document_is_served_if_accepted(self):
+        status, headers, body = self.get('/style.css', 'gzip')
+        self.assertEqual(200, status)
+        self.assertEqual('gzip', headers['content-encoding'])
+        self.assertEqual('text/css', headers['content-type'])
+        self.assertEqual('p {}', gunzip(body))
+
+    def test_uncompressed_document_is_served_unless_accepted(self):
+        status, headers, body = self.get('/style.css')
+        self.assertEqual(200, status)
+        self.assertNotIn('content-encoding', headers)
+        self.assertEqual('Accept-Encoding', headers['vary'])
+        self.assertEqual('p {}', body)
+
+
+class ServerTimingTest(unittest.TestCase):
+
+    def setUp(self):
+        self.app = webtest.TestApp(ophelia.wsgi.Application({
+                    'site': 'http://localhost/',
+                    'template_root': fixture('templates'),
+                    'document_root': fixture('documents'),
+                    'server_timing': 'on',
+                    'response_cache_size': '100000',
+                    }))
+
+    def test_server_timing_header_lists_phases(self):
+        r = self.app.get('/smoke.html', status=200)
+        phases = [metric.split(';')[0] for metric in
+                  r.headers['server-timing'].split(', ')]
+        for phase in ('cook', 'script', 'render', 'headers'):
+            self.assertIn(phase, phases)
+
+    def test_server_timing_header_is_not_cached(self):
+        self.app.get('/smoke.html')
+        r = self.app.get('/smoke.html')
+        self.assertEqual(1, self.app.app.response_cache.hits)
+        self.assertNotIn('server-timing', r.headers)
+
+    def test_server_timing_is_off_by_default(self):
+        r = self.app.get('/smoke.html', extra_environ={
+                'server_timing': 'off'})
+        self.assertNotIn('server-timing', r.headers)
+
+
+class MetricsTest(unittest.TestCase):
+
+    def setUp(self):
+        self.app = webtest.TestApp(ophelia.wsgi.Application({
+                    'site': 'http://localhost/',
+                    'template_root': fixture('templates'),
+                    'document_root': fixture('documents'),
+                    'metrics_path': '/_metrics',
+                    }))
+
+    def test_metrics_are_off_by_default(self):
+        app = webtest.TestApp(ophelia.wsgi.Application({
+                    'site': 'http://localhost/',
+                    'template_root': fixture('templates'),
+                    'document_root': fixture('documents'),
+                    }))
+        app.get('/_metrics', status=404)
+
+    def test_requests_are_counted(self):
+        self.app.get('/smoke.html', status=200)
+        self.app.get('/smoke.html', status=200)
+        self.app.get('/raise.html', status=500)
+        self.app.get('/smoke-document.html', status=200)
+        r = self.app.get('/_metrics', status=200)
+        self.assertEqual('text/plain', r.content_type)
+        lines = r.body.splitlines()
+        self.assertIn('ophelia_requests_total{status="200"} 3', lines)
+        self.assertIn('ophelia_requests_total{status="500"} 1', lines)
+        self.assertIn('ophelia_request_duration_seconds_count'
+                      '{segment="/smoke.html"} 2', lines)
+        self.assertIn('ophelia_sendfile_total 1', lines)
+        self.assertIn('ophelia_errors_total 1', lines)
+        self.assertTrue([line for line in lines
+                         if line.startswith('ophelia_cache_hits_total'
+                                            '{cache="template"}')])
+
+
+class MacroLibraryTest(unittest.TestCase):
+
+    def setUp(self):
+        self.template_root = tempfile.mkdtemp()
+        self.write('layout.html', """\
+<div metal:define-macro="page">layout <p metal:define-slot="body" /></div>
+""")
+        self.write('extra.html', """\
+<span metal:define-macro="extra">extra</span>
+""")
+        self.write('page.html', """\
+__request__.load_macros('layout.html')
+<?xml?>
+<div metal:use-macro="macros/page"><p metal:fill-slot="body">page</p></div>
+""")
+        self.write('shared.html', """\
+<?xml?>
+<div><span metal:use-macro="macros/extra" /></div>
+""")
+        self.write('local.html', """\
+__request__.load_macros('local-macros.html')
+<?xml?>
+<div metal:use-macro="macros/extra" />
+""")
+        self.write('local-macros.html', """\
+<span metal:define-macro="extra">local</span>
+""")
+        self.app = webtest.TestApp(ophelia.wsgi.Application({
+                    'site': 'http://localhost/',
+                    'template_root': self.template_root,
+                    'macro_files': 'layout.html extra.html',
+                    }))
+
+    def tearDown(self):
+        shutil.rmtree(self.template_root)
+
+    def write(self, path, content):
+        write(os.path.join(self.template_root, path), content)
+
+    def test_shared_macros_are_visible_without_loading(self):
+        r = self.app.get('/shared.html', status=200)
+        self.assertIn('<span>extra</span>', r.body)
+
+    def test_loading_preloaded_macros_uses_library(self):
+        r = self.app.get('/page.html', status=200)
+        self.assertIn('layout <p>page</p>', r.body)
+
+    def test_request_macros_override_library(self):
+        r = self.app.get('/local.html', status=200)
+        self.assertIn('<span>local</span>', r.body)
+        self.assertNotIn('extra', r.body)
+        r = self.app.get('/shared.html', status=200)
+        self.assertIn('<span>extra</span>', r.body)
+
+    def test_changed_macro_file_is_loaded_again(self):
+        self.write('layout.html', """\
+<div metal:define-macro="page">changed <p metal:define-slot="body" /></div>
+""")
+        r = self.app.get('/page.html', status=200)
+        self.assertIn('changed <p>page</p>', r.body)
+
+    def test_library_is_immutable(self):
+        library = self.app.app.options['ophelia.macros']
+        self.assertEqual(['extra', 'page'], sorted(library))
+        self.assertRaises(TypeError, library.__setitem__, 'foo', None)
+        self.assertRaises(TypeError, library.update, {})
+
+    def test_macros_may_be_named_like_dict_methods(self):
+        self.write('methods.html', """\
+<span metal:define-macro="items">items</span>
+<span metal:define-macro="copy">copy</span>
+""")
+        self.write('local-methods.html', """\
+<span metal:define-macro="get">get</span>
+""")
+        self.write('methods-page.html', """\
+__request__.load_macros('local-methods.html')
+<?xml?>
+<div><span metal:use-macro="macros/items" />
+<span metal:use-macro="macros/copy" />
+<span metal:use-macro="macros/get" /></div>
+""")
+        app = webtest.TestApp(ophelia.wsgi.Application({
+                    'site': 'http://localhost/',
+                    'template_root': self.template_root,
+                    'macro_files': 'methods.html',
+                    }))
+        r = app.get('/methods-page.html', status=200)
+        self.assertIn('<span>items</span>\n<span>copy</span>\n'
+                      '<span>get</span>', r.body)
+
+    def test_macro_files_must_not_contain_scripts(self):
+        self.assertRaises(ValueError, ophelia.wsgi.Application, {
+                'site': 'http://localhost/',
+                'template_root': self.template_root,
+                'macro_files': 'page.html',
+                })
@@ -0,0 +1,124 @@
+# Copyright (c) 2013 Thomas Lotze
+# See also LICENSE.txt
+
+"""Measuring the time spent in the phases of processing a request.
+"""
+
+import time
+
+
+PHASES = ("read", "split", "cook", "compile", "script", "render", "headers")
+
+
+class Timer(object):
+    """Records durations of processing phases and passes them on to hooks.
+
+    Instantiate as Timer(request, hooks=(), clock=time.time).
+
+    request: the request being processed
+    hooks: iterable of callables to be called with the request, the phase
+           name, the path of the input file concerned or None, and the
+           duration in seconds whenever a phase has been completed
+    clock: callable returning the current time in seconds
+
+    Phases may be nested, for example when a script renders another file's
+    template. The time spent in nested phases is not counted towards the
+    enclosing phase so durations add up to the total processing time.
+    """
+
+    def __init__(self, request, hooks=(), clock=time.time):
+        self.request = request
+        self.hooks = list(hooks)
+        self.clock = clock
+        self.timings = []
+        self.running = []
+
+    def __call__(self, phase, file_path=None):
+        """Measure the duration of a phase.
+
+        phase: str, name of the phase
+        file_path: str, path of the input file concerned if any
+
+        returns context manager which records the duration upon exit
+        """
+        return Measurement(self, phase, file_path)
+
+    def record(self, phase, file_path, duration):
+        self.timings.append((phase, file_path, duration))
+        for hook in self.hooks:
+            hook(self.request, phase, file_path, duration)
+
+    def totals(self):
+        """Sum up durations by phase.
+
+        returns dict mapping phase names to durations in seconds
+        """
+        totals = {}
+        for phase, file_path, duration in self.timings:
+            totals[phase] = totals.get(phase, 0) + duration
+        return totals
+
+
+class Measurement(object):
+
+    __slots__ = ("timer", "phase", "file_path", "start", "nested")
+
+    def __init__(self, timer, phase, file_path):
+        self.timer = timer
+        self.phase = phase
+        self.file_path = file_path
+
+    def __enter__(self):
+        self.nested = 0
+        self.timer.running.append(self)
+        self.start = self.timer.clock()
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        elapsed = self.timer.clock() - self.start
+        running = self.timer.running
+        running.pop()
+        if running:
+            running[-1].nested += elapsed
+        self.timer.record(self.phase, self.file_path, elapsed - self.nested)
+
+
+class NullTimer(object):
+    """Timer that doesn't measure anything, used when timing is turned off.
+    """
+
+    timings = ()
+
+    def __nonzero__(self):
+        return False
+
+    def __call__(self, phase, file_path=None):
+        return null_measurement
+
+    def totals(self):
+        return {}
+
+
+class NullMeasurement(object):
+
+    def __enter__(self):
+        pass
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        pass
+
+
+null_timer = NullTimer()
+null_measurement = NullMeasurement()
+
+
+def server_timing(totals):
+    """Format phase durations as the value of a Server-Timing header.
+
+    totals: dict mapping phase names to durations in seconds
+
+    returns str
+    """
+    phases = [phase for phase in PHASES if phase in totals]
+    phases.extend(sorted(set(totals).difference(PHASES)))
+    return ", ".join("%s;dur=%.3f" % (phase, totals[phase] * 1000)
+                     for phase in phases)
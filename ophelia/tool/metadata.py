@@ -97,5 +97,10 @@ class MetaData(object):
                 "Can't compute an Etag before content has been built.")
 
         obj = md5.new()
-        obj.update(self.request.content)
+        content = self.request.content
+        if isinstance(content, list):
+            for chunk in content:
+                obj.update(chunk)
+        else:
+            obj.update(content)
         return HEX_ENCODER(obj.digest())[0]
@@ -1,9 +1,13 @@
 # Copyright (c) 2007-2013 Thomas Lotze
 # See also LICENSE.txt
 
+import ConfigParser
+import codecs
 import locale
+import sys
 import time
 import datetime
+import zope.exceptions.exceptionformatter
 
 
 class Namespace(dict):
@@ -27,6 +31,229 @@ class Namespace(dict):
             raise AttributeError(name)
 
 
+# value hiding a name from the layers below in a LayeredNamespace
+HIDDEN = object()
+
+_marker = object()
+
+
+class LayeredNamespace(Namespace):
+    """Namespace looking up names it doesn't hold itself in a stack of dicts.
+
+    Instantiate as LayeredNamespace(layers, **names).
+
+    layers: sequence of dicts, the first one taking precedence; a layer
+            mapping a name to HIDDEN hides it from the layers below
+    names: initial content of the namespace's own, topmost layer
+
+    Layers are not copied, so lookups see later changes to them. Assigning to
+    or deleting names only ever affects the namespace's own layer; deleting a
+    name found in the layers hides it. Layers that are LayeredNamespaces
+    themselves are flattened, taking a snapshot of their own layer.
+
+    Copying a layered namespace copies only its own layer and shares the
+    stack of layers, which is cheap as long as only few names have been
+    assigned to or deleted from the namespace itself.
+    """
+
+    def __init__(self, layers, **names):
+        dict.__init__(self, names)
+        flat = []
+        for layer in layers:
+            if isinstance(layer, LayeredNamespace):
+                flat.append(dict.copy(layer))
+                flat.extend(object.__getattribute__(layer, "_layers"))
+            else:
+                flat.append(layer)
+        object.__setattr__(self, "_layers", tuple(flat))
+
+    def __getattribute__(self, name):
+        value = _lookup(self, name)
+        if value is _marker:
+            return object.__getattribute__(self, name)
+        return value
+
+    def __getitem__(self, name):
+        value = _lookup(self, name)
+        if value is _marker:
+            raise KeyError(name)
+        return value
+
+    def __delitem__(self, name):
+        if _lookup(self, name) is _marker:
+            raise KeyError(name)
+        dict.__setitem__(self, name, HIDDEN)
+
+    def __contains__(self, name):
+        return _lookup(self, name) is not _marker
+
+    has_key = __contains__
+
+    def get(self, name, default=None):
+        value = _lookup(self, name)
+        if value is _marker:
+            return default
+        return value
+
+    def pop(self, name, default=_marker):
+        value = _lookup(self, name)
+        if value is _marker:
+            if default is _marker:
+                raise KeyError(name)
+            return default
+        dict.__setitem__(self, name, HIDDEN)
+        return value
+
+    def setdefault(self, name, default=None):
+        value = _lookup(self, name)
+        if value is _marker:
+            self[name] = value = default
+        return value
+
+    def copy(self):
+        copy = dict.__new__(LayeredNamespace)
+        dict.update(copy, self)
+        object.__setattr__(
+            copy, "_layers", object.__getattribute__(self, "_layers"))
+        return copy
+
+    def keys(self):
+        return _flatten(self).keys()
+
+    def values(self):
+        return _flatten(self).values()
+
+    def items(self):
+        return _flatten(self).items()
+
+    def iterkeys(self):
+        return _flatten(self).iterkeys()
+
+    __iter__ = iterkeys
+
+    def itervalues(self):
+        return _flatten(self).itervalues()
+
+    def iteritems(self):
+        return _flatten(self).iteritems()
+
+    def __len__(self):
+        return len(_flatten(self))
+
+    def __repr__(self):
+        return repr(_flatten(self))
+
+
+def _flatten(namespace):
+    # collect the visible content of all layers in a single dict
+    flat = {}
+    layers = object.__getattribute__(namespace, "_layers")
+    for layer in reversed((namespace,) + layers):
+        for name, value in dict.iteritems(layer):
+            if value is HIDDEN:
+                flat.pop(name, None)
+            else:
+                flat[name] = value
+    return flat
+
+
+def _lookup(namespace, name):
+    value = dict.get(namespace, name, _marker)
+    if value is HIDDEN:
+        return _marker
+    if value is not _marker:
+        return value
+    for layer in object.__getattribute__(namespace, "_layers"):
+        value = dict.get(layer, name, _marker)
+        if value is HIDDEN:
+            return _marker
+        if value is not _marker:
+            return value
+    return _marker
+
+
+class EncodingWriter(object):
+    """File-like object that encodes unicode text written to it incrementally.
+
+    Instantiate as EncodingWriter(encoding, chunk_size=8192).
+
+    The encoded text is collected in a list of str chunks of roughly the
+    given size, so that it is never held as one large string.
+    """
+
+    def __init__(self, encoding, chunk_size=8192):
+        self.encoder = codecs.getincrementalencoder(encoding)()
+        self.chunk_size = chunk_size
+        self.chunks = []
+        self.pending = []
+        self.pending_size = 0
+
+    def write(self, text):
+        """Encode and store a piece of text.
+
+        text: unicode, or str which must be ASCII
+        """
+        data = self.encoder.encode(text)
+        if data:
+            self.pending.append(data)
+            self.pending_size += len(data)
+            if self.pending_size >= self.chunk_size:
+                self.flush()
+
+    def write_encoded(self, data):
+        """Store a piece of already encoded data.
+
+        data: str
+        """
+        self.flush()
+        self.chunks.append(data)
+
+    def flush(self):
+        if self.pending:
+            self.chunks.append(''.join(self.pending))
+            self.pending = []
+            self.pending_size = 0
+
+    def close(self):
+        """Finish encoding and return the encoded text.
+
+        returns list of str
+        """
+        data = self.encoder.encode(u'', True)
+        if data:
+            self.pending.append(data)
+        self.flush()
+        return self.chunks
+
+
+def read_config(config_file):
+    """Read settings from the DEFAULT section of an ini-style file.
+
+    returns dict
+    """
+    config = ConfigParser.ConfigParser()
+    config.read(config_file)
+    return dict((key.replace('-', '_'), value)
+                for key, value in config.items('DEFAULT'))
+
+
+def format_exception(exc_info=None):
+    """Format an exception's traceback including any traceback supplements.
+
+    exc_info: (type, value, traceback) as returned by sys.exc_info(),
+              defaults to the exception currently being handled
+
+    returns str, UTF-8 encoded text
+    """
+    if exc_info is None:
+        exc_info = sys.exc_info()
+    msg = "".join(zope.exceptions.exceptionformatter.format_exception(
+        with_filenames=True, *exc_info))
+    if isinstance(msg, unicode):
+        msg = msg.encode('utf-8')
+    return msg
+
+
 def strftime(format, t=None):
     """Similar to time.strftime, but returns unicode.
 
@@ -0,0 +1,108 @@
+# Copyright (c) 2013 Thomas Lotze
+# See also LICENSE.txt
+
+"""Filling the process-wide caches from all input files of a template tree.
+"""
+
+import collections
+import ophelia.cache
+import ophelia.input
+import ophelia.pagetemplate
+import ophelia.util
+import optparse
+import os
+import os.path
+import sys
+import time
+
+
+WarmUpResult = collections.namedtuple("WarmUpResult", "files skipped errors")
+
+
+def input_files(template_root):
+    """Find all input files of a template tree.
+
+    Hidden files and directories as well as editor backup files are ignored.
+
+    template_root: str, file system path to the template root
+
+    returns iterable of str, absolute file system paths
+    """
+    template_root = os.path.abspath(template_root)
+    for dir_path, dir_names, file_names in os.walk(template_root):
+        dir_names[:] = sorted(name for name in dir_names
+                              if not name.startswith('.'))
+        for name in sorted(file_names):
+            if name.startswith('.') or name.endswith('~'):
+                continue
+            yield os.path.join(dir_path, name)
+
+
+def warm_up(template_root, options=None):
+    """Split, compile and cook all input files of a template tree.
+
+    The results are stored in the process-wide caches used by requests.
+    Input encodings are taken from the options; files that can't be decoded
+    accordingly are skipped since scripts may change the encodings while
+    traversing the tree.
+
+    template_root: str, file system path to the template root
+    options: dict of configuration settings
+
+    returns WarmUpResult: the number of files processed, a list of the paths
+            of skipped files and a list of (str, str), paths of files that
+            failed to compile and formatted tracebacks which include the
+            offending template lines
+    """
+    options = options or {}
+    splitter = ophelia.input.Splitter(**options)
+    script_cache_dir = options.get("script_cache_dir")
+    files = 0
+    skipped = []
+    errors = []
+    for file_path in input_files(template_root):
+        files += 1
+        try:
+            signature = ophelia.cache.file_signature(file_path)
+            try:
+                script, text, offset, script_offset = splitter.read(
+                    file_path, signature)
+            except UnicodeError:
+                skipped.append(file_path)
+                continue
+            if script:
+                ophelia.input.compile_script(
+                    script, file_path, script_offset, signature,
+                    script_cache_dir)
+            ophelia.pagetemplate.get_template(
+                text, file_path, offset, signature)
+        except Exception:
+            errors.append((file_path, ophelia.util.format_exception()))
+    return WarmUpResult(files, skipped, errors)
+
+
+def main():
+    parser = optparse.OptionParser(
+        usage='%prog [options] config_file',
+        description='Compile all scripts and templates of an Ophelia site, '
+        'reporting any errors. Exits with status 1 if there were errors.')
+    parser.add_option(
+        '-v', '--verbose', action='store_true', default=False,
+        help='list files skipped because of their encoding')
+    cmd_options, args = parser.parse_args()
+    if len(args) != 1:
+        parser.error('need a configuration file')
+
+    options = ophelia.util.read_config(args[0])
+    start = time.time()
+    result = warm_up(options['template_root'], options)
+    duration = time.time() - start
+
+    for file_path, msg in result.errors:
+        sys.stdout.write('Error in %s:\n%s\n' % (file_path, msg))
+    if cmd_options.verbose:
+        for file_path in result.skipped:
+            sys.stdout.write('Skipped %s\n' % file_path)
+    sys.stdout.write('%d files in %.2f s, %d skipped, %d errors\n' % (
+            result.files, duration, len(result.skipped), len(result.errors)))
+    sys.exit(1 if result.errors else 0)
@@ -0,0 +1,338 @@
+# Copyright (c) 2013 Thomas Lotze
+# See also LICENSE.txt
+
+"""Watching directory trees for changes to the files within.
+
+Changes are reported to listeners by the file system path of the file or
+directory that was modified, added, removed or renamed. Linux' inotify is
+used where available, otherwise the trees are polled periodically.
+"""
+
+import ctypes
+import ctypes.util
+import errno
+import logging
+import ophelia.interfaces
+import os
+import os.path
+import select
+import stat
+import struct
+import threading
+import zope.interface
+
+
+logger = logging.getLogger('ophelia')
+
+IN_MODIFY = 0x2
+IN_ATTRIB = 0x4
+IN_CLOSE_WRITE = 0x8
+IN_MOVED_FROM = 0x40
+IN_MOVED_TO = 0x80
+IN_CREATE = 0x100
+IN_DELETE = 0x200
+IN_DELETE_SELF = 0x400
+IN_MOVE_SELF = 0x800
+IN_Q_OVERFLOW = 0x4000
+IN_IGNORED = 0x8000
+IN_ISDIR = 0x40000000
+IN_CLOEXEC = 0x80000
+
+WATCH_MASK = (IN_MODIFY | IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM |
+              IN_MOVED_TO | IN_CREATE | IN_DELETE | IN_DELETE_SELF |
+              IN_MOVE_SELF)
+
+# struct inotify_event without the name that follows it
+EVENT = struct.Struct("iIII")
+
+
+def walk(path, ancestors=()):
+    """Find a file or directory and everything within, following symlinks.
+
+    Directories linked to from within themselves are not descended into
+    again.
+
+    path: str, file system path
+    ancestors: tuple of (int, int), device and inode numbers of the
+               directories the path is in
+
+    returns iterable of (str, os.stat_result), paths and their stats
+    """
+    try:
+        st = os.stat(path)
+    except OSError:
+        return
+    yield path, st
+    if not stat.S_ISDIR(st.st_mode):
+        return
+    key = (st.st_dev, st.st_ino)
+    if key in ancestors:
+        return
+    try:
+        names = os.listdir(path)
+    except OSError:
+        return
+    ancestors += (key,)
+    for name in sorted(names):
+        for item in walk(os.path.join(path, name), ancestors):
+            yield item
+
+
+class Watcher(object):
+    """Base class of watchers reporting changes within directory trees.
+
+    Instantiate as Watcher(roots).
+
+    roots: iterable of str, file system paths of the directories to watch
+
+    Subclasses implement start() and stop() according to IWatcher.
+    """
+
+    zope.interface.implements(ophelia.interfaces.IWatcher)
+
+    def __init__(self, roots):
+        self.roots = [os.path.abspath(root) for root in roots]
+        self.listeners = []
+
+    def notify(self, path):
+        for listener in list(self.listeners):
+            try:
+                listener(path)
+            except Exception:
+                logger.exception("Error notifying of a change to %s", path)
+
+
+def load_libc():
+    name = ctypes.util.find_library('c')
+    if name is None:
+        return None
+    try:
+        libc = ctypes.CDLL(name, use_errno=True)
+    except OSError:
+        return None
+    if not hasattr(libc, 'inotify_init1'):
+        return None
+    return libc
+
+
+class InotifyWatcher(Watcher):
+    """Watcher using Linux' inotify.
+
+    Each directory in the trees is watched separately. Watches are added for
+    directories that are created or moved into a tree and removed for those
+    that are deleted or moved away. A directory reached through several
+    paths because of symlinks reports changes for all of them.
+
+    raises OSError if inotify is not available
+    """
+
+    def __init__(self, roots):
+        super(InotifyWatcher, self).__init__(roots)
+        self.libc = load_libc()
+        if self.libc is None:
+            raise OSError(errno.ENOSYS, "inotify is not available")
+        self.lock = threading.Lock()
+        self.fd = None
+        self.thread = None
+        # watch descriptors by path, and the paths of watch descriptors
+        self.watches = {}
+        self.paths = {}
+
+    def start(self):
+        self.fd = self.libc.inotify_init1(IN_CLOEXEC)
+        if self.fd < 0:
+            self.fd = None
+            raise_errno()
+        try:
+            for root in self.roots:
+                self.add_tree(root)
+        except OSError:
+            os.close(self.fd)
+            self.fd = None
+            raise
+        self.stop_r, self.stop_w = os.pipe()
+        self.thread = threading.Thread(target=self.run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def stop(self):
+        if self.thread is None:
+            return
+        os.write(self.stop_w, 'x')
+        self.thread.join()
+        self.thread = None
+        for fd in (self.stop_r, self.stop_w, self.fd):
+            os.close(fd)
+        self.fd = None
+        self.watches.clear()
+        self.paths.clear()
+
+    def run(self):
+        while True:
+            try:
+                readable = select.select([self.fd, self.stop_r], [], [])[0]
+            except select.error, e:
+                if e.args[0] == errno.EINTR:
+                    continue
+                raise
+            if self.stop_r in readable:
+                break
+            data = os.read(self.fd, 65536)
+            for wd, mask, name in parse_events(data):
+                try:
+                    self.handle(wd, mask, name)
+                except Exception:
+                    logger.exception("Error handling a file system event")
+
+    def handle(self, wd, mask, name):
+        if mask & IN_Q_OVERFLOW:
+            # events have been lost, so anything may have changed
+            for root in self.roots:
+                self.add_tree(root)
+                self.notify(root)
+            return
+        if mask & IN_IGNORED:
+            self.forget(wd)
+            return
+        with self.lock:
+            dir_paths = list(self.paths.get(wd, ()))
+        for dir_path in dir_paths:
+            path = os.path.join(dir_path, name) if name else dir_path
+            # symlinks to directories don't come with IN_ISDIR
+            if mask & (IN_MOVED_FROM | IN_DELETE):
+                self.remove_tree(path)
+            elif mask & (IN_MOVED_TO | IN_CREATE):
+                self.add_tree(path)
+            self.notify(path)
+
+    def add_tree(self, path):
+        for path, st in walk(path):
+            if stat.S_ISDIR(st.st_mode):
+                self.add_watch(path)
+
+    def add_watch(self, path):
+        wd = self.libc.inotify_add_watch(self.fd, path, WATCH_MASK)
+        if wd < 0:
+            if ctypes.get_errno() == errno.ENOSPC:
+                # running out of watches would make us miss changes
+                raise_errno()
+            # the directory has gone away meanwhile
+            return
+        with self.lock:
+            self.watches[path] = wd
+            paths = self.paths.setdefault(wd, [])
+            if path not in paths:
+                paths.append(path)
+
+    def remove_tree(self, path):
+        prefix = path + os.sep
+        with self.lock:
+            for watched in [watched for watched in self.watches
+                            if watched == path or watched.startswith(prefix)]:
+                wd = self.watches.pop(watched)
+                paths = self.paths.get(wd, [])
+                if watched in paths:
+                    paths.remove(watched)
+                if not paths:
+                    self.paths.pop(wd, None)
+                    self.libc.inotify_rm_watch(self.fd, wd)
+
+    def forget(self, wd):
+        with self.lock:
+            for path in self.paths.pop(wd, ()):
+                if self.watches.get(path) == wd:
+                    del self.watches[path]
+
+
+def parse_events(data):
+    """Parse the inotify events read from an inotify file descriptor.
+
+    returns iterable of (int, int, str), watch descriptor, event mask and
+            name of the file the event concerns, which is empty if the event
+            concerns the watched directory itself
+    """
+    offset = 0
+    while offset + EVENT.size <= len(data):
+        wd, mask, cookie, length = EVENT.unpack_from(data, offset)
+        offset += EVENT.size
+        name = data[offset:offset + length].rstrip('\0')
+        offset += length
+        yield wd, mask, name
+
+
+def raise_errno():
+    code = ctypes.get_errno()
+    raise OSError(code, os.strerror(code))
+
+
+class PollingWatcher(Watcher):
+    """Watcher comparing the signatures of all files in the trees
+    periodically.
+
+    Instantiate as PollingWatcher(roots, interval=1).
+
+    interval: number of seconds to wait between looking at the trees
+    """
+
+    def __init__(self, roots, interval=1):
+        super(PollingWatcher, self).__init__(roots)
+        self.interval = interval
+        self.stopping = threading.Event()
+        self.thread = None
+
+    def start(self):
+        self.stopping.clear()
+        self.snapshot = self.take_snapshot()
+        self.thread = threading.Thread(target=self.run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def stop(self):
+        if self.thread is None:
+            return
+        self.stopping.set()
+        self.thread.join()
+        self.thread = None
+
+    def run(self):
+        while True:
+            self.stopping.wait(self.interval)
+            if self.stopping.isSet():
+                break
+            self.poll()
+
+    def poll(self):
+        """Look at the trees once, reporting any changes since last time.
+        """
+        snapshot = self.take_snapshot()
+        previous = self.snapshot
+        self.snapshot = snapshot
+        for path in sorted(set(previous) | set(snapshot)):
+            if previous.get(path) != snapshot.get(path):
+                self.notify(path)
+
+    def take_snapshot(self):
+        signatures = {}
+        for root in self.roots:
+            for path, st in walk(root):
+                signatures[path] = (st.st_mtime, st.st_size, st.st_ino)
+        return signatures
+
+
+def watch(roots, interval=1):
+    """Start watching directory trees by the best means available.
+
+    roots: iterable of str, file system paths of the directories to watch
+    interval: number of seconds between looking at the trees if they need to
+              be polled
+
+    returns Watcher, started already
+    """
+    try:
+        watcher = InotifyWatcher(roots)
+        watcher.start()
+    except OSError, e:
+        logger.info("Polling for file changes since inotify failed: %s", e)
+        watcher = PollingWatcher(roots, interval)
+        watcher.start()
+    return watcher
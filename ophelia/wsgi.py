@@ -5,27 +5,76 @@
 this application.
 """
 
-import ConfigParser
+import email.utils
+import hashlib
 import logging
+import mimetypes
+import ophelia.bundle
+import ophelia.cache
+import ophelia.compression
+import ophelia.frozen
+import ophelia.input
+import ophelia.metrics
+import ophelia.pagetemplate
 import ophelia.request
+import ophelia.timing
 import ophelia.util
+import ophelia.warmup
+import ophelia.watch
 import os.path
+import signal
+import stat
 import sys
+import threading
+import time
 import wsgiref.simple_server
 import xsendfile
-import zope.exceptions.exceptionformatter
 
 
 logger = logging.getLogger('ophelia')
 logger.addHandler(logging.StreamHandler())
 
+# whether paths below document roots are directories, by file signature
+document_directory_cache = ophelia.cache.FileCache(1000)
+
+# content types of compressed files served as they are, by their encoding
+ENCODED_TYPES = {
+    'gzip': 'application/gzip',
+    'bzip2': 'application/x-bzip2',
+    'compress': 'application/x-compress',
+    'xz': 'application/x-xz',
+    }
+
+
+def is_directory(path):
+    """Tell whether a path below a document root points to a directory.
+
+    The answer is cached by the path's signature, so it costs no file system
+    access while the document root is being watched. Unlike
+    ophelia.request.list_directory(), this neither reads the directory nor
+    fills the directory cache used in traversing the template root.
+
+    path: str, file system path
+
+    returns bool
+    """
+    try:
+        signature = ophelia.cache.file_signature(path)
+    except OSError:
+        return False
+    result = document_directory_cache.lookup(path, signature)
+    if result is None:
+        result = os.path.isdir(path)
+        document_directory_cache.store(path, signature, result)
+    return result
+
 
 class Request(ophelia.request.Request):
 
     @ophelia.request.push_request
-    def __call__(self):
+    def traverse(self, **context):
         try:
-            return super(Request, self).__call__()
+            super(Request, self).traverse(**context)
         except ophelia.request.NotFound:
             env = self.env
             document_root = env.get('document_root')
@@ -40,7 +89,7 @@ class Request(ophelia.request.Request):
                 raise ophelia.request.Redirect(path=path[:-len(index_name)])
 
             fs_path = os.path.join(document_root, *parts)
-            if os.path.isdir(fs_path):
+            if is_directory(fs_path):
                 if not path.endswith('/'):
                     raise ophelia.request.Redirect(path=path + '/')
 
@@ -56,6 +105,188 @@ class Application(object):
     def __init__(self, options=None):
         self.options = options or {}
 
+        template_cache_size = self.options.get('template_cache_size')
+        if template_cache_size:
+            ophelia.pagetemplate.template_cache.max_size = int(
+                template_cache_size)
+        split_cache_size = self.options.get('split_cache_size')
+        if split_cache_size:
+            ophelia.input.split_cache.max_size = int(split_cache_size)
+        code_cache_size = self.options.get('code_cache_size')
+        if code_cache_size:
+            ophelia.input.code_cache.max_size = int(code_cache_size)
+
+        self.response_cache = None
+        response_cache_size = int(self.options.get('response_cache_size', 0))
+        response_cache_file = self.options.get('response_cache_file')
+        if response_cache_size and response_cache_file:
+            self.response_cache = ophelia.cache.SharedResponseCache(
+                response_cache_file, response_cache_size, int(
+                    self.options.get('response_cache_slot_size', 65536)))
+        elif response_cache_size:
+            self.response_cache = ophelia.cache.ResponseCache(
+                response_cache_size)
+        # file system paths, sizes and headers of static files by document
+        # root and path, used for static_stat_ttl seconds before checking
+        # the file again
+        self.static_cache = ophelia.cache.LRUCache(
+            int(self.options.get('static_cache_size', 1000)))
+        self.static_stat_ttl = float(self.options.get('static_stat_ttl', 1))
+        self.xsendfile_apps = {}
+        self.watched_roots = set()
+        # counts reported changes to tell whether a lookup may be stale
+        self.generation = 0
+
+        self.not_found_cache = None
+        not_found_cache_size = int(
+            self.options.get('not_found_cache_size', 0))
+        if not_found_cache_size:
+            self.not_found_cache = ophelia.cache.NegativeCache(
+                not_found_cache_size,
+                float(self.options.get('not_found_cache_ttl', 10)))
+
+        self.render_cache = None
+        render_cache_dir = self.options.get('render_cache_dir')
+        if render_cache_dir:
+            self.render_cache = ophelia.cache.RenderCache(render_cache_dir)
+        self.response_cache_ttl = float(
+            self.options.get('response_cache_ttl', 60))
+        self.gzip_cache = None
+        gzip_cache_size = int(self.options.get('gzip_cache_size', 10000000))
+        if gzip_cache_size:
+            self.gzip_cache = ophelia.cache.LRUCache(gzip_cache_size)
+        self.response_cache_vary = [
+            'HTTP_' + name.strip().upper().replace('-', '_')
+            for name in self.options.get(
+                'response_cache_vary', '').replace(',', ' ').split()]
+
+        # compile the one header expression every page uses before serving;
+        # headers preset by the server arrive with each request and are
+        # compiled when first seen
+        ophelia.request.compile_header(
+            ophelia.request.CONTENT_TYPE_EXPRESSION)
+
+        self.watcher = None
+        if boolean(self.options.get('watch', False)):
+            self.start_watching()
+
+        self.tree = None
+        if (boolean(self.options.get('frozen', False)) or
+            self.options.get('bundle_file')):
+            if self.not_found_cache is not None:
+                # missing paths stay missing until the tree is reloaded
+                self.not_found_cache.ttl = float('inf')
+            self.load_tree()
+            reload_signal = self.options.get('reload_signal')
+            if reload_signal:
+                self.reload_on_signal(reload_signal)
+
+        macro_files = self.options.get('macro_files', '').split()
+        if macro_files:
+            template_root = self.options.get('template_root', '')
+            library = ophelia.pagetemplate.load_macro_library(
+                [os.path.abspath(os.path.join(template_root, name))
+                 for name in macro_files],
+                ophelia.input.Splitter(**self.options))
+            self.options = dict(self.options, **{'ophelia.macros': library})
+
+        if boolean(self.options.get('warm_up', False)):
+            result = ophelia.warmup.warm_up(
+                self.options['template_root'], self.options)
+            for file_path, msg in result.errors:
+                logger.error("Error in %s:\n%s", file_path, msg)
+
+        self.metrics = None
+        self.metrics_path = self.options.get('metrics_path')
+        if self.metrics_path:
+            buckets = self.options.get('metrics_buckets')
+            if buckets:
+                buckets = sorted(float(bound) for bound in buckets.split())
+            self.metrics = ophelia.metrics.Metrics(
+                buckets or ophelia.metrics.BUCKETS)
+
+    def start_watching(self):
+        """Watch the template and document roots for changes.
+
+        While the trees are being watched, file signatures, directory
+        listings and static file information are kept until a change is
+        reported instead of looking at the file system for each request.
+        """
+        roots = [self.options['template_root']]
+        document_root = self.options.get('document_root')
+        if document_root:
+            roots.append(document_root)
+            self.watched_roots.add(document_root)
+        self.watcher = ophelia.watch.watch(
+            roots, float(self.options.get('watch_interval', 1)))
+        if ophelia.cache.signature_cache is None:
+            ophelia.cache.signature_cache = ophelia.cache.SignatureCache(
+                int(self.options.get('signature_cache_size', 10000)))
+        self.watcher.listeners.extend([
+                ophelia.cache.signature_cache.invalidate, self.invalidate])
+        ophelia.cache.signature_cache.add_roots(self.watcher.roots)
+
+    def load_tree(self):
+        """Load the template tree into memory for requests to traverse.
+
+        Replaces any tree loaded before once the new one is complete, so
+        requests being processed meanwhile see either tree as a whole.
+        """
+        bundle_file = self.options.get('bundle_file')
+        if bundle_file:
+            tree = ophelia.bundle.Bundle(
+                bundle_file, self.options['template_root'])
+        else:
+            tree = ophelia.frozen.FrozenTree(
+                self.options['template_root'], self.options)
+        for file_path, msg in tree.errors:
+            logger.error("Error in %s:\n%s", file_path, msg)
+        logger.info("Loaded %s files in %s directories from %s "
+                    "(%s bytes)", tree.file_count,
+                    len(tree.directories), tree.template_root, tree.size)
+        self.options = dict(self.options, **{'ophelia.tree': tree})
+        self.tree = tree
+        if self.not_found_cache is not None:
+            self.not_found_cache.clear()
+
+    def reload_on_signal(self, name):
+        """Load the template tree again whenever a signal is received.
+
+        name: str, name of the signal such as "SIGUSR1" or "HUP"
+        """
+        if not name.upper().startswith('SIG'):
+            name = 'SIG' + name
+        signum = getattr(signal, name.upper(), None)
+        if not isinstance(signum, int):
+            raise ValueError("Unknown signal %s." % name)
+
+        def reload(signum, frame):
+            # loading takes a while, the interrupted thread shouldn't wait
+            threading.Thread(target=self.load_tree).start()
+        try:
+            signal.signal(signum, reload)
+        except ValueError:
+            logger.warning("Can't reload the template tree on %s as signal "
+                           "handlers can only be set in the main thread.",
+                           name)
+
+    def invalidate(self, path):
+        """Forget looking up static files and missing pages after a change.
+        """
+        self.generation += 1
+        self.static_cache.clear()
+        if self.not_found_cache is not None:
+            self.not_found_cache.clear()
+
+    def close(self):
+        """Stop watching for changes to the template and document roots.
+        """
+        if self.watcher is None:
+            return
+        ophelia.cache.signature_cache.remove_roots(self.watcher.roots)
+        self.watcher.stop()
+        self.watcher = None
+
     @classmethod
     def paste_app_factory(cls, global_conf, **local_conf):
         options = global_conf.copy()
@@ -65,9 +296,71 @@ class Application(object):
         return cls(options)
 
     def __call__(self, env, start_response):
+        if self.metrics is None:
+            return self.respond(env, start_response)
+
+        path = env.get("PATH_INFO", "")
+        if path == self.metrics_path:
+            return self.metrics_response(env, start_response)
+
+        status = []
+        def metrics_start_response(status_line, headers, exc_info=None):
+            status[:] = [status_line]
+            return start_response(status_line, headers, exc_info)
+        start = time.time()
+        try:
+            return self.respond(env, metrics_start_response)
+        finally:
+            self.metrics.observe(
+                path, status[0] if status else "500", time.time() - start)
+
+    def respond(self, env, start_response):
         env = ophelia.util.Namespace(self.options, **env)
+
+        cache_key = None
+        if (self.response_cache is not None and
+            env["REQUEST_METHOD"] in ("GET", "HEAD")):
+            cache_key = self.response_cache_key(env)
+            response = self.response_cache.lookup(cache_key)
+            if response is not None:
+                status, response_headers, body = response
+                if boolean(env.get('conditional_get', False)):
+                    validators = dict(
+                        (key, value) for key, value in response_headers
+                        if key.lower() in ('etag', 'last-modified'))
+                    if self.not_modified(env, validators):
+                        start_response(
+                            "304 Not modified", validators.items())
+                        return []
+                if boolean(env.get('gzip', False)):
+                    response_headers, body = self.compress(
+                        env, response_headers, body)
+                start_response(status, response_headers)
+                return body if env["REQUEST_METHOD"] == "GET" else []
+
+        # every query string would leave a file behind on disk
+        if (self.render_cache is not None and
+            not env.get('QUERY_STRING') and
+            env["REQUEST_METHOD"] in ("GET", "HEAD")):
+            if cache_key is None:
+                cache_key = self.response_cache_key(env)
+            # pages are as valid as the tree they would be rendered from
+            tree = self.tree
+            page = self.render_cache.lookup(
+                cache_key, tree.file_signature if tree is not None else None)
+            if page is not None:
+                return self.send_rendered(env, start_response, *page)
+
+        if (self.not_found_cache is not None and
+            self.not_found_cache.lookup(
+                (env.get('document_root'), env["PATH_INFO"]))):
+            return self.not_found(env, start_response)
+
         path = env["PATH_INFO"].lstrip('/')
         context = env.get("ophelia.context", {})
+        server_timing = boolean(env.get("server_timing", False))
+        if server_timing:
+            env["timing"] = True
 
         request = Request(
             path, env.pop("template_root"), env.pop("site"), **env)
@@ -78,10 +371,38 @@ class Application(object):
 
         try:
             try:
-                response_headers, body = request(**context)
+                request.traverse(**context)
             except ophelia.request.NotFound, e:
+                if (self.not_found_cache is not None and
+                    request.cache_ttl != 0):
+                    dependencies = self.missing_document(env, e.args)
+                    if dependencies is not None:
+                        dependencies.update(request.dependencies)
+                        self.not_found_cache.store(
+                            (env.get('document_root'), env["PATH_INFO"]),
+                            dependencies)
+                        return self.not_found(env, start_response)
                 env['PATH_INFO'] = e.args[0]
                 return self.sendfile(env, start_response)
+
+            validators = {}
+            if (boolean(env.get('conditional_get', False)) and
+                request.cache_ttl != 0):
+                validators = self.validators(env, request)
+                if self.not_modified(env, validators):
+                    start_response("304 Not modified", validators.items())
+                    return []
+
+            response_headers, body = request.build()
+            if isinstance(body, basestring):
+                body = [body]
+            present = set(name.lower() for name in response_headers)
+            for key, value in validators.iteritems():
+                if key.lower() not in present:
+                    response_headers[key] = value
+            if 'content-length' not in present:
+                response_headers['Content-Length'] = sum(
+                    len(chunk) for chunk in body)
         except ophelia.request.Redirect, e:
             status = "301 Moved permanently"
             text = ('The resource you were trying to access '
@@ -90,11 +411,10 @@ class Application(object):
             response_headers["location"] = e.uri
         except Exception, e:
             status = "500 Internal server error"
+            if self.metrics is not None:
+                self.metrics.count_error()
             exc_info = sys.exc_info()
-            msg = "".join(zope.exceptions.exceptionformatter.format_exception(
-                with_filenames=True, *exc_info))
-            if isinstance(msg, unicode):
-                msg = msg.encode('utf-8')
+            msg = ophelia.util.format_exception(exc_info)
             logger.error(msg)
             if boolean(env.get('debug', False)):
                 text = '<pre>\n%s\n</pre>' % msg
@@ -105,20 +425,515 @@ class Application(object):
 
         response_headers = [(key, str(value))
                             for key, value in response_headers.iteritems()]
+
+        shared = self.shareable(response_headers)
+        if (self.response_cache is not None and cache_key is not None and
+            shared and body is not None and env["REQUEST_METHOD"] == "GET"):
+            ttl = request.cache_ttl
+            if ttl is None:
+                ttl = self.response_cache_ttl
+            if ttl > 0:
+                self.response_cache.store(
+                    cache_key, (status, response_headers, body), ttl)
+
+        if (self.render_cache is not None and cache_key is not None and
+            shared and not env.get('QUERY_STRING') and
+            body is not None and request.cache_ttl != 0):
+            compress = None
+            if (boolean(env.get('gzip', False)) and
+                self.compressible(env, response_headers, body)):
+                compress = lambda body: ophelia.compression.compress(
+                    body, int(env.get('gzip_level', 6)))
+            self.render_cache.store(
+                cache_key, (status, response_headers, body),
+                request.dependencies, request.cache_ttl, compress)
+
+        if server_timing and body is not None:
+            # not cached as it describes the rendering of this very response
+            response_headers = response_headers + [(
+                    'Server-Timing',
+                    ophelia.timing.server_timing(request.timer.totals()))]
+
+        if body is not None and boolean(env.get('gzip', False)):
+            response_headers, body = self.compress(
+                env, response_headers, body)
         start_response(status, response_headers, exc_info)
 
         if env["REQUEST_METHOD"] == "GET":
             if body is None:
-                body = self.error_body % {"status": status, "text": text}
-            return [body]
+                body = [self.error_body % {"status": status, "text": text}]
+            return body
         else:
             return []
 
+    def validators(self, env, request):
+        """Compute cache validators from the files a response depends upon.
+
+        The ETag is derived from the requested path and the signatures of all
+        input files processed while traversing; the Last-Modified date is the
+        latest modification time of any of these files.
+
+        returns dict of ETag and Last-Modified header values
+        """
+        digest = hashlib.md5(repr((
+            env["PATH_INFO"], env.get("QUERY_STRING", ""),
+            sorted(request.dependencies.items()))))
+        validators = {"ETag": '"%s"' % digest.hexdigest()}
+        mtimes = [signature[0]
+                  for signature in request.dependencies.itervalues()
+                  if signature is not None]
+        if mtimes:
+            validators["Last-Modified"] = email.utils.formatdate(
+                int(max(mtimes)), usegmt=True)
+        return validators
+
+    def not_modified(self, env, validators):
+        """Tell whether the client's copy of a response is still valid.
+
+        validators: dict mapping response header names (such as ETag and
+                    Last-Modified) to values, which are sent with a 304
+                    response
+
+        If gzip is on and accepted by the client, the ETag of the compressed
+        variant matches as well, in which case the ETag in validators is
+        replaced by that of the variant.
+
+        returns bool
+        """
+        if_none_match = env.get("HTTP_IF_NONE_MATCH")
+        if if_none_match is not None:
+            etag = None
+            for key, value in validators.items():
+                if key.lower() == "etag":
+                    etag, etag_key = value, key
+            if etag is None:
+                return False
+            tags = [tag.strip() for tag in if_none_match.split(",")]
+            if "*" in tags or etag in tags:
+                return True
+            if (gzip_etag(etag) in tags and
+                boolean(env.get("gzip", False)) and
+                ophelia.compression.accepts_gzip(env)):
+                # the client has the compressed variant, which is identified
+                # by its own ETag in the response
+                validators[etag_key] = gzip_etag(etag)
+                return True
+            return False
+
+        validators = dict((key.lower(), value)
+                          for key, value in validators.iteritems())
+        if_modified_since = env.get("HTTP_IF_MODIFIED_SINCE")
+        last_modified = validators.get("last-modified")
+        if if_modified_since is None or last_modified is None:
+            return False
+        client_date = email.utils.parsedate_tz(if_modified_since)
+        if client_date is None:
+            return False
+        return (email.utils.mktime_tz(email.utils.parsedate_tz(last_modified))
+                <= email.utils.mktime_tz(client_date))
+
+    def compress(self, env, response_headers, body):
+        """Compress a response body if the client accepts gzip encoding.
+
+        Compressed bodies are kept in a cache so the same content isn't
+        compressed again for each request.
+
+        response_headers: list of (str, str)
+        body: list of str chunks
+
+        returns (list of (str, str), list of str): headers and body
+        """
+        if not self.compressible(env, response_headers, body):
+            return response_headers, body
+        response_headers = add_vary(
+            [(key, value) for key, value in response_headers
+             if key.lower() != 'content-length'], 'Accept-Encoding')
+        if not ophelia.compression.accepts_gzip(env):
+            response_headers.append(('Content-Length', str(
+                sum(len(chunk) for chunk in body))))
+            return response_headers, body
+
+        level = int(env.get('gzip_level', 6))
+        digest = hashlib.md5()
+        for chunk in body:
+            digest.update(chunk)
+        key = (digest.digest(), level)
+        data = None
+        if self.gzip_cache is not None:
+            data = self.gzip_cache.get(key)
+        if data is None:
+            data = ophelia.compression.compress(body, level)
+            if self.gzip_cache is not None:
+                self.gzip_cache.set(key, data, len(data))
+
+        for i, (name, value) in enumerate(response_headers):
+            if name.lower() == 'etag':
+                response_headers[i] = (name, gzip_etag(value))
+        response_headers.append(('Content-Encoding', 'gzip'))
+        response_headers.append(('Content-Length', str(len(data))))
+        return response_headers, [data]
+
+    def shareable(self, response_headers):
+        """Tell whether a response may be sent to clients other than the one
+        it was made for.
+
+        Responses setting cookies or marked as private or not to be stored
+        by their Cache-Control header are meant for one client only.
+
+        response_headers: list of (str, str)
+
+        returns bool
+        """
+        for key, value in response_headers:
+            key = key.lower()
+            if key == 'set-cookie':
+                return False
+            if key == 'cache-control':
+                directives = set(directive.split('=')[0].strip().lower()
+                                 for directive in value.split(','))
+                if directives & set(['private', 'no-store']):
+                    return False
+        return True
+
+    def compressible(self, env, response_headers, body):
+        """Tell whether a response body is worth compressing.
+
+        response_headers: list of (str, str)
+        body: list of str chunks
+
+        returns bool
+        """
+        headers = dict((key.lower(), value)
+                       for key, value in response_headers)
+        return ('content-encoding' not in headers and
+                ophelia.compression.compressible(
+                    headers.get('content-type', '')) and
+                sum(len(chunk) for chunk in body) >=
+                int(env.get('gzip_min_size', 1024)))
+
+    def send_rendered(self, env, start_response, status, response_headers,
+                      body_path):
+        """Answer a request by a page from the render cache.
+
+        The body is handed to the static file server configured by the
+        xsendfile option, with the page's own headers replacing those derived
+        from the body file.
+
+        body_path: str, path of the body file relative to the cache directory
+        """
+        if boolean(env.get('conditional_get', False)):
+            validators = dict(
+                (key, value) for key, value in response_headers
+                if key.lower() in ('etag', 'last-modified'))
+            if self.not_modified(env, validators):
+                start_response("304 Not modified", validators.items())
+                return []
+
+        response_headers = [(key, value) for key, value in response_headers
+                            if key.lower() != 'content-length']
+        fs_path = os.path.join(self.render_cache.directory, body_path)
+        if (boolean(env.get('gzip', False)) and
+            os.path.isfile(fs_path + '.gz')):
+            response_headers = add_vary(response_headers, 'Accept-Encoding')
+            if ophelia.compression.accepts_gzip(env):
+                body_path += '.gz'
+                fs_path += '.gz'
+                response_headers = [
+                    (key, gzip_etag(value) if key.lower() == 'etag'
+                     else value)
+                    for key, value in response_headers]
+                response_headers.append(('Content-Encoding', 'gzip'))
+
+        if env["REQUEST_METHOD"] == "HEAD":
+            response_headers.append(
+                ('Content-Length', str(os.path.getsize(fs_path))))
+            start_response(status, response_headers)
+            return []
+
+        def sendfile_start_response(status, sender_headers, exc_info=None):
+            if status.startswith('20'):
+                sender_headers = add_vary([
+                    (key, value) for key, value in sender_headers
+                    if key.lower() not in (
+                        'content-type', 'content-encoding', 'etag',
+                        'last-modified')] + response_headers)
+            return start_response(status, sender_headers, exc_info)
+
+        env['PATH_INFO'] = '/' + body_path.replace(os.sep, '/')
+        sender = env.get('xsendfile', 'serve')
+        if sender == 'serve':
+            # the page's validators have been checked already
+            env.pop('HTTP_IF_NONE_MATCH', None)
+            env.pop('HTTP_IF_MODIFIED_SINCE', None)
+            env['document_root'] = self.render_cache.directory
+            # body files are rewritten when a page is rendered again, so
+            # look at them afresh rather than trusting the static file cache
+            for path in (env['PATH_INFO'], env['PATH_INFO'] + '.gz'):
+                self.static_cache.pop((self.render_cache.directory, path))
+            return self.serve_static(env, sendfile_start_response)
+        key = (self.render_cache.directory, sender)
+        xsendfile_app = self.xsendfile_apps.get(key)
+        if xsendfile_app is None:
+            if sender == 'nginx':
+                # the document root's internal location can't serve the cache
+                sender = xsendfile.NginxSendfile('/-internal-render-')
+            xsendfile_app = self.xsendfile_apps[key] = \
+                xsendfile.XSendfileApplication(key[0], sender)
+        return xsendfile_app(env, sendfile_start_response)
+
+    def response_cache_key(self, env):
+        return ((env["PATH_INFO"], env.get("QUERY_STRING", "")) +
+                tuple(env.get(name) for name in self.response_cache_vary))
+
+    def metrics_response(self, env, start_response):
+        body = self.metrics.render([
+                ('template', ophelia.pagetemplate.template_cache),
+                ('split', ophelia.input.split_cache),
+                ('code', ophelia.input.code_cache),
+                ('directory', ophelia.request.directory_cache),
+                ('document_directory', document_directory_cache),
+                ('signature', ophelia.cache.signature_cache),
+                ('response', self.response_cache),
+                ('render', self.render_cache),
+                ('not_found', self.not_found_cache),
+                ('gzip', self.gzip_cache),
+                ], self.gauges())
+        start_response("200 OK", [
+                ("Content-Type", ophelia.metrics.CONTENT_TYPE),
+                ("Content-Length", str(len(body))),
+                ("Cache-Control", "no-cache"),
+                ])
+        return [body] if env["REQUEST_METHOD"] != "HEAD" else []
+
+    def gauges(self):
+        if self.tree is None:
+            return []
+        return [
+            ('ophelia_frozen_tree_files',
+             'Number of input files in the frozen template tree.',
+             self.tree.file_count),
+            ('ophelia_frozen_tree_bytes',
+             'Estimated memory taken up by the frozen template tree, or the '
+             'size of the bundle file it was loaded from.',
+             self.tree.size),
+            ]
+
     def sendfile(self, env, start_response):
-        xsendfile_app = xsendfile.XSendfileApplication(
-            env['document_root'], env.get('xsendfile', 'serve'))
+        if self.metrics is not None:
+            self.metrics.count_sendfile()
+        sender = env.get('xsendfile', 'serve')
+        if sender == 'serve':
+            return self.serve_static(env, start_response)
+        if boolean(env.get('gzip', False)):
+            parts = env['PATH_INFO'].split('/')
+            fs_path = os.path.join(env['document_root'], *parts)
+            content_type = mimetypes.guess_type(fs_path)[0]
+            if (content_type and
+                ophelia.compression.compressible(content_type) and
+                os.path.isfile(fs_path + '.gz')):
+                # use a precompressed variant if there is one
+                if ophelia.compression.accepts_gzip(env):
+                    env['PATH_INFO'] += '.gz'
+                    start_response = self.gzip_start_response(
+                        start_response, content_type)
+                else:
+                    start_response = self.gzip_start_response(
+                        start_response)
+        key = (env['document_root'], sender)
+        xsendfile_app = self.xsendfile_apps.get(key)
+        if xsendfile_app is None:
+            xsendfile_app = self.xsendfile_apps[key] = \
+                xsendfile.XSendfileApplication(*key)
         return xsendfile_app(env, start_response)
 
+    def serve_static(self, env, start_response):
+        """Serve a file from the document root.
+
+        Supports conditional and single byte-range requests as well as
+        precompressed variants of files if the gzip option is switched on.
+        The body is passed to the server's wsgi.file_wrapper if available,
+        which may send the file without copying it through Python.
+        """
+        if env["REQUEST_METHOD"] not in ("GET", "HEAD"):
+            return self.static_error(
+                env, start_response, "405 Method not allowed",
+                "The requested resource can only be retrieved.",
+                [("Allow", "GET, HEAD")])
+
+        document_root = env['document_root']
+        path = env['PATH_INFO']
+        info = self.static_file(document_root, path)
+        if info is None:
+            return self.static_error(
+                env, start_response, "404 Not found",
+                "The requested resource was not found on this server.")
+        fs_path, size, response_headers = info
+        validators = dict(response_headers[1:3])
+
+        if boolean(env.get('gzip', False)):
+            content_type = response_headers[0][1]
+            variant = (ophelia.compression.compressible(content_type) and
+                       self.static_file(document_root, path + '.gz'))
+            if variant:
+                # use a precompressed variant if there is one
+                response_headers = response_headers + [
+                    ('Vary', 'Accept-Encoding')]
+                if ophelia.compression.accepts_gzip(env):
+                    fs_path, size, variant_headers = variant
+                    validators = dict(variant_headers[1:3])
+                    validators['ETag'] = gzip_etag(validators['ETag'])
+                    response_headers = (
+                        [response_headers[0]] + validators.items() +
+                        response_headers[3:] +
+                        [('Content-Encoding', 'gzip')])
+
+        if self.not_modified(env, validators):
+            start_response("304 Not modified", validators.items())
+            return []
+
+        try:
+            file_ = open(fs_path, 'rb')
+        except IOError:
+            self.static_cache.pop((document_root, path))
+            return self.static_error(
+                env, start_response, "404 Not found",
+                "The requested resource was not found on this server.")
+
+        status = "200 OK"
+        start, length = 0, size
+        byte_range = env.get('HTTP_RANGE')
+        if_range = env.get('HTTP_IF_RANGE')
+        if (byte_range is not None and
+            (if_range is None or if_range in validators.values())):
+            try:
+                byte_range = parse_range(byte_range, size)
+            except ValueError:
+                file_.close()
+                return self.static_error(
+                    env, start_response,
+                    "416 Requested range not satisfiable",
+                    "The requested range is not available.",
+                    [('Content-Range', 'bytes */%s' % size)])
+            if byte_range is not None:
+                start, end = byte_range
+                length = end - start + 1
+                status = "206 Partial content"
+                response_headers = response_headers + [
+                    ('Content-Range', 'bytes %s-%s/%s' % (start, end, size))]
+
+        start_response(status, response_headers + [
+                ('Content-Length', str(length))])
+        if env["REQUEST_METHOD"] == "HEAD":
+            file_.close()
+            return []
+        if start or length != size:
+            file_.seek(start)
+            return read_file(file_, length)
+        file_wrapper = env.get('wsgi.file_wrapper')
+        if file_wrapper is not None:
+            return file_wrapper(file_, 65536)
+        return read_file(file_, length)
+
+    def static_file(self, document_root, path):
+        """Look up a file in the document root.
+
+        Results are kept in the static file cache and used without checking
+        the file system again for the number of seconds set by the
+        static_stat_ttl option, or until a change is reported if the document
+        root is being watched.
+
+        document_root: str, file system path of the document root
+        path: str, the requested path
+
+        returns (str, int, list of (str, str)) or None: the file's path and
+                size and the response headers Content-Type, ETag,
+                Last-Modified and Accept-Ranges, in this order
+        """
+        key = (document_root, path)
+        now = time.time()
+        entry = self.static_cache.get(key)
+        if entry is not None and entry[0] > now:
+            return entry[1]
+        generation = self.generation
+
+        root = os.path.realpath(document_root)
+        fs_path = os.path.realpath(os.path.join(root, *path.split('/')))
+        info = None
+        if fs_path.startswith(root + os.sep):
+            try:
+                st = os.stat(fs_path)
+            except OSError:
+                st = None
+            if st is not None and stat.S_ISREG(st.st_mode):
+                content_type, encoding = mimetypes.guess_type(fs_path)
+                if encoding:
+                    # don't make clients decompress e.g. archive downloads
+                    content_type = ENCODED_TYPES.get(encoding)
+                headers = [
+                    ('Content-Type',
+                     content_type or 'application/octet-stream'),
+                    ('ETag', '"%s"' % hashlib.md5(repr(
+                                (st.st_mtime, st.st_size, st.st_ino))
+                                                 ).hexdigest()),
+                    ('Last-Modified',
+                     email.utils.formatdate(int(st.st_mtime), usegmt=True)),
+                    ('Accept-Ranges', 'bytes'),
+                    ]
+                info = (fs_path, st.st_size, headers)
+        ttl = self.static_stat_ttl
+        if document_root in self.watched_roots:
+            if generation != self.generation:
+                # a change was reported while looking at the file
+                return info
+            ttl = float('inf')
+        self.static_cache.set(key, (now + ttl, info))
+        return info
+
+    def missing_document(self, env, args):
+        """Check whether there is no document on disk for a missing page.
+
+        args: arguments of the NotFound exception raised by traversal, which
+              hold the path of the document to look for if any
+
+        returns dict mapping the file system path of the document to None,
+                or None if the document exists
+        """
+        document_root = env.get('document_root')
+        if not document_root:
+            return {}
+        path = args[0]
+        if self.static_file(document_root, path) is not None:
+            return None
+        return {os.path.join(document_root, *path.split('/')): None}
+
+    def not_found(self, env, start_response):
+        return self.static_error(
+            env, start_response, "404 Not found",
+            "The requested resource was not found on this server.")
+
+    def static_error(self, env, start_response, status, text, headers=()):
+        body = self.error_body % {"status": status, "text": text}
+        start_response(status, [
+                ("Content-Type", "text/html"),
+                ("Content-Length", str(len(body))),
+                ] + list(headers))
+        return [body] if env["REQUEST_METHOD"] != "HEAD" else []
+
+    def gzip_start_response(self, start_response, content_type=None):
+        def wrapper(status, response_headers, exc_info=None):
+            response_headers = add_vary(response_headers, 'Accept-Encoding')
+            if content_type is not None:
+                response_headers = [
+                    (key, value) for key, value in response_headers
+                    if key.lower() not in ('content-type',
+                                           'content-encoding')]
+                response_headers.extend([
+                        ('Content-Type', content_type),
+                        ('Content-Encoding', 'gzip'),
+                        ])
+            return start_response(status, response_headers, exc_info)
+        return wrapper
+
     error_body = """\
         <html>
           <head>
@@ -134,6 +949,94 @@ class Application(object):
         """.replace(" ", "")
 
 
+def parse_range(value, size):
+    """Parse the value of a Range request header.
+
+    value: str, the header value
+    size: int, the size of the requested file
+
+    returns (int, int), the first and last byte position requested, or None
+            if the header is to be ignored because it is malformed or asks
+            for multiple ranges
+
+    raises ValueError if the range doesn't overlap the file
+    """
+    unit, sep, ranges = value.partition('=')
+    if unit.strip().lower() != 'bytes' or ',' in ranges:
+        return None
+    first, sep, last = [part.strip() for part in ranges.partition('-')]
+    if (not sep or not (first or last) or
+        first and not first.isdigit() or last and not last.isdigit()):
+        return None
+    if first:
+        start = int(first)
+        end = int(last) if last else size - 1
+        if last and end < start:
+            return None
+    else:
+        suffix = int(last)
+        if not suffix:
+            raise ValueError("Empty suffix range.")
+        start = max(size - suffix, 0)
+        end = size - 1
+    if start >= size:
+        raise ValueError("Range starts beyond the end of the file.")
+    return start, min(end, size - 1)
+
+
+def read_file(file_, length, block_size=65536):
+    """Read part of a file in blocks, closing the file in the end.
+
+    file_: file object positioned at the start of the part to read
+    length: int, number of bytes to read
+
+    returns iterator of str
+    """
+    try:
+        while length > 0:
+            data = file_.read(min(block_size, length))
+            if not data:
+                break
+            length -= len(data)
+            yield data
+    finally:
+        file_.close()
+
+
+def gzip_etag(etag):
+    """Derive the ETag of a gzip-compressed variant from the original's.
+    """
+    if etag.endswith('"'):
+        return etag[:-1] + '-gzip"'
+    return etag
+
+
+def add_vary(response_headers, *names):
+    """Merge all Vary headers of a response into one, adding header names.
+
+    response_headers: list of (str, str)
+    names: str, names of request headers the response varies upon
+
+    returns list of (str, str), with a single Vary header at the end
+    """
+    vary = []
+    for key, value in response_headers:
+        if key.lower() == 'vary':
+            vary.extend(value.split(','))
+    vary.extend(names)
+    merged = []
+    for name in vary:
+        name = name.strip()
+        if name and name.lower() not in [
+            other.lower() for other in merged]:
+            merged.append(name)
+    response_headers = [(key, value) for key, value in response_headers
+                        if key.lower() != 'vary']
+    if merged:
+        response_headers.append(('Vary', ', '.join(merged)))
+    return response_headers
+
+
 def boolean(value):
     if isinstance(value, basestring):
         return value.lower() in ("on", "true", "yes")
@@ -151,11 +1054,7 @@ def paste_app_factory(global_conf, **local_conf):
 
 def wsgiref_server():
     config_file = sys.argv[1]
-
-    config = ConfigParser.ConfigParser()
-    config.read(config_file)
-    options = dict((key.replace('-', '_'), value)
-                   for key, value in config.items('DEFAULT'))
+    options = ophelia.util.read_config(config_file)
 
     configured_app = Application(options)
 
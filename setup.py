@@ -24,6 +24,11 @@ longdesc = "\n\n".join((open(project_path("README.txt")).read(),
 entry_points = """\
     [console_scripts]
     ophelia-wsgiref = ophelia.wsgi:wsgiref_server
+    ophelia-build = ophelia.build:main
+    ophelia-server = ophelia.server:main
+    ophelia-benchmark = ophelia.benchmark:main
+    ophelia-warmup = ophelia.warmup:main
+    ophelia-bundle = ophelia.bundle:main
 
     [paste.app_factory]
     main = ophelia.wsgi:Application.paste_app_factory
@@ -32,6 +37,7 @@ entry_points = """\
 install_requires = [
     "xsendfile",
     "zope.interface",
+    "zope.tal",
     "zope.tales",
     "zope.pagetemplate",
     "zope.exceptions",